@@ -6,15 +6,326 @@ Chứa toàn bộ logic xử lý từ main.py
 import os
 import cv2
 import time
+import threading
+from collections import OrderedDict
 from pathlib import Path
-from ultralytics import YOLO
 import numpy as np
 
 # Import utils từ thư mục gốc
 import sys
 sys.path.append(str(Path(__file__).parent.parent))
-from utils.caculator import inside
-from utils.processor import get_color
+from utils.caculator import assign_items
+from utils.pipeline import Pipeline, Stage, RateMeter, BLOCK, DROP_OLDEST
+from utils.scheduler import MultiSourceScheduler, ROUND_ROBIN
+from utils.writer import AsyncVideoWriter
+from utils.clips import ClipRecorder
+from utils.eventlog import DetectionLog
+from utils.upload import cache_upload, local_path, unpin_upload
+from utils.profiler import StageProfiler
+from utils.motion import MotionGate, frame_signature, frame_difference
+from utils.renderer import Renderer, BGR, RGB
+from utils.tracker import BoxPropagator, WorkerTracker
+from src.predictor import load_predictor
+
+# Backend chạy model
+ULTRALYTICS = 'ultralytics'
+CUSTOM = 'custom'
+ONNX = 'onnx'
+TORCHSCRIPT = 'torchscript'
+COMPILED = 'compiled'
+
+
+class InferenceBackend:
+    """
+    Backend chạy model: load model từ file và chạy inference trên lô frame BGR
+    
+    Mọi backend trả về cùng 1 định dạng: list dict {'boxes' (xyxy theo frame gốc),
+    'class_ids', 'confidences', 'names'}, nên phần còn lại của pipeline không
+    phụ thuộc vào backend.
+    
+    Args:
+        model_path (str): Đường dẫn file model
+        device (str): Thiết bị chạy model (None = tự chọn)
+    """
+    
+    name = None
+    suffixes = ()  # Đuôi file được tự động chọn backend này
+    
+    def __init__(self, model_path, device=None):
+        self.model_path = model_path
+        self.device = device
+        self.model = self.load(model_path, device)
+    
+    def load(self, model_path, device):
+        raise NotImplementedError
+    
+    def infer(self, frames, conf, profiler, classes=None):
+        """
+        Args:
+            frames (list): Danh sách frame BGR
+            conf (float): Ngưỡng confidence
+            profiler (StageProfiler): Nơi ghi thời gian preprocess / forward / postprocess
+            classes (list): Chỉ giữ detection của các class id này (None = mọi lớp)
+            
+        Returns:
+            list: Mỗi phần tử là dict {'boxes', 'class_ids', 'confidences', 'names'}
+        """
+        raise NotImplementedError
+    
+    def class_ids(self, labels):
+        """Class id (theo names của model) của các nhãn trong `labels`, không phân biệt hoa thường"""
+        labels = {label.lower() for label in labels}
+        return sorted(i for i, name in self.model.names.items() if name.lower() in labels)
+
+
+class UltralyticsBackend(InferenceBackend):
+    """
+    YOLO của ultralytics (load trực tiếp file .pt đã train)
+    
+    Predictor của ultralytics giữ trạng thái theo từng lần gọi nên không
+    thread-safe; backend lấy từ MODEL_REGISTRY được dùng chung giữa các session,
+    thread inference của pipeline và scheduler nhiều nguồn, nên mỗi lần
+    inference được khóa riêng cho từng model.
+    """
+    
+    name = ULTRALYTICS
+    suffixes = ('.pt',)
+    
+    def __init__(self, model_path, device=None):
+        self._lock = threading.Lock()
+        super().__init__(model_path, device)
+    
+    def load(self, model_path, device):
+        # Import nặng, chỉ thực hiện khi thật sự dùng backend này
+        from ultralytics import YOLO
+        return YOLO(model_path)
+    
+    def infer(self, frames, conf, profiler, classes=None):
+        with self._lock:
+            results = self.model(list(frames), verbose=False, conf=conf, device=self.device, classes=classes)
+        
+        detections = []
+        for result in results:
+            # Ultralytics đo sẵn thời gian (ms/ảnh) cho từng bước của predict
+            for stage, key in (('preprocess', 'preprocess'), ('forward', 'inference'), ('postprocess', 'postprocess')):
+                if result.speed.get(key) is not None:
+                    profiler.record(stage, result.speed[key] / 1000)
+            
+            detections.append({
+                'boxes': result.boxes.xyxy.cpu().numpy(),
+                'class_ids': result.boxes.cls.cpu().numpy().astype(int),
+                'confidences': result.boxes.conf.cpu().numpy(),
+                'names': result.names
+            })
+        return detections
+
+
+class PredictorBackend(InferenceBackend):
+    """Backend dùng chung tiền / hậu xử lý của src/predictor.py, chỉ khác phần forward"""
+    
+    compile = False
+    
+    def load(self, model_path, device):
+        predictor = load_predictor(model_path, device, compile=self.compile)
+        predictor.names = predictor.names or PPEDetector.LABELS
+        return predictor
+    
+    def infer(self, frames, conf, profiler, classes=None):
+        count = len(frames)
+        with profiler.stage('preprocess', count=count):
+            batch, metas = self.model.preprocess(list(frames))
+        with profiler.stage('forward', count=count):
+            preds = self.model.forward(batch)
+        with profiler.stage('postprocess', count=count):
+            return self.model.postprocess(preds, metas, conf, classes)
+
+
+class CustomBackend(PredictorBackend):
+    """DetectionModel trong src/ (PyTorch, BatchNorm đã gộp), load file .pt hoặc .ppe"""
+    
+    name = CUSTOM
+    suffixes = ('.ppe',)
+
+
+class CompiledBackend(CustomBackend):
+    """
+    DetectionModel biên dịch bằng torch.compile (channels_last, shape tĩnh)
+    
+    Chỉ dùng khi chọn rõ ràng: mỗi độ phân giải đầu vào mới tốn vài chục giây
+    biên dịch ở frame đầu tiên.
+    """
+    
+    name = COMPILED
+    suffixes = ()
+    compile = True
+
+
+class OnnxBackend(PredictorBackend):
+    """File .onnx export bởi src/export.py, chạy bằng ONNX Runtime"""
+    
+    name = ONNX
+    suffixes = ('.onnx',)
+
+
+class TorchScriptBackend(PredictorBackend):
+    """File .torchscript export bởi src/export.py"""
+    
+    name = TORCHSCRIPT
+    suffixes = ('.torchscript',)
+
+
+BACKENDS = {cls.name: cls for cls in (UltralyticsBackend, CustomBackend, CompiledBackend, OnnxBackend,
+                                      TorchScriptBackend)}
+
+# Đuôi file model được liệt kê trong UI
+MODEL_SUFFIXES = tuple(suffix for cls in BACKENDS.values() for suffix in cls.suffixes)
+
+
+def resolve_backend(model_path, backend=None):
+    """
+    Chọn backend theo tham số, hoặc theo đuôi file model nếu backend = None
+    
+    Args:
+        model_path (str): Đường dẫn file model (có thể None)
+        backend (str): Tên backend trong BACKENDS (None = tự chọn)
+        
+    Returns:
+        str: Tên backend
+    """
+    suffix = Path(model_path).suffix.lower() if model_path else ''
+    if backend is None:
+        return next((name for name, cls in BACKENDS.items() if suffix in cls.suffixes), ULTRALYTICS)
+    if backend not in BACKENDS:
+        raise ValueError(f"backend phải là 1 trong {list(BACKENDS)}, nhận được: {backend}")
+    if backend in (ONNX, TORCHSCRIPT) and model_path and suffix not in BACKENDS[backend].suffixes:
+        raise ValueError(f"Backend '{backend}' cần file {BACKENDS[backend].suffixes[0]}, nhận được: {model_path}")
+    return backend
+
+
+class ModelRegistry:
+    """
+    Cache các model đã load trong toàn process
+    
+    Module backend chỉ được import 1 lần nên registry sống qua các lần rerun
+    và giữa các session của Streamlit. Model được nhận diện theo (đường dẫn,
+    mtime, device, backend): file .pt bị ghi đè sẽ được load lại. Khi tổng dung lượng
+    vượt ngân sách, model ít dùng gần đây nhất bị loại (LRU).
+    
+    Load và warm-up chạy ngoài lock chung (có thể mất hàng chục giây với backend
+    compiled), chỉ chặn các lời gọi khác cho cùng key; lock chung chỉ giữ khi tra /
+    sửa cache.
+    
+    Args:
+        max_bytes (int): Ngân sách bộ nhớ cho toàn bộ model trong cache
+    """
+    
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self._models = OrderedDict()  # key -> (model, nbytes)
+        self._loading = {}  # key -> lock của lần load đang chạy
+        self._lock = threading.Lock()
+    
+    @staticmethod
+    def make_key(model_path, device=None, backend=ULTRALYTICS):
+        path = Path(model_path).resolve()
+        return (str(path), path.stat().st_mtime_ns, str(device or 'auto'), backend)
+    
+    @staticmethod
+    def model_nbytes(model):
+        """Ước lượng bộ nhớ của model từ parameters và buffers (hoặc thuộc tính nbytes)"""
+        if getattr(model, 'nbytes', None) is not None:
+            return model.nbytes
+        if hasattr(model, 'parameters'):
+            tensors = list(model.parameters()) + list(model.buffers())
+            return sum(t.numel() * t.element_size() for t in tensors)
+        # Backend / Predictor bọc model thật trong thuộc tính .model
+        if hasattr(model, 'model'):
+            return ModelRegistry.model_nbytes(model.model)
+        return 0
+    
+    @property
+    def total_bytes(self):
+        return sum(nbytes for _, nbytes in self._models.values())
+    
+    def get(self, model_path, device=None, loader=None, warmup=None, backend=ULTRALYTICS):
+        """
+        Lấy model từ cache, load (và warm-up) nếu chưa có
+        
+        Args:
+            model_path (str): Đường dẫn model
+            device (str): Thiết bị chạy model (None = tự chọn)
+            loader (function): Hàm load model từ đường dẫn
+            warmup (function): Hàm chạy inference thử ngay sau khi load
+            backend (str): Backend của model (cùng 1 file có thể được load bởi nhiều backend)
+            
+        Returns:
+            Model đã load
+        """
+        key = self.make_key(model_path, device, backend)
+        with self._lock:
+            model = self._lookup(key)
+            if model is not None:
+                return model
+            load_lock = self._loading.setdefault(key, threading.Lock())
+        
+        with load_lock:
+            try:
+                # Thread khác có thể vừa load xong cùng key trong lúc chờ
+                with self._lock:
+                    model = self._lookup(key)
+                if model is not None:
+                    return model
+                
+                model = loader(model_path)
+                if warmup is not None:
+                    warmup(model)
+                nbytes = self.model_nbytes(model)
+                
+                with self._lock:
+                    # Bỏ các bản cũ của cùng file (mtime khác)
+                    for old_key in [k for k in self._models if k[0] == key[0] and k[2:] == key[2:]]:
+                        del self._models[old_key]
+                    
+                    self._models[key] = (model, nbytes)
+                    self._evict()
+                return model
+            finally:
+                with self._lock:
+                    if self._loading.get(key) is load_lock:
+                        del self._loading[key]
+    
+    def _lookup(self, key):
+        """Model trong cache (đánh dấu vừa dùng) hoặc None; gọi khi đang giữ _lock"""
+        if key not in self._models:
+            return None
+        self._models.move_to_end(key)
+        self._evict()
+        return self._models[key][0]
+    
+    def _evict(self):
+        # Luôn giữ lại model vừa dùng, kể cả khi 1 mình nó vượt ngân sách
+        while len(self._models) > 1 and self.total_bytes > self.max_bytes:
+            self._models.popitem(last=False)
+    
+    def clear(self):
+        with self._lock:
+            self._models.clear()
+
+
+# Registry dùng chung, ngân sách cấu hình qua biến môi trường PPE_MODEL_CACHE_MB
+MODEL_REGISTRY = ModelRegistry(int(os.environ.get('PPE_MODEL_CACHE_MB', 2048)) * 1024 * 1024)
+
+
+class _StreamState:
+    """Trạng thái theo thời gian của 1 luồng video (keyframe, nội suy box)"""
+    
+    def __init__(self):
+        self.frame_index = -1
+        self.last_key_index = None
+        self.key_signature = None
+        self.propagator = BoxPropagator()
+        self.tracker = None
+        self.gate = None
 
 
 class PPEDetector:
@@ -33,7 +344,14 @@ class PPEDetector:
         8: 'no_boots'
     }
     
-    def __init__(self, model_path, required_items, conf_threshold=0.5):
+    # Kích thước ảnh dùng để warm-up model sau khi load
+    WARMUP_SIZE = (640, 640)
+    
+    def __init__(self, model_path, required_items, conf_threshold=0.5, device=None, profiler=None,
+                 stride=1, scene_change_threshold=None, track_workers=False, tracker_options=None,
+                 motion_threshold=None, motion_max_skip=30, motion_method='diff',
+                 render=True, color_order=BGR, backend=None, required_only=False, event_log=None,
+                 clip_recorder=None):
         """
         Khởi tạo PPE Detector
         
@@ -41,109 +359,500 @@ class PPEDetector:
             model_path (str): Đường dẫn đến model .pt
             required_items (list): Danh sách các PPE cần phát hiện
             conf_threshold (float): Ngưỡng confidence
+            device (str): Thiết bị chạy model, ví dụ 'cpu', 'cuda:0' (None = tự chọn)
+            profiler (StageProfiler): Bộ đo thời gian từng stage (None = tạo mới)
+            stride (int): Chỉ chạy model mỗi `stride` frame (keyframe); các frame
+                ở giữa dùng box nội suy theo vận tốc (1 = chạy mọi frame)
+            scene_change_threshold (float): Chạy model sớm hơn khi chênh lệch trung
+                bình (0-255) so với keyframe trước vượt ngưỡng (None = tắt)
+            track_workers (bool): Theo dõi worker qua các frame (ID ổn định, trạng thái
+                Safe/Unsafe được làm mượt, chỉ gán lại PPE cho worker đã di chuyển)
+            tracker_options (dict): Tham số thêm cho WorkerTracker
+            motion_threshold (float): Bỏ qua inference và dùng lại detection trước khi
+                điểm chuyển động dưới ngưỡng này (None = tắt), xem MotionGate
+            motion_max_skip (int): Số keyframe bỏ qua liên tiếp tối đa trước khi buộc
+                chạy lại model
+            motion_method (str): Cách tính điểm chuyển động: 'diff' hoặc 'mog2'
+            render (bool): Vẽ kết quả lên frame (False = chạy headless, frame giữ nguyên)
+            color_order (str): Thứ tự kênh màu của frame sau annotate(): 'bgr' (vẽ thẳng
+                lên frame) hoặc 'rgb' (1 lần cvtColor ra mảng mới rồi vẽ lên đó). AsyncVideoWriter
+                với encoder opencv lại đổi RGB về BGR, nên chỉ export thì dùng 'bgr'
+            backend (str): 'ultralytics', 'custom' (DetectionModel trong src/), 'compiled'
+                (custom + torch.compile), 'onnx' hoặc 'torchscript' (None = chọn theo đuôi file model)
+            required_only (bool): Chỉ hậu xử lý worker, các PPE trong required_items và
+                nhãn no_* tương ứng; PPE không yêu cầu bị bỏ ngay sau forward (không được vẽ)
+            event_log (DetectionLog): Nơi ghi detection / trạng thái Safe của mọi frame
+                sau associate() (None = không ghi)
+            clip_recorder (ClipRecorder): Nơi nhận frame sau annotate() để chỉ lưu các
+                clip quanh vi phạm (None = không ghi), chỉ dùng cho 1 luồng video
         """
         self.model_path = model_path
         self.required_items = required_items
         self.conf_threshold = conf_threshold
+        self.device = device
+        self.backend = resolve_backend(model_path, backend)
         self.model = None
         self.fps = 0
+        self.profiler = profiler or StageProfiler()
+        self.stride = max(int(stride), 1)
+        self.scene_change_threshold = scene_change_threshold
+        self.track_workers = track_workers
+        self.tracker_options = tracker_options or {}
+        self.motion_threshold = motion_threshold
+        self.motion_max_skip = motion_max_skip
+        self.motion_method = motion_method
+        self.renderer = Renderer(color_order, enabled=render)
+        self.required_only = required_only
+        self.event_log = event_log
+        self.clip_recorder = clip_recorder
+        self._classes = None
+        self.stats = {'frames': 0, 'keyframes': 0, 'motion_skipped': 0, 'motion_forced': 0}
+        self._streams = {}
         
     def load_model(self):
-        """Load YOLO model từ file .pt"""
+        """Lấy model từ registry dùng chung (chỉ load từ file .pt ở lần đầu)"""
         if self.model is None:
-            self.model = YOLO(self.model_path)
-            self.model.conf = self.conf_threshold
+            self.model = MODEL_REGISTRY.get(
+                self.model_path,
+                device=self.device,
+                loader=lambda path: BACKENDS[self.backend](path, self.device),
+                warmup=self._warmup,
+                backend=self.backend
+            )
         return self.model
     
-    def process_frame(self, frame):
-        start_time = time.time()
+    def _warmup(self, model):
+        """Chạy 1 lần inference trên ảnh đen để khởi tạo predictor trước frame đầu tiên"""
+        height, width = self.WARMUP_SIZE
+        dummy = np.zeros((height, width, 3), dtype=np.uint8)
+        model.infer([dummy], self.conf_threshold, StageProfiler())
+    
+    def reset_streams(self):
+        """Xóa trạng thái theo thời gian của mọi luồng video"""
+        self._streams.clear()
+    
+    def _is_keyframe(self, state, signature):
+        if state.last_key_index is None:
+            return True
+        if state.frame_index - state.last_key_index >= self.stride:
+            return True
+        if self.scene_change_threshold is not None:
+            return frame_difference(signature, state.key_signature) > self.scene_change_threshold
+        return False
+    
+    def predict(self, frames, streams=None, timestamps=None):
+        """
+        Lấy detection cho một lô frame; chỉ keyframe mới chạy model (1 lần forward)
+        
+        Args:
+            frames (list): Danh sách frame BGR theo đúng thứ tự đọc
+            streams (list): ID luồng video của từng frame (None = cùng 1 luồng)
+            timestamps (list): Thời điểm của từng frame trong luồng, giây (None = không rõ,
+                log tính theo frame / fps)
+            
+        Returns:
+            list: Mỗi phần tử là dict {'boxes', 'class_ids', 'confidences', 'names', 'keyframe',
+                'stream', 'frame' (chỉ số frame trong luồng), 'timestamp', 'processed' (unix time lúc xử lý)}
+        """
+        streams = streams if streams is not None else [0] * len(frames)
+        timestamps = timestamps if timestamps is not None else [None] * len(frames)
         
-        # Chạy YOLO detection
-        results = self.model(frame, verbose=False, conf=self.conf_threshold)[0]
+        # Bước 1: chọn keyframe cho từng frame theo stride / mức thay đổi cảnh,
+        # keyframe mà cảnh gần như đứng yên thì dùng lại detection trước (không chạy model)
+        plan = []
+        skipped = 0
+        for frame, stream_id in zip(frames, streams):
+            state = self._streams.setdefault(stream_id, _StreamState())
+            state.frame_index += 1
+            signature = None
+            if self.scene_change_threshold is not None or self.motion_threshold is not None:
+                signature = frame_signature(frame)
+            is_key = self._is_keyframe(state, signature)
+            hold = False
+            if is_key and self.motion_threshold is not None:
+                if state.gate is None:
+                    state.gate = MotionGate(self.motion_threshold, self.motion_max_skip, self.motion_method)
+                forced = state.gate.forced
+                hold = not state.gate.should_run(frame, signature)
+                self.stats['motion_forced'] += state.gate.forced - forced
+                skipped += hold
+            if is_key:
+                state.last_key_index = state.frame_index
+                state.key_signature = signature
+            plan.append((state, state.frame_index, is_key and not hold, hold))
         
-        # Lấy thông tin detection
-        boxes = results.boxes.xyxy.cpu().numpy()
-        class_ids = results.boxes.cls.cpu().numpy().astype(int)
-        confidences = results.boxes.conf.cpu().numpy()
-        names = results.names
+        key_frames = [frame for frame, (_, _, is_key, _) in zip(frames, plan) if is_key]
+        key_detections = iter(self._infer(key_frames) if key_frames else [])
+        processed = time.time()
         
-        workers = []
-        items = []
+        # Bước 2: theo đúng thứ tự, cập nhật keyframe và nội suy các frame còn lại
+        detections = []
+        for frame, stream_id, timestamp, (state, frame_index, is_key, hold) in zip(frames, streams, timestamps, plan):
+            if is_key:
+                detection = next(key_detections)
+                state.propagator.update(detection, frame_index)
+            elif hold:
+                detection = state.propagator.hold(frame_index, frame.shape)
+            else:
+                detection = state.propagator.propagate(frame_index, frame.shape)
+            detections.append({**detection, 'keyframe': is_key, 'stream': stream_id, 'frame': frame_index,
+                               'timestamp': timestamp, 'processed': processed})
+        
+        self.stats['frames'] += len(frames)
+        self.stats['keyframes'] += len(key_frames)
+        self.stats['motion_skipped'] += skipped
+        return detections
+    
+    def _infer(self, frames):
+        """
+        Chạy model (qua backend) trên một lô frame trong 1 lần forward
         
-        # Phân loại workers và PPE items
-        for box, cls_id, conf in zip(boxes, class_ids, confidences):
-            label = names[cls_id]
+        Args:
+            frames (list): Danh sách frame BGR
             
-            if label.lower() == 'worker':
-                workers.append({'box': box, 'items': set(), 'conf': conf})
-            elif label in self.LABELS.values():
-                items.append({'box': box, 'label': label, 'conf': conf})
-        
-        # Kiểm tra trang bị của từng worker
-        for worker in workers:
-            wbox = worker['box']
-            for item in items:
-                if item['label'] in self.required_items and inside(item['box'], wbox):
-                    worker['items'].add(item['label'])
-        
-        # Vẽ PPE items trước
-        # frame = results.plot()
-        for item in items:
-            x1, y1, x2, y2 = map(int, item['box'])
-            color = get_color(item['label'])
-            cv2.rectangle(frame, (x1, y1), (x2, y2), color, 1)
-            label_text = f"{item['label']} {item['conf']:.2f}"
-            cv2.putText(frame, label_text, (x1, y1 - 8),
-                        cv2.FONT_HERSHEY_SIMPLEX, 0.4, color, 1)
-        
-        # Vẽ workers với màu phù hợp
-        for worker in workers:
-            x1, y1, x2, y2 = map(int, worker['box'])
-            has_all = all(req in worker['items'] for req in self.required_items) and \
-                      all(f"no_{req}" not in worker['items'] for req in self.required_items)
+        Returns:
+            list: Mỗi phần tử là dict {'boxes', 'class_ids', 'confidences', 'names'}
+        """
+        return self.model.infer(frames, self.conf_threshold, self.profiler, self._decode_classes())
+    
+    def _decode_classes(self):
+        """Class id cần hậu xử lý khi bật required_only (None = mọi lớp)"""
+        if not self.required_only:
+            return None
+        if self._classes is None:
+            labels = {'worker', *self.required_items, *(f"no_{item}" for item in self.required_items)}
+            # Không khớp được nhãn nào (model có names khác) thì giữ mọi lớp
+            self._classes = self.model.class_ids(labels) or None
+        return self._classes
+    
+    def associate(self, detection):
+        """
+        Phân loại worker / PPE item và kiểm tra trang bị của từng worker
+        
+        Args:
+            detection (dict): Kết quả của predict() cho 1 frame
             
-            # Safe: xanh lá, Unsafe: đỏ
-            color = (0, 255, 0) if has_all else (0, 0, 255)
-            status = 'Safe' if has_all else 'Unsafe'
-            label_text = f"Worker ({status}) {worker['conf']:.2f}"
+        Returns:
+            tuple: (workers, items)
+        """
+        with self.profiler.stage('association'):
+            names = detection['names']
+            workers = []
+            items = []
+            
+            # Phân loại workers và PPE items
+            for box, cls_id, conf in zip(detection['boxes'], detection['class_ids'], detection['confidences']):
+                label = names[cls_id]
             
-            cv2.rectangle(frame, (x1, y1), (x2, y2), color, 2)
-            cv2.putText(frame, label_text, (x1, y1 - 8),
-                       cv2.FONT_HERSHEY_SIMPLEX, 0.6, color, 2)
+                if label.lower() == 'worker':
+                    workers.append({'box': box, 'items': set(), 'conf': conf})
+                elif label in self.LABELS.values():
+                    items.append({'box': box, 'label': label, 'conf': conf})
+            
+            required = [item for item in items if item['label'] in self.required_items]
+            if self.track_workers:
+                self._associate_tracks(detection.get('stream', 0), workers, required)
+            else:
+                # Kiểm tra trang bị của từng worker (tính toàn bộ cặp worker × item một lần)
+                if workers and required:
+                    _, mask = assign_items(
+                        [item['box'] for item in required],
+                        [worker['box'] for worker in workers]
+                    )
+                    for item_idx, worker_idx in zip(*np.nonzero(mask)):
+                        workers[worker_idx]['items'].add(required[item_idx]['label'])
+                
+                for worker in workers:
+                    worker['safe'] = self.is_safe(worker['items'])
             
-            # Hiển thị missing items nếu unsafe
-            if not has_all:
-                missing = set(self.required_items) - worker['items']
-                missing_text = f"Missing: {', '.join(missing)}"
-                cv2.putText(frame, missing_text, (x1, y2 + 20),
-                           cv2.FONT_HERSHEY_SIMPLEX, 0.4, (0, 0, 255), 1)
+            if self.event_log is not None:
+                self.event_log.add(detection, workers, items)
+            return workers, items
+    
+    def is_safe(self, worker_items):
+        """Safe khi có đủ PPE yêu cầu và không có nhãn no_* tương ứng"""
+        return all(req in worker_items for req in self.required_items) and \
+               all(f"no_{req}" not in worker_items for req in self.required_items)
+    
+    def _associate_tracks(self, stream_id, workers, required):
+        """Gán PPE qua WorkerTracker của luồng: dùng lại kết quả cho worker không di chuyển"""
+        state = self._streams.setdefault(stream_id, _StreamState())
+        if state.tracker is None:
+            state.tracker = WorkerTracker(self.is_safe, assign_items, **self.tracker_options)
         
-        # Tính FPS
-        end_time = time.time()
-        self.fps = 1 / (end_time - start_time) if (end_time - start_time) > 0 else 0
+        tracks = state.tracker.update(
+            [worker['box'] for worker in workers],
+            [item['box'] for item in required],
+            [item['label'] for item in required]
+        )
+        for worker, track in zip(workers, tracks):
+            worker['track_id'] = track.track_id
+            worker['items'] = set(track.items)
+            worker['safe'] = track.safe
+    
+    def track_summary(self, stream_id=0):
+        """Thống kê theo người của 1 luồng (None nếu không bật theo dõi worker)"""
+        state = self._streams.get(stream_id)
+        if state is None or state.tracker is None:
+            return None
+        return state.tracker.summary()
+    
+    def annotate(self, frame, workers, items):
+        """
+        Vẽ PPE items và workers (Safe/Unsafe) lên frame (in-place, xem Renderer)
         
-        return frame, self.fps
+        Khi có clip_recorder, frame đã vẽ được đưa tiếp vào đó kèm số worker Unsafe,
+        nên annotate() phải được gọi theo đúng thứ tự frame.
+        """
+        with self.profiler.stage('annotation'):
+            frame = self.renderer.draw(frame, workers, items, self.required_items)
+        if self.clip_recorder is not None:
+            with self.profiler.stage('clips'):
+                unsafe = sum(1 for worker in workers if not worker['safe'])
+                self.clip_recorder.add(frame, unsafe > 0, unsafe)
+        return frame
+    
+    def process_batch(self, frames, timestamps=None):
+        """
+        Xử lý một lô frame: 1 lần inference cho cả lô, sau đó gán PPE và vẽ từng frame
+        
+        Args:
+            frames (list): Danh sách frame BGR theo đúng thứ tự đọc
+            timestamps (list): Thời điểm của từng frame trong luồng (xem predict())
+            
+        Returns:
+            list: Danh sách (frame, fps) cùng thứ tự với đầu vào
+        """
+        if not frames:
+            return []
+        
+        start_time = time.time()
+        
+        detections = self.predict(frames, timestamps=timestamps)
+        processed = []
+        for frame, detection in zip(frames, detections):
+            workers, items = self.associate(detection)
+            processed.append(self.annotate(frame, workers, items))
+        
+        # FPS tính theo thời gian trung bình mỗi frame trong lô
+        elapsed = time.time() - start_time
+        self.fps = len(frames) / elapsed if elapsed > 0 else 0
+        
+        return [(frame, self.fps) for frame in processed]
+    
+    def process_frame(self, frame):
+        return self.process_batch([frame])[0]
 
 
 def get_available_models(weights_dir="weights/ppe"):
     """
-    Lấy danh sách các model .pt có sẵn
+    Lấy danh sách các model có sẵn (.pt, .ppe, .onnx, .torchscript)
     
     Args:
         weights_dir (str): Thư mục chứa model weights
         
     Returns:
-        list: Danh sách các file .pt
+        list: Danh sách tên file model
     """
     root_path = Path(__file__).parent.parent / weights_dir
     if not root_path.exists():
         return []
     
-    models = [f for f in os.listdir(root_path) if f.endswith('.pt')]
+    models = [f for f in os.listdir(root_path) if f.endswith(MODEL_SUFFIXES)]
     return sorted(models)
 
 
-def run_detection(model_path, required_items, conf_threshold, source, stop_flag=None, export_path=None):
+def is_stream_url(source):
+    """Kiểm tra source có phải stream URL (rtsp://, http://, ...) không"""
+    return isinstance(source, str) and '://' in source
+
+
+def is_live_source(source):
+    """Camera và stream là nguồn trực tiếp: nên bỏ frame cũ thay vì chờ"""
+    return isinstance(source, int) or is_stream_url(source)
+
+
+def open_capture(source):
+    """
+    Mở cv2.VideoCapture cho một nguồn video
+    
+    Args:
+        source: Camera ID (int), stream URL, đường dẫn file, hoặc uploaded file
+        
+    Returns:
+        cv2.VideoCapture: Capture đã mở (file upload được giữ trong cache nên không cần xóa)
+    """
+    cap = None
+    
+    if isinstance(source, os.PathLike):
+        source = str(source)
+    
+    # Mở video capture
+    if isinstance(source, int):
+        # Webcam
+        cap = cv2.VideoCapture(source, cv2.CAP_DSHOW)  # Sử dụng DirectShow trên Windows
+        if not cap.isOpened():
+            cap = cv2.VideoCapture(source)  # Fallback
+        
+        if not cap.isOpened():
+            raise ValueError(f"Không thể mở camera ID {source}. Vui lòng kiểm tra:\n"
+                           f"- Camera đã được kết nối chưa?\n"
+                           f"- Ứng dụng khác có đang sử dụng camera không?")
+    
+    elif is_stream_url(source):
+        # Stream URL (RTSP/HTTP)
+        cap = cv2.VideoCapture(source)
+        
+        if not cap.isOpened():
+            raise ValueError(f"Không thể kết nối stream: {source}")
+    
+    elif isinstance(source, str):
+        # File path
+        if not Path(source).exists():
+            raise ValueError(f"File không tồn tại: {source}")
+        
+        cap = cv2.VideoCapture(source)
+        
+        if not cap.isOpened():
+            raise ValueError(f"Không thể mở file video: {source}\n"
+                           f"- Định dạng file có được hỗ trợ không?\n"
+                           f"- File có bị lỗi không?")
+    
+    else:
+        # Uploaded file: mở trực tiếp nếu đã nằm trên ổ đĩa, ngược lại copy
+        # theo từng chunk vào cache (theo hash nội dung) để không giữ cả file trong RAM
+        file_ext = '.mp4'
+        if hasattr(source, 'name'):
+            file_ext = Path(source.name).suffix or '.mp4'
+        
+        try:
+            video_path = local_path(source)
+            pinned = video_path is None
+            if pinned:
+                # Giữ file cache tới khi mở xong để session khác không dọn mất
+                video_path = cache_upload(source, suffix=file_ext, pin=True)
+        except Exception as e:
+            raise ValueError(f"Lỗi khi xử lý file upload: {str(e)}")
+        
+        try:
+            cap = cv2.VideoCapture(video_path)
+        finally:
+            if pinned:
+                unpin_upload(video_path)
+        
+        if not cap.isOpened():
+            raise ValueError(f"Không thể mở file video đã upload.\n"
+                           f"- Định dạng file: {file_ext}\n"
+                           f"- Vui lòng thử upload file khác hoặc định dạng khác (MP4, AVI, MOV)")
+    
+    # Kiểm tra cuối cùng
+    if not cap or not cap.isOpened():
+        raise ValueError("Không thể mở nguồn video. Vui lòng thử lại.")
+    
+    return cap
+
+
+def _read_frame(cap, profiler):
+    """Đọc 1 frame (đo thời gian decode); trả về None khi hết video"""
+    with profiler.stage('decode'):
+        ret, frame = cap.read()
+    return frame if ret else None
+
+
+def _stream_clock(cap, live):
+    """
+    Tạo hàm trả về thời điểm (giây, tính từ frame đầu) của frame vừa đọc từ cap
+    
+    File dùng vị trí trong video (CAP_PROP_POS_MSEC), nguồn trực tiếp dùng thời gian
+    thực lúc đọc, nên thời điểm vẫn đúng khi frame bị bỏ (DROP_OLDEST, buffer của
+    camera). Phải gọi ngay sau khi đọc, trên cùng thread với cap.read().
+    """
+    start = None
+    
+    def clock():
+        nonlocal start
+        now = time.time() if live else cap.get(cv2.CAP_PROP_POS_MSEC) / 1000
+        if start is None:
+            start = now
+        return now - start
+    
+    return clock
+
+
+def _finish_frame(processed_frame, fps, video_writer, profiler, color_order=BGR, output_order=RGB):
+    """Ghi frame vào video (nếu có) và trả về frame theo thứ tự kênh output_order"""
+    with profiler.stage('encode'):
+        # Ghi frame vào video nếu có export
+        if video_writer is not None:
+            video_writer.write(processed_frame)
+        
+        # Frame đã được vẽ đúng thứ tự kênh cần thì không chuyển màu nữa
+        if color_order == output_order:
+            return processed_frame, fps
+        converted = cv2.cvtColor(processed_frame, cv2.COLOR_BGR2RGB)
+    return converted, fps
+
+
+def _run_pipelined(detector, cap, clock, video_writer, stop_flag, batch_size, max_batch_latency, queue_size,
+                   policy, output_order=RGB):
+    """
+    Chạy detection dạng pipeline: đọc → inference → vẽ → encode trên các thread riêng
+    
+    Thời điểm của frame (clock, xem _stream_clock) được lấy ngay lúc đọc để log vẫn
+    đúng khi frame bị bỏ ở hàng đợi.
+    
+    Yields:
+        tuple: (frame theo output_order, fps) theo đúng thứ tự đọc
+    """
+    profiler = detector.profiler
+    
+    def read():
+        frame = _read_frame(cap, profiler)
+        return None if frame is None else (frame, clock())
+    
+    def infer(items):
+        frames = [frame for frame, _ in items]
+        return list(zip(frames, detector.predict(frames, timestamps=[timestamp for _, timestamp in items])))
+    
+    def render(pairs):
+        return [detector.annotate(frame, *detector.associate(detection)) for frame, detection in pairs]
+    
+    def encode(frames):
+        color_order = detector.renderer.color_order
+        return [_finish_frame(frame, 0, video_writer, profiler, color_order, output_order)[0] for frame in frames]
+    
+    pipeline = Pipeline(
+        read,
+        [
+            Stage(infer, 'infer', batch_size=batch_size, max_latency=max_batch_latency),
+            Stage(render, 'render'),
+            Stage(encode, 'encode'),
+        ],
+        queue_size=queue_size,
+        policy=policy
+    )
+    
+    # FPS đo theo tốc độ frame ra khỏi pipeline
+    meter = RateMeter()
+    frame_count = 0
+    for frame_rgb in pipeline:
+        if stop_flag and stop_flag():
+            break
+        
+        fps = meter.tick()
+        profiler.maybe_dump()
+        
+        frame_count += 1
+        yield frame_rgb, fps
+    
+    if frame_count == 0 and not (stop_flag and stop_flag()):
+        raise ValueError("Không thể đọc frame từ video. File có thể bị lỗi.")
+
+
+def run_detection(model_path, required_items, conf_threshold, source, stop_flag=None, export_path=None,
+                  batch_size=1, max_batch_latency=0.1, pipelined=False, queue_size=4, backpressure=None,
+                  device=None, export_options=None, profiler=None, detector=None, detector_options=None,
+                  output_color_order=RGB, log_path=None, log_options=None, clip_dir=None, clip_options=None):
     """
     Generator function để chạy detection và yield frame từng bước
     
@@ -154,74 +863,60 @@ def run_detection(model_path, required_items, conf_threshold, source, stop_flag=
         source: Nguồn video (0 cho webcam, path cho video file, hoặc uploaded file)
         stop_flag (function): Hàm callback để kiểm tra có dừng không
         export_path (str): Đường dẫn để lưu video kết quả (None = không lưu)
+        batch_size (int): Số frame gom lại cho 1 lần inference (1 = từng frame)
+        max_batch_latency (float): Thời gian tối đa (giây) chờ gom đủ lô trước khi
+            xử lý, để camera trực tiếp vẫn ra frame nhanh
+        pipelined (bool): Chạy đọc / inference / vẽ / encode trên các thread riêng
+        queue_size (int): Kích thước hàng đợi giữa các stage khi pipelined
+        backpressure (str): 'block' hoặc 'drop_oldest' khi hàng đợi đầy;
+            None = tự chọn (camera: drop_oldest, file: block)
+        device (str): Thiết bị chạy model (None = tự chọn)
+        export_options (dict): Tham số cho AsyncVideoWriter (encoder, codec, crf,
+            preset, queue_size, policy)
+        profiler (StageProfiler): Bộ đo thời gian từng stage, truyền vào để đọc
+            thống kê từ bên ngoài (None = tạo mới, xem detector.profiler)
+        detector (PPEDetector): Detector đã cấu hình sẵn; khi truyền vào thì
+            model_path, required_items, conf_threshold, device, profiler bị bỏ qua
+            (nên tạo với color_order = output_color_order để không phải chuyển màu từng frame)
+        detector_options (dict): Tham số thêm cho PPEDetector (stride, scene_change_threshold, ...)
+        output_color_order (str): Thứ tự kênh màu của frame yield ra: 'rgb' (mặc định,
+            dùng thẳng cho st.image) hoặc 'bgr' (ví dụ để tự nén JPEG bằng OpenCV)
+        log_path (str): Thư mục ghi log detection dạng cột (None = không ghi), xem
+            DetectionLog; dùng cùng export_path=None để không phải encode video
+        log_options (dict): Tham số thêm cho DetectionLog (chunk_frames, compress)
+        clip_dir (str): Thư mục lưu clip quanh các vi phạm (None = không lưu), xem
+            ClipRecorder; dùng thay cho export_path để không phải ghi toàn bộ video
+        clip_options (dict): Tham số thêm cho ClipRecorder (pre_seconds, post_seconds,
+            max_seconds, writer_options, prefix)
         
     Yields:
-        tuple: (frame, fps)
+        tuple: (frame, fps) - fps là tốc độ end-to-end (đọc → hiển thị) đo tại đầu ra
+        
+    Raises:
+        RuntimeError: Khi ghi video export lỗi (raise sau frame cuối, hoặc từ close()
+            khi dừng sớm; nên đóng generator rõ ràng, ví dụ bằng contextlib.closing)
     """
-    # Khởi tạo detector
-    detector = PPEDetector(model_path, required_items, conf_threshold)
+    # Khởi tạo detector (model lấy từ registry nên không load lại mỗi lần rerun),
+    # vẽ thẳng theo thứ tự kênh của đầu ra
+    if detector is None:
+        detector = PPEDetector(model_path, required_items, conf_threshold, device=device, profiler=profiler,
+                               **{'color_order': output_color_order, **(detector_options or {})})
     detector.load_model()
+    profiler = detector.profiler
+    color_order = detector.renderer.color_order
     
-    tmp_path = None
     cap = None
     video_writer = None
+    event_log = None
+    clip_recorder = None
     
     try:
-        # Mở video capture
-        if isinstance(source, int):
-            # Webcam
-            cap = cv2.VideoCapture(source, cv2.CAP_DSHOW)  # Sử dụng DirectShow trên Windows
-            if not cap.isOpened():
-                cap = cv2.VideoCapture(source)  # Fallback
-            
-            if not cap.isOpened():
-                raise ValueError(f"Không thể mở camera ID {source}. Vui lòng kiểm tra:\n"
-                               f"- Camera đã được kết nối chưa?\n"
-                               f"- Ứng dụng khác có đang sử dụng camera không?")
-        
-        elif isinstance(source, str):
-            # File path
-            if not Path(source).exists():
-                raise ValueError(f"File không tồn tại: {source}")
-            
-            cap = cv2.VideoCapture(source)
-            
-            if not cap.isOpened():
-                raise ValueError(f"Không thể mở file video: {source}\n"
-                               f"- Định dạng file có được hỗ trợ không?\n"
-                               f"- File có bị lỗi không?")
-        
-        else:
-            # Uploaded file (bytes)
-            import tempfile
-            try:
-                # Lấy tên file gốc nếu có
-                file_ext = '.mp4'
-                if hasattr(source, 'name'):
-                    file_ext = Path(source.name).suffix or '.mp4'
-                
-                with tempfile.NamedTemporaryFile(delete=False, suffix=file_ext) as tmp_file:
-                    tmp_file.write(source.read())
-                    tmp_path = tmp_file.name
-                
-                cap = cv2.VideoCapture(tmp_path)
-                
-                if not cap.isOpened():
-                    raise ValueError(f"Không thể mở file video đã upload.\n"
-                                   f"- Định dạng file: {file_ext}\n"
-                                   f"- Vui lòng thử upload file khác hoặc định dạng khác (MP4, AVI, MOV)")
-            
-            except Exception as e:
-                if tmp_path and Path(tmp_path).exists():
-                    try:
-                        os.unlink(tmp_path)
-                    except:
-                        pass
-                raise ValueError(f"Lỗi khi xử lý file upload: {str(e)}")
-        
-        # Kiểm tra cuối cùng
-        if not cap or not cap.isOpened():
-            raise ValueError("Không thể mở nguồn video. Vui lòng thử lại.")
+        cap = open_capture(source)
+        
+        if log_path:
+            event_log = open_event_log(log_path, detector, [cap], [source], log_options)
+        if clip_dir:
+            clip_recorder = open_clip_recorder(clip_dir, detector, cap, clip_options)
         
         # Thiết lập video writer nếu cần export
         if export_path:
@@ -234,40 +929,64 @@ def run_detection(model_path, required_items, conf_threshold, source, stop_flag=
             frame_height = int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT))
             fps_video = int(cap.get(cv2.CAP_PROP_FPS)) or 30
             
-            # Khởi tạo VideoWriter
-            fourcc = cv2.VideoWriter_fourcc(*'mp4v')
-            video_writer = cv2.VideoWriter(
-                str(export_path),
-                fourcc,
+            # Khởi tạo writer chạy nền để encode không làm chậm detection
+            video_writer = AsyncVideoWriter(
+                export_path,
                 fps_video,
-                (frame_width, frame_height)
+                (frame_width, frame_height),
+                **{'color_order': color_order, **(export_options or {})}
             )
         
-        # Đọc và xử lý frames
+        clock = _stream_clock(cap, is_live_source(source))
+        if pipelined:
+            if backpressure is None:
+                backpressure = DROP_OLDEST if is_live_source(source) else BLOCK
+            yield from _run_pipelined(detector, cap, clock, video_writer, stop_flag,
+                                      batch_size, max_batch_latency, queue_size, backpressure,
+                                      output_color_order)
+            return
+        
+        # Đọc và xử lý frames theo lô
+        batch_size = max(int(batch_size), 1)
         frame_count = 0
+        batch = []
+        timestamps = []
+        batch_start = None
+        meter = RateMeter()
         while cap.isOpened():
             # Kiểm tra stop flag
             if stop_flag and stop_flag():
                 break
             
-            ret, frame = cap.read()
-            if not ret:
-                if frame_count == 0:
+            frame = _read_frame(cap, profiler)
+            if frame is None:
+                if frame_count == 0 and not batch:
                     raise ValueError("Không thể đọc frame từ video. File có thể bị lỗi.")
                 break
             
-            # Process frame
-            processed_frame, fps = detector.process_frame(frame)
+            if not batch:
+                batch_start = time.time()
+            batch.append(frame)
+            timestamps.append(clock())
             
-            # Ghi frame vào video nếu có export
-            if video_writer is not None:
-                video_writer.write(processed_frame)
+            # Chờ gom đủ lô, trừ khi đã quá thời gian chờ cho phép
+            if len(batch) < batch_size and time.time() - batch_start < max_batch_latency:
+                continue
             
-            # Convert BGR to RGB cho Streamlit
-            processed_frame_rgb = cv2.cvtColor(processed_frame, cv2.COLOR_BGR2RGB)
-            
-            frame_count += 1
-            yield processed_frame_rgb, fps
+            for processed_frame, _ in detector.process_batch(batch, timestamps):
+                frame_count += 1
+                profiler.maybe_dump()
+                yield _finish_frame(processed_frame, meter.tick(), video_writer, profiler, color_order,
+                                    output_color_order)
+            batch = []
+            timestamps = []
+        
+        # Xử lý nốt các frame còn lại trong lô
+        if batch and not (stop_flag and stop_flag()):
+            for processed_frame, _ in detector.process_batch(batch, timestamps):
+                frame_count += 1
+                yield _finish_frame(processed_frame, meter.tick(), video_writer, profiler, color_order,
+                                    output_color_order)
             
     except Exception as e:
         # Re-raise với thông tin chi tiết
@@ -278,15 +997,168 @@ def run_detection(model_path, required_items, conf_threshold, source, stop_flag=
         if cap is not None:
             cap.release()
         
+        # Ghi nốt các frame còn trong hàng đợi rồi đóng file
         if video_writer is not None:
             video_writer.release()
         
-        # Xóa temp file nếu có
-        if tmp_path and Path(tmp_path).exists():
-            try:
-                os.unlink(tmp_path)
-            except:
-                pass
+        if event_log is not None:
+            detector.event_log = None
+            event_log.close()
+        
+        # Đóng clip đang ghi dở và chờ các clip encode xong
+        if clip_recorder is not None:
+            detector.clip_recorder = None
+            clip_recorder.close()
+        
+        # Encode lỗi (ví dụ ffmpeg thoát giữa chừng) thì báo cho phía gọi thay vì coi như đã lưu,
+        # trừ khi đang có lỗi khác (giữ nguyên lỗi gốc); khi generator bị đóng sớm,
+        # lỗi được raise từ close()
+        pending = sys.exc_info()[1]
+        if video_writer is not None and video_writer.error is not None and (
+                pending is None or isinstance(pending, GeneratorExit)):
+            raise RuntimeError(f"Lỗi khi ghi video: {video_writer.error}") from video_writer.error
+
+
+def open_clip_recorder(clip_dir, detector, cap, clip_options=None):
+    """
+    Tạo ClipRecorder cho 1 lần chạy và gắn vào detector
+    
+    Args:
+        clip_dir (str): Thư mục lưu clip
+        detector (PPEDetector): Detector sẽ đưa frame vào recorder sau mỗi lần annotate()
+        cap (cv2.VideoCapture): Capture của nguồn video (lấy fps, kích thước frame)
+        clip_options (dict): Tham số thêm cho ClipRecorder
+        
+    Returns:
+        ClipRecorder
+    """
+    detector.clip_recorder = ClipRecorder(
+        clip_dir,
+        cap.get(cv2.CAP_PROP_FPS) or 30,
+        (int(cap.get(cv2.CAP_PROP_FRAME_WIDTH)), int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT))),
+        **{'color_order': detector.renderer.color_order, **(clip_options or {})}
+    )
+    return detector.clip_recorder
+
+
+def open_event_log(log_path, detector, captures, sources, log_options=None):
+    """
+    Tạo DetectionLog cho 1 lần chạy và gắn vào detector
+    
+    Args:
+        log_path (str): Thư mục log
+        detector (PPEDetector): Detector sẽ ghi log sau mỗi lần associate()
+        captures (list): Capture của từng nguồn, cùng thứ tự với sources (lấy fps để
+            tính thời điểm frame; kích thước frame lấy từ nguồn đầu tiên)
+        sources (list): Các nguồn video (ghi vào meta.json)
+        log_options (dict): Tham số thêm cho DetectionLog
+        
+    Returns:
+        DetectionLog
+    """
+    cap = captures[0]
+    meta = {
+        'sources': [source if isinstance(source, (int, str)) else str(getattr(source, 'name', source))
+                    for source in sources],
+        'frame_size': [int(cap.get(cv2.CAP_PROP_FRAME_WIDTH)), int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT))],
+        'model': str(detector.model_path),
+        'backend': detector.backend,
+        'required_items': list(detector.required_items),
+        'conf_threshold': detector.conf_threshold,
+    }
+    fps = [capture.get(cv2.CAP_PROP_FPS) or None for capture in captures]
+    detector.event_log = DetectionLog(log_path, PPEDetector.LABELS, meta, **{'fps': fps, **(log_options or {})})
+    return detector.event_log
+
+
+def run_multi_detection(model_path, required_items, conf_threshold, sources, stop_flag=None,
+                        batch_size=None, max_batch_latency=0.05, policy=ROUND_ROBIN, device=None,
+                        profiler=None, detector_options=None, log_path=None, log_options=None):
+    """
+    Generator chạy detection cho nhiều nguồn video với 1 model dùng chung
+    
+    Frame từ tất cả các nguồn được gom vào chung các lô inference, chia lượt
+    theo round-robin hoặc theo deadline (frame chờ lâu nhất trước).
+    
+    Args:
+        model_path (str): Đường dẫn đến model
+        required_items (list): Danh sách PPE cần detect
+        conf_threshold (float): Ngưỡng confidence
+        sources (list): Các nguồn video (camera ID, đường dẫn file, stream URL)
+        stop_flag (function): Hàm callback để kiểm tra có dừng không
+        batch_size (int): Số frame tối đa mỗi lô (None = số nguồn)
+        max_batch_latency (float): Thời gian tối đa (giây) chờ gom đủ lô
+        policy (str): 'round_robin' hoặc 'deadline'
+        device (str): Thiết bị chạy model (None = tự chọn)
+        profiler (StageProfiler): Bộ đo thời gian từng stage (None = tạo mới)
+        detector_options (dict): Tham số thêm cho PPEDetector; trạng thái theo
+            thời gian (stride, ...) được giữ riêng cho từng nguồn
+        log_path (str): Thư mục ghi log detection dạng cột của mọi nguồn (cột 'stream'
+            là vị trí nguồn trong sources), None = không ghi
+        log_options (dict): Tham số thêm cho DetectionLog
+        
+    Yields:
+        tuple: (source_id, frame RGB, fps) - source_id là vị trí nguồn trong sources
+    """
+    detector = PPEDetector(model_path, required_items, conf_threshold, device=device, profiler=profiler,
+                           **{'color_order': RGB, **(detector_options or {})})
+    detector.load_model()
+    
+    captures = []
+    scheduler = None
+    event_log = None
+    
+    try:
+        for source in sources:
+            captures.append(open_capture(source))
+        if log_path:
+            event_log = open_event_log(log_path, detector, captures, sources, log_options)
+        
+        live = [is_live_source(source) for source in sources]
+        
+        def make_reader(cap):
+            return lambda: _read_frame(cap, detector.profiler)
+        
+        scheduler = MultiSourceScheduler(
+            [make_reader(cap) for cap in captures],
+            live,
+            batch_size=batch_size,
+            max_latency=max_batch_latency,
+            policy=policy
+        )
+        meters = [RateMeter() for _ in sources]
+        
+        # Nguồn trực tiếp có thể bị bỏ frame nên log dùng thời điểm đọc của scheduler
+        # (tính từ frame đầu của nguồn); file không bao giờ bị bỏ frame nên dùng frame / fps
+        first_read = {}
+        
+        for batch in scheduler:
+            if stop_flag and stop_flag():
+                break
+            
+            frames = [frame for _, frame, _ in batch]
+            streams = [source_id for source_id, _, _ in batch]
+            timestamps = [read_at - first_read.setdefault(source_id, read_at) if live[source_id] else None
+                          for source_id, _, read_at in batch]
+            for (source_id, frame, _), detection in zip(batch, detector.predict(frames, streams, timestamps)):
+                processed_frame = detector.annotate(frame, *detector.associate(detection))
+                frame_rgb, _ = _finish_frame(processed_frame, 0, None, detector.profiler,
+                                             detector.renderer.color_order)
+                detector.profiler.maybe_dump()
+                yield source_id, frame_rgb, meters[source_id].tick()
+        
+        if scheduler.errors:
+            source_id, exc = next(iter(scheduler.errors.items()))
+            raise ValueError(f"Lỗi khi đọc nguồn {sources[source_id]}: {exc}")
+    
+    finally:
+        if scheduler is not None:
+            scheduler.stop()
+        for cap in captures:
+            cap.release()
+        if event_log is not None:
+            detector.event_log = None
+            event_log.close()
 
 
 def get_all_ppe_labels():
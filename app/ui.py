@@ -6,6 +6,7 @@
 import streamlit as st
 import cv2
 from pathlib import Path
+from contextlib import closing
 from datetime import datetime
 import sys
 
@@ -14,8 +15,16 @@ from backend import (
     PPEDetector,
     get_available_models,
     run_detection,
-    get_all_ppe_labels
+    get_all_ppe_labels,
+    StageProfiler,
+    BACKENDS
 )
+# backend đã thêm thư mục gốc vào sys.path
+from utils.display import encode_preview, RateLimiter
+from src.quantize import INT8_SUFFIX
+
+# Số lần cập nhật FPS / thống kê mỗi giây (độc lập với tốc độ hiển thị frame)
+STATS_RATE = 2
 
 # ============ Cấu hình trang ============
 st.set_page_config(
@@ -67,11 +76,19 @@ with st.sidebar:
     selected_model = st.selectbox(
         "Model",
         available_models,
-        help="Chọn model YOLO đã train để sử dụng"
+        format_func=lambda name: f"{name} (INT8)" if name.endswith(INT8_SUFFIX) else name,
+        help="Chọn model YOLO đã train để sử dụng. Bản INT8 (tạo bằng python -m src.quantize) nhanh hơn trên CPU"
     )
     
     model_path = Path(__file__).parent.parent / "weights" / "ppe" / selected_model
     
+    backend = st.selectbox(
+        "Backend",
+        [None] + list(BACKENDS),
+        format_func=lambda name: "Tự động (theo đuôi file)" if name is None else name,
+        help="File .onnx / .torchscript / .ppe tạo bằng: python -m src.export hoặc python -m src.weights"
+    )
+    
     st.divider()
     
     # === Label Selection ===
@@ -104,6 +121,96 @@ with st.sidebar:
     
     st.divider()
     
+    # === Performance Settings ===
+    st.markdown("### ⚡ Hiệu năng")
+    batch_size = st.number_input(
+        "Batch size",
+        min_value=1,
+        max_value=32,
+        value=1,
+        help="Số frame gom lại cho 1 lần inference (tăng throughput khi xử lý video có sẵn)"
+    )
+    max_batch_latency_ms = st.number_input(
+        "Độ trễ gom lô tối đa (ms)",
+        min_value=0,
+        max_value=2000,
+        value=100,
+        step=10,
+        help="Thời gian chờ tối đa để gom đủ lô, giữ cho camera trực tiếp không bị trễ"
+    )
+    stride = st.number_input(
+        "Chạy model mỗi N frame",
+        min_value=1,
+        max_value=30,
+        value=1,
+        help="Các frame ở giữa dùng box nội suy từ keyframe (1 = chạy mọi frame)"
+    )
+    scene_change = st.slider(
+        "Ngưỡng thay đổi cảnh",
+        min_value=0,
+        max_value=50,
+        value=0,
+        help="Chạy model ngay khi cảnh thay đổi vượt ngưỡng (0 = tắt)"
+    )
+    motion_threshold = st.slider(
+        "Ngưỡng chuyển động",
+        min_value=0.0,
+        max_value=5.0,
+        value=0.0,
+        step=0.1,
+        help="Bỏ qua inference khi cảnh gần như đứng yên và dùng lại kết quả trước (0 = tắt)"
+    )
+    track_workers = st.checkbox(
+        "Theo dõi worker",
+        value=False,
+        help="Gán ID cố định cho từng worker, làm mượt trạng thái Safe/Unsafe và đếm số người vi phạm"
+    )
+    required_only = st.checkbox(
+        "Chỉ phát hiện PPE bắt buộc",
+        value=False,
+        help="Chỉ giữ worker và các PPE đã chọn (kèm nhãn no_*), bỏ các lớp khác ngay sau model"
+    )
+    pipelined = st.checkbox(
+        "Chạy pipeline song song",
+        value=False,
+        help="Đọc video, inference, vẽ và ghi video trên các thread riêng"
+    )
+    display_fps = st.slider(
+        "Tốc độ hiển thị (FPS)",
+        min_value=1,
+        max_value=30,
+        value=10,
+        help="Số frame tối đa gửi lên trình duyệt mỗi giây; detection vẫn chạy hết tốc độ"
+    )
+    display_width = st.selectbox(
+        "Chiều rộng hiển thị tối đa",
+        options=[640, 960, 1280, 1920, 0],
+        index=1,
+        format_func=lambda w: "Gốc" if w == 0 else f"{w}px",
+        help="Frame được thu nhỏ và nén JPEG trước khi gửi, giúp xem mượt qua mạng yếu"
+    )
+    jpeg_quality = st.slider(
+        "Chất lượng JPEG",
+        min_value=40,
+        max_value=95,
+        value=80,
+        step=5
+    )
+    show_profile = st.checkbox(
+        "Hiển thị thời gian từng stage",
+        value=False,
+        help="Thống kê p50/p95/p99 (ms) cho decode, inference, gán PPE, vẽ, encode và hiển thị"
+    )
+    profile_jsonl = st.text_input(
+        "Ghi thống kê ra file JSON lines",
+        placeholder="VD: results/profile.jsonl",
+        help="Để trống nếu không cần ghi"
+    )
+    # Vùng hiển thị bảng thời gian, được cập nhật trong lúc chạy
+    profile_placeholder = st.empty()
+    
+    st.divider()
+    
     # === Export Settings ===
     st.markdown("### 💾 Xuất kết quả")
     export_video = st.checkbox(
@@ -112,11 +219,45 @@ with st.sidebar:
         help="Xuất video đã detect ra file"
     )
     
+    export_log = st.checkbox(
+        "Lưu log detection",
+        value=False,
+        help="Ghi detection, PPE của từng worker và trạng thái Safe/Unsafe theo frame (file .npz "
+             "dạng cột, nhỏ hơn nhiều so với video); có thể chỉ lưu log mà không lưu video"
+    )
+    log_path = None
+    if export_log:
+        log_path = str(Path(__file__).parent.parent / "results" /
+                       f"ppe_log_{datetime.now().strftime('%Y%m%d_%H%M%S')}")
+        st.info(f"📁 Log sẽ lưu tại: `{log_path}`")
+    
     export_path = None
+    export_options = None
+    clip_dir = None
+    clip_options = None
     if export_video:
-        use_custom_path = st.checkbox("Tùy chỉnh đường dẫn", value=False)
+        export_clips = st.checkbox(
+            "Chỉ lưu clip khi có vi phạm",
+            value=False,
+            help="Giữ vài giây gần nhất trong bộ nhớ, chỉ ghi clip từ trước đến sau lúc có worker "
+                 "Unsafe (các vi phạm gần nhau được gộp chung 1 clip, mỗi clip kèm file .json)"
+        )
+        use_custom_path = not export_clips and st.checkbox("Tùy chỉnh đường dẫn", value=False)
         
-        if use_custom_path:
+        if export_clips:
+            clip_dir = str(Path(__file__).parent.parent / "results" /
+                           f"ppe_clips_{datetime.now().strftime('%Y%m%d_%H%M%S')}")
+            st.info(f"📁 Clip sẽ lưu tại: `{clip_dir}`")
+            pre_seconds, post_seconds = st.slider(
+                "Số giây trước / sau vi phạm",
+                min_value=0,
+                max_value=30,
+                value=(5, 5),
+                help="Khoảng thời gian được lưu trước và sau mỗi vi phạm. Đoạn trước vi phạm được giữ "
+                     "trong RAM dạng JPEG (khoảng 0.1-0.3 MB mỗi frame 1080p, tối đa 256 MB)"
+            )
+            clip_options = {'pre_seconds': pre_seconds, 'post_seconds': post_seconds}
+        elif use_custom_path:
             custom_path = st.text_input(
                 "Đường dẫn lưu file",
                 placeholder="VD: D:\\Videos\\output.mp4",
@@ -130,6 +271,24 @@ with st.sidebar:
             results_dir = Path(__file__).parent.parent / "results"
             export_path = str(results_dir / f"ppe_detection_{timestamp}.mp4")
             st.info(f"📁 Sẽ lưu tại: `{export_path}`")
+        
+        export_encoder = st.selectbox(
+            "Bộ encode",
+            ["opencv", "ffmpeg"],
+            help="ffmpeg (cần cài sẵn) cho file nhỏ hơn với codec H.264"
+        )
+        export_options = {'encoder': export_encoder}
+        if export_encoder == "ffmpeg":
+            export_options['crf'] = st.slider(
+                "CRF",
+                min_value=0,
+                max_value=51,
+                value=23,
+                help="Chất lượng video (càng nhỏ càng đẹp, file càng lớn)"
+            )
+        if clip_options is not None:
+            clip_options['writer_options'] = export_options
+            export_path = export_options = None
     
     st.divider()
     
@@ -227,37 +386,100 @@ with col2:
         if export_video and export_path:
             st.info(f"💾 Đang ghi video vào: `{export_path}`")
         
+        profiler = StageProfiler(jsonl_path=profile_jsonl or None)
+        frame_limiter = RateLimiter(display_fps)
+        stats_limiter = RateLimiter(STATS_RATE)
+        profile_limiter = RateLimiter(1)
+        
+        # Tạo detector ở đây để đọc được thống kê theo người trong lúc chạy
+        detector = PPEDetector(
+            str(model_path),
+            selected_labels,
+            confidence,
+            profiler=profiler,
+            stride=int(stride),
+            scene_change_threshold=scene_change or None,
+            track_workers=track_workers,
+            motion_threshold=motion_threshold or None,
+            color_order='bgr',
+            backend=backend,
+            required_only=required_only
+        )
+        
+        def show_frame(frame):
+            with profiler.stage('display'):
+                video_placeholder.image(
+                    encode_preview(frame, display_width or None, jpeg_quality),
+                    width="stretch"
+                )
+        
         try:
             # Chạy detection
             frame_count = 0
-            for frame, fps in run_detection(
+            pending_frame = None
+            detection_stream = run_detection(
                 model_path=str(model_path),
                 required_items=selected_labels,
                 conf_threshold=confidence,
                 source=video_source,
                 stop_flag=lambda: st.session_state.stop_detection,
-                export_path=export_path if export_video else None
-            ):
-                # Hiển thị frame
-                video_placeholder.image(
-                    frame,
-                    channels="RGB",
-                    width="stretch",
-                    # caption=f"PPE Detection - Frame {frame_count}"
-                )
-                
-                # Hiển thị FPS
-                fps_placeholder.markdown(
-                    f"<p style='text-align: center; color: #4da6ff; font-size: 1.2rem;'>"
-                    f"⚡ FPS: <strong>{fps:.1f}</strong></p>",
-                    unsafe_allow_html=True
-                )
-                
-                frame_count += 1
-                
-                # Kiểm tra stop flag
-                if st.session_state.stop_detection:
-                    break
+                export_path=export_path if export_video else None,
+                batch_size=int(batch_size),
+                max_batch_latency=max_batch_latency_ms / 1000,
+                pipelined=pipelined,
+                export_options=export_options,
+                profiler=profiler,
+                detector=detector,
+                output_color_order='bgr',
+                log_path=log_path,
+                clip_dir=clip_dir,
+                clip_options=clip_options
+            )
+            # Đóng generator rõ ràng (kể cả khi dừng sớm) để lỗi ghi video được báo ngay
+            with closing(detection_stream):
+                for frame, fps in detection_stream:
+                    frame_count += 1
+                    
+                    # Chỉ gửi frame lên trình duyệt theo tốc độ hiển thị đã chọn
+                    if frame_limiter.ready():
+                        show_frame(frame)
+                        pending_frame = None
+                    else:
+                        pending_frame = frame
+                    
+                    # Cập nhật bảng thời gian từng stage (tối đa 1 lần/giây)
+                    if show_profile and profile_limiter.ready():
+                        profile_placeholder.dataframe(
+                            [
+                                {'stage': stage, **{k: round(v, 2) for k, v in stats.items()}}
+                                for stage, stats in profiler.summary().items()
+                            ],
+                            hide_index=True,
+                            width="stretch"
+                        )
+                    
+                    # Hiển thị FPS (kèm thống kê theo người / số frame bỏ qua nếu bật)
+                    if stats_limiter.ready():
+                        stats_parts = [f"⚡ FPS: <strong>{fps:.1f}</strong>"]
+                        track_stats = detector.track_summary()
+                        if track_stats:
+                            stats_parts.append(f"👷 Đang theo dõi: <strong>{track_stats['active_tracks']}</strong>")
+                            stats_parts.append(f"⚠️ Số người vi phạm: <strong>{track_stats['violators']}</strong>")
+                        if motion_threshold:
+                            stats_parts.append(f"💤 Bỏ qua: <strong>{detector.stats['motion_skipped']}</strong> frame")
+                        fps_placeholder.markdown(
+                            f"<p style='text-align: center; color: #4da6ff; font-size: 1.2rem;'>"
+                            f"{' &nbsp;|&nbsp; '.join(stats_parts)}</p>",
+                            unsafe_allow_html=True
+                        )
+                    
+                    # Kiểm tra stop flag
+                    if st.session_state.stop_detection:
+                        break
+            
+            # Hiển thị frame cuối cùng nếu bị bỏ qua do giới hạn tốc độ
+            if pending_frame is not None:
+                show_frame(pending_frame)
             
             # Kết thúc detection
             st.session_state.detecting = False
@@ -280,6 +502,15 @@ with col2:
                 else:
                     st.warning("⚠️ Không thể lưu video")
             
+            if clip_dir:
+                clips = sorted(Path(clip_dir).glob("*.mp4")) if Path(clip_dir).exists() else []
+                clip_size = sum(p.stat().st_size for p in clips) / (1024 * 1024)
+                st.success(f"🎬 Đã lưu {len(clips)} clip vi phạm vào: `{clip_dir}` ({clip_size:.2f} MB)")
+            
+            if log_path and Path(log_path).exists():
+                log_size = sum(p.stat().st_size for p in Path(log_path).iterdir()) / (1024 * 1024)
+                st.success(f"🗂️ Log detection đã được lưu: `{log_path}` ({log_size:.2f} MB)")
+            
             if st.button("🔄 Phát hiện lại"):
                 st.session_state.detecting = True
                 st.session_state.stop_detection = False
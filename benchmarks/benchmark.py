@@ -0,0 +1,341 @@
+"""
+Benchmark offline cho pipeline PPE detection và các biến thể DetectionModel
+
+Chạy hoàn toàn trên CPU, không tải gì từ mạng:
+    python benchmarks/benchmark.py run --out results/bench.json
+    python benchmarks/benchmark.py compare results/base.json results/bench.json
+"""
+
+import argparse
+import importlib.util
+import json
+import platform
+import sys
+import tempfile
+import time
+from datetime import datetime
+from pathlib import Path
+
+import numpy as np
+
+# synthetic thêm thư mục gốc và app/ vào sys.path
+from synthetic import ScriptedDetector, make_random_model, make_scene, write_video
+from backend import run_detection  # noqa: E402
+from utils.profiler import StageProfiler  # noqa: E402
+
+# Chỉ số chính của từng loại kết quả (càng lớn càng tốt)
+PRIMARY_METRIC = {
+    'process_frame': 'fps',
+    'run_detection': 'fps',
+    'model': 'images_per_sec',
+    'postprocess': 'images_per_sec',
+}
+
+# Module cần có để export và chạy từng định dạng trong suite pipeline (onnx là dependency tùy chọn)
+EXPORT_REQUIRES = {
+    'onnx': ('onnx', 'onnxruntime'),
+    'torchscript': (),
+}
+
+
+def _stage_stats(profiler):
+    return {
+        name: {k: round(v, 3) for k, v in stats.items()}
+        for name, stats in profiler.summary().items()
+    }
+
+
+def bench_process_frame(model_path, scene, size, n_frames, warmup):
+    """Đo PPEDetector.process_frame trên frame tổng hợp với detection theo kịch bản"""
+    width, height = size
+    frame = np.full((height, width, 3), 96, dtype=np.uint8)
+    profiler = StageProfiler(window=n_frames)
+    detector = ScriptedDetector([scene], model_path, ['helmet', 'vest', 'gloves', 'boots'],
+                                conf_threshold=0.5, device='cpu', profiler=profiler)
+    detector.load_model()
+
+    for _ in range(warmup):
+        detector.process_frame(frame.copy())
+    profiler.reset()
+
+    start = time.perf_counter()
+    for _ in range(n_frames):
+        detector.process_frame(frame.copy())
+    elapsed = time.perf_counter() - start
+    return {'fps': n_frames / elapsed, 'stages': _stage_stats(profiler)}
+
+
+def bench_run_detection(model_path, video_path, scenes, options, backend=None):
+    """Đo run_detection end-to-end (đọc video → yield frame RGB)"""
+    profiler = StageProfiler(window=len(scenes))
+    detector = ScriptedDetector(scenes, model_path, ['helmet', 'vest', 'gloves', 'boots'],
+                                conf_threshold=0.5, device='cpu', profiler=profiler, color_order='rgb',
+                                backend=backend)
+
+    start = time.perf_counter()
+    n_frames = sum(1 for _ in run_detection(None, None, None, video_path, detector=detector, **options))
+    elapsed = time.perf_counter() - start
+    return {'fps': n_frames / elapsed, 'frames': n_frames, 'stages': _stage_stats(profiler)}
+
+
+def bench_model(variant, imgsz, batch_size, iters, warmup, mode='eager'):
+    """
+    Đo throughput forward của src/model.py DetectionModel với trọng số ngẫu nhiên
+
+    mode: 'eager' (Conv -> BN -> SiLU), 'fused' (BN gộp vào Conv), 'fused_cl'
+    (fused + channels_last) hoặc 'compiled' (fused_cl + torch.compile, thời gian
+    biên dịch nằm trong warmup và không được tính)
+    """
+    import torch
+    from src.model import DetectionModel
+
+    torch.manual_seed(0)
+    model = DetectionModel(type=variant).eval()
+    x = torch.randn(batch_size, 3, imgsz, imgsz)
+    if mode == 'compiled':
+        model.compile()
+    elif mode != 'eager':
+        model.fuse(channels_last=mode == 'fused_cl')
+    if model.channels_last:
+        x = x.contiguous(memory_format=torch.channels_last)
+
+    with torch.inference_mode():
+        for _ in range(max(warmup, 1 if mode == 'compiled' else 0)):
+            model(x)
+        times = []
+        for _ in range(iters):
+            start = time.perf_counter()
+            model(x)
+            times.append(time.perf_counter() - start)
+
+    times = np.array(times) * 1000
+    return {
+        'images_per_sec': batch_size * iters / (times.sum() / 1000),
+        'latency_ms': {'p50': float(np.percentile(times, 50)), 'p95': float(np.percentile(times, 95))},
+        'params': sum(p.numel() for p in model.parameters()),
+    }
+
+
+def bench_postprocess(imgsz, batch_size, conf, iters, warmup, classes=None):
+    """
+    Đo Predictor.postprocess (lọc confidence, NMS, đưa box về frame gốc) trên đầu ra
+    giả lập của DetectionModel 9 lớp: box ngẫu nhiên, ~1% anchor là vật thể (điểm lớp
+    ngẫu nhiên), còn lại là nền với điểm dưới 0.02 như model đã train
+    """
+    import torch
+    from src.model import N_CLASSES
+    from src.predictor import Predictor
+
+    n_anchors = sum((imgsz // stride) ** 2 for stride in (8, 16, 32))
+    xy = torch.rand(batch_size, 2, n_anchors) * imgsz
+    wh = torch.rand(batch_size, 2, n_anchors) * imgsz / 4 + 4
+    scores = torch.rand(batch_size, N_CLASSES, n_anchors) * 0.02
+    objects = torch.rand(batch_size, 1, n_anchors) < 0.01
+    scores = torch.where(objects, torch.rand_like(scores), scores)
+    preds = torch.cat([xy, wh, scores], dim=1)
+    metas = [(1.0, (0, 0), (imgsz, imgsz))] * batch_size
+
+    predictor = Predictor(None, None, imgsz, stride=32, device='cpu')
+    for _ in range(warmup):
+        predictor.postprocess(preds, metas, conf, classes)
+    times = []
+    for _ in range(iters):
+        start = time.perf_counter()
+        detections = predictor.postprocess(preds, metas, conf, classes)
+        times.append(time.perf_counter() - start)
+
+    times = np.array(times) * 1000
+    return {
+        'images_per_sec': batch_size * iters / (times.sum() / 1000),
+        'latency_ms': {'p50': float(np.percentile(times, 50)), 'p95': float(np.percentile(times, 95))},
+        'detections': sum(len(d['boxes']) for d in detections),
+    }
+
+
+def _record(results, kind, name, fn, *args):
+    print(f"  {kind}/{name} ...", end=' ', flush=True)
+    try:
+        entry = {'kind': kind, 'name': f"{kind}/{name}", 'status': 'ok', **fn(*args)}
+        print(f"{entry[PRIMARY_METRIC[kind]]:.2f} {PRIMARY_METRIC[kind]}")
+    except Exception as e:
+        entry = {'kind': kind, 'name': f"{kind}/{name}", 'status': 'error', 'error': f"{type(e).__name__}: {e}"}
+        print(f"lỗi: {entry['error']}")
+    results.append(entry)
+
+
+def _export(model_path, fmt):
+    """Export model cho suite pipeline; thiếu dependency hoặc export lỗi thì bỏ qua định dạng đó"""
+    missing = [module for module in EXPORT_REQUIRES[fmt] if importlib.util.find_spec(module) is None]
+    if missing:
+        print(f"  export/{fmt}: bỏ qua (chưa cài {', '.join(missing)})")
+        return None
+    try:
+        from src.export import export
+        return export(model_path, [fmt], check=False)[0]
+    except Exception as e:
+        print(f"  export/{fmt}: lỗi, bỏ qua ({type(e).__name__}: {e})")
+        return None
+
+
+def run(args):
+    import torch
+
+    torch.manual_seed(args.seed)
+    if args.threads:
+        torch.set_num_threads(args.threads)
+
+    size = (args.width, args.height)
+    results = []
+
+    with tempfile.TemporaryDirectory() as tmp:
+        tmp = Path(tmp)
+        if 'pipeline' in args.suites:
+            print("== Pipeline ==")
+            model_path = make_random_model(tmp / f'random_8{args.pipeline_variant}.pt', args.pipeline_variant, args.seed)
+            exported = {}
+            for fmt in args.backends:
+                path = _export(model_path, fmt)
+                if path is not None:
+                    exported[fmt] = path
+            for n_workers, n_items in args.scenes:
+                tag = f"w{n_workers}_i{n_items}"
+                scenes = make_scene(n_workers, n_items, size, args.frames, seed=args.seed)
+                _record(results, 'process_frame', tag, bench_process_frame,
+                        model_path, scenes[0], size, args.frames, args.warmup)
+
+                video_path = write_video(tmp / f'{tag}.mp4', scenes, size)
+                batch = {'batch_size': args.batch_size, 'max_batch_latency': 1.0}
+                modes = [
+                    ('sequential', {}, model_path, 'ultralytics'),
+                    (f'batch{args.batch_size}', batch, model_path, 'ultralytics'),
+                    ('pipelined', {'pipelined': True, **batch}, model_path, 'ultralytics'),
+                    (f'custom/batch{args.batch_size}', batch, model_path, 'custom'),
+                ]
+                # Cùng trọng số, chạy qua file đã export (backend chọn theo đuôi file)
+                modes += [(f'{fmt}/batch{args.batch_size}', batch, path, None) for fmt, path in exported.items()]
+                for mode, options, path, backend in modes:
+                    _record(results, 'run_detection', f"{tag}/{mode}", bench_run_detection,
+                            path, video_path, scenes, options, backend)
+
+        if 'model' in args.suites:
+            print("== DetectionModel ==")
+            for variant in args.variants:
+                for imgsz in args.imgsz:
+                    for batch_size in args.batch_sizes:
+                        for mode in args.model_modes:
+                            # Giữ tên cũ cho bản eager để so sánh được với kết quả trước đây
+                            name = f"{variant}/{imgsz}/b{batch_size}" + ('' if mode == 'eager' else f"/{mode}")
+                            _record(results, 'model', name, bench_model,
+                                    variant, imgsz, batch_size, args.iters, args.warmup, mode)
+
+        if 'postprocess' in args.suites:
+            print("== Postprocess ==")
+            for imgsz in args.imgsz:
+                for batch_size in args.batch_sizes:
+                    for conf in args.post_confs:
+                        name = f"{imgsz}/b{batch_size}/conf{conf}"
+                        _record(results, 'postprocess', name, bench_postprocess,
+                                imgsz, batch_size, conf, args.iters, args.warmup)
+                        # Chỉ worker + helmet + vest + no_helmet + no_vest
+                        _record(results, 'postprocess', f"{name}/required", bench_postprocess,
+                                imgsz, batch_size, conf, args.iters, args.warmup, [0, 1, 2, 5, 6])
+
+    report = {
+        'meta': {
+            'time': datetime.now().isoformat(timespec='seconds'),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'processor': platform.processor(),
+            'torch': torch.__version__,
+            'torch_threads': torch.get_num_threads(),
+            'args': {k: v for k, v in vars(args).items() if k != 'func'},
+        },
+        'results': results,
+    }
+    Path(args.out).parent.mkdir(parents=True, exist_ok=True)
+    with open(args.out, 'w', encoding='utf-8') as f:
+        json.dump(report, f, indent=2)
+    print(f"✅ Đã ghi kết quả: {args.out}")
+
+
+def compare(args):
+    """So sánh 2 lần chạy; trả về mã lỗi 1 nếu có case chậm đi quá ngưỡng"""
+    with open(args.base, encoding='utf-8') as f:
+        base = {r['name']: r for r in json.load(f)['results']}
+    with open(args.new, encoding='utf-8') as f:
+        new = {r['name']: r for r in json.load(f)['results']}
+
+    regressions = []
+    print(f"{'case':<45} {'base':>10} {'new':>10} {'change':>8}")
+    for name in sorted(base.keys() & new.keys()):
+        b, n = base[name], new[name]
+        if b['status'] != 'ok' or n['status'] != 'ok':
+            print(f"{name:<45} {b['status']:>10} {n['status']:>10}")
+            if b['status'] == 'ok':
+                regressions.append(name)
+            continue
+        metric = PRIMARY_METRIC[b['kind']]
+        change = n[metric] / b[metric] - 1
+        flag = ''
+        if change < -args.threshold:
+            regressions.append(name)
+            flag = '  ❌'
+        print(f"{name:<45} {b[metric]:>10.2f} {n[metric]:>10.2f} {change:>+8.1%}{flag}")
+
+    for name in sorted(base.keys() - new.keys()):
+        print(f"{name:<45} (thiếu trong lần chạy mới)")
+
+    if regressions:
+        print(f"\n❌ {len(regressions)} case chậm hơn quá {args.threshold:.0%}")
+        return 1
+    print("\n✅ Không có regression")
+    return 0
+
+
+def _scene(value):
+    n_workers, n_items = value.split('x')
+    return int(n_workers), int(n_items)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark PPE detection (CPU, không cần tải dữ liệu)")
+    sub = parser.add_subparsers(dest='command', required=True)
+
+    p_run = sub.add_parser('run', help="Chạy benchmark và ghi file JSON")
+    p_run.add_argument('--out', default='results/benchmark.json')
+    p_run.add_argument('--suites', nargs='+', default=['pipeline', 'model', 'postprocess'],
+                       choices=['pipeline', 'model', 'postprocess'])
+    p_run.add_argument('--scenes', nargs='+', type=_scene, default=[(5, 15), (40, 150)],
+                       help="Cảnh dạng WORKERSxITEMS, ví dụ 40x150")
+    p_run.add_argument('--width', type=int, default=1280)
+    p_run.add_argument('--height', type=int, default=720)
+    p_run.add_argument('--frames', type=int, default=60)
+    p_run.add_argument('--batch-size', type=int, default=4)
+    p_run.add_argument('--pipeline-variant', default='n', choices=list('nsmlx'))
+    p_run.add_argument('--variants', nargs='+', default=list('nsmlx'), choices=list('nsmlx'))
+    p_run.add_argument('--imgsz', nargs='+', type=int, default=[320, 640])
+    p_run.add_argument('--batch-sizes', nargs='+', type=int, default=[1, 4])
+    p_run.add_argument('--backends', nargs='*', default=['onnx'], choices=['onnx', 'torchscript'],
+                       help="Định dạng export chạy thêm trong suite pipeline")
+    p_run.add_argument('--model-modes', nargs='+', default=['eager', 'fused'],
+                       choices=['eager', 'fused', 'fused_cl', 'compiled'])
+    p_run.add_argument('--post-confs', nargs='+', type=float, default=[0.25, 0.001],
+                       help="Ngưỡng confidence cho suite postprocess")
+    p_run.add_argument('--iters', type=int, default=10)
+    p_run.add_argument('--warmup', type=int, default=2)
+    p_run.add_argument('--threads', type=int, default=0, help="Số thread torch (0 = mặc định)")
+    p_run.add_argument('--seed', type=int, default=0)
+    p_run.set_defaults(func=run)
+
+    p_cmp = sub.add_parser('compare', help="So sánh 2 file kết quả")
+    p_cmp.add_argument('base')
+    p_cmp.add_argument('new')
+    p_cmp.add_argument('--threshold', type=float, default=0.1, help="Mức chậm đi tối đa cho phép (0.1 = 10%%)")
+    p_cmp.set_defaults(func=compare)
+
+    args = parser.parse_args()
+    sys.exit(args.func(args) or 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,123 @@
+"""
+Dữ liệu giả lập cho benchmark: video tổng hợp với số worker / item tùy chọn
+và model YOLOv8 trọng số ngẫu nhiên (không cần tải gì từ mạng)
+"""
+
+import sys
+from pathlib import Path
+
+import cv2
+import numpy as np
+
+ROOT = Path(__file__).parent.parent
+sys.path.append(str(ROOT))
+sys.path.append(str(ROOT / 'app'))
+
+from backend import PPEDetector  # noqa: E402
+
+NAMES = PPEDetector.LABELS
+WORKER_ID = 0
+ITEM_IDS = [i for i in NAMES if i != WORKER_ID]
+
+
+def make_scene(n_workers, n_items, size, n_frames, seed=0):
+    """
+    Sinh box worker / item cho từng frame, worker di chuyển chậm theo thời gian
+
+    Args:
+        n_workers (int): Số worker mỗi frame
+        n_items (int): Số PPE item mỗi frame (phân bố vào trong các worker)
+        size (tuple): (width, height) của frame
+        n_frames (int): Số frame
+        seed (int): Seed ngẫu nhiên
+
+    Returns:
+        list: Mỗi phần tử là dict {'boxes', 'class_ids', 'confidences', 'names'}
+              cùng định dạng với PPEDetector.predict()
+    """
+    rng = np.random.default_rng(seed)
+    width, height = size
+    w_size = rng.uniform(0.06, 0.12, (n_workers, 1)) * np.array([width, height * 2.5])
+    w_pos = rng.uniform(0, 1, (n_workers, 2)) * (np.array([width, height]) - w_size)
+    w_vel = rng.uniform(-2, 2, (n_workers, 2))
+
+    owner = rng.integers(0, max(n_workers, 1), n_items)
+    i_rel = rng.uniform(0.1, 0.7, (n_items, 2))
+    i_size = rng.uniform(0.2, 0.3, (n_items, 2))
+    item_cls = rng.choice(ITEM_IDS, n_items)
+
+    scenes = []
+    for t in range(n_frames):
+        pos = np.clip(w_pos + w_vel * t, 0, np.array([width, height]) - w_size)
+        workers = np.concatenate([pos, pos + w_size], axis=1)
+        if n_workers:
+            i_xy = pos[owner] + i_rel * w_size[owner]
+            items = np.concatenate([i_xy, i_xy + i_size * w_size[owner]], axis=1)
+        else:
+            items = np.zeros((0, 4))
+        boxes = np.concatenate([workers, items]).astype(np.float32)
+        class_ids = np.concatenate([np.full(n_workers, WORKER_ID), item_cls]).astype(int)
+        scenes.append({
+            'boxes': boxes,
+            'class_ids': class_ids,
+            'confidences': np.full(len(boxes), 0.9, dtype=np.float32),
+            'names': NAMES,
+        })
+    return scenes
+
+
+def write_video(path, scenes, size, fps=25):
+    """Vẽ scene thành video mp4 (nền xám, worker / item là các khối màu)"""
+    width, height = size
+    writer = cv2.VideoWriter(str(path), cv2.VideoWriter_fourcc(*'mp4v'), fps, (width, height))
+    for scene in scenes:
+        frame = np.full((height, width, 3), 96, dtype=np.uint8)
+        for box, cls_id in zip(scene['boxes'], scene['class_ids']):
+            x1, y1, x2, y2 = map(int, box)
+            color = (40, 160, 40) if cls_id == WORKER_ID else (0, 200, 255)
+            cv2.rectangle(frame, (x1, y1), (x2, y2), color, -1 if cls_id == WORKER_ID else 2)
+        writer.write(frame)
+    writer.release()
+    return str(path)
+
+
+def make_random_model(path, variant='n', seed=0):
+    """
+    Tạo checkpoint ultralytics YOLOv8 trọng số ngẫu nhiên với 9 lớp PPE
+
+    Dùng file yaml có sẵn trong ultralytics nên không cần tải trọng số.
+    """
+    import torch
+    from ultralytics.nn.tasks import DetectionModel
+
+    torch.manual_seed(seed)
+    model = DetectionModel(f'yolov8{variant}.yaml', nc=len(NAMES), verbose=False)
+    model.names = dict(NAMES)
+    model.args = {'imgsz': 640}
+    torch.save({'model': model.half(), 'train_args': {}, 'date': None, 'version': 'benchmark'}, path)
+    return str(path)
+
+
+class ScriptedDetector(PPEDetector):
+    """
+    PPEDetector chạy forward thật của model nhưng trả về detection theo kịch bản
+
+    Giữ nguyên chi phí inference, còn số worker / item ở các bước gán PPE và vẽ
+    thì đúng như scene đã sinh, để benchmark có thể điều khiển mật độ cảnh.
+    """
+
+    def __init__(self, scenes, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.scenes = scenes
+        self._cursor = 0
+        self._scene_of = {}
+
+    def predict(self, frames, streams=None, timestamps=None):
+        # Ghi nhớ scene của từng frame vì _infer chỉ nhận các keyframe
+        self._scene_of = {id(frame): self._cursor + k for k, frame in enumerate(frames)}
+        self._cursor += len(frames)
+        return super().predict(frames, streams, timestamps)
+
+    def _infer(self, frames):
+        super()._infer(frames)
+        return [self.scenes[self._scene_of[id(frame)] % len(self.scenes)] for frame in frames]
@@ -1,11 +1,32 @@
+"""
+CLI xử lý hàng loạt video / ảnh (không cần giao diện, chạy được trên server)
+
+Mỗi file được giao cho 1 tiến trình trong pool (mặc định bằng số core). Kết
+quả gồm file đã vẽ (Safe/Unsafe) và 1 file JSON tóm tắt cho từng file đầu vào,
+đặt trong thư mục output theo cùng cấu trúc thư mục với đầu vào. File JSON chỉ
+được ghi khi file đã xử lý xong, nên chạy lại cùng lệnh sẽ bỏ qua các file đã
+xong và làm tiếp phần còn lại.
+
+Ví dụ:
+    python main.py recordings/ --model weights/ppe/ppe_8s_best.pt --classes helmet vest
+    python main.py "footage/cam*/2024-05-01/*.mp4" --model weights/ppe/ppe_8s_best.ppe \
+        --classes 1 2 --conf 0.4 --output results/night --no-save
+    python main.py shifts/ --model weights/ppe/ppe_8s_best.ppe --classes helmet vest --no-save --clips
+"""
+
+import argparse
+import glob
+import json
 import os
-import cv2
-from ultralytics import YOLO
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from multiprocessing import get_context
+from pathlib import Path
 
-from utils.caculator import inside
-from utils.processor import get_color
+ROOT = Path(__file__).parent
 
-# === Cấu hình các lớp ===
+# Định nghĩa các lớp (giống PPEDetector.LABELS)
 LABELS = {
     0: 'worker',
     1: 'helmet',
@@ -18,97 +39,462 @@ LABELS = {
     8: 'no_boots'
 }
 
-print("Các lớp phát hiện: ")
-print("""
-1: helmet
-2: vest
-3: gloves
-4: boots
-5: no_helmet
-6: no_vest
-7: no_gloves
-8: no_boots
-"""
-)
-ids = map(int, input("Nhập các lớp cần phát hiện (ví dụ: 1 2 3 cho helmet, vest, gloves): ").split())
-REQUIRED_ITEMS = [LABELS[i] for i in ids if i in LABELS]
-print(f"✅ Đã chọn các lớp: {REQUIRED_ITEMS}")
-
-root = "weights\ppe"
-MODELS = os.listdir(root)
-print("Các model sẵn có: ")
-for i, m in enumerate(MODELS):
-    print(f"{i}: {m}")
-
-model_id = MODELS[int(input("Chọn model bạn muốn sử dụng (nhập số tương ứng): "))]
-model_path = os.path.join(root, model_id)
-print(f"✅ Đã chọn model: {model_path}")
-
-
-model = YOLO(model_path)  
-
-media = input("Nhập đường dẫn video hoặc để trống để dùng webcam: ")
-if media.strip() == "":
-    media = 0
-    
-cap = cv2.VideoCapture(media)
-
-while cap.isOpened():
-    ret, frame = cap.read()
-    if not ret:
-        break
-
-    # === Chạy YOLO detect trên frame ===
-    results = model(frame, verbose=False, conf=0.2)[0]
-    frame = results.plot()
-
-    boxes = results.boxes.xyxy.cpu().numpy()
-    class_ids = results.boxes.cls.cpu().numpy().astype(int)
-    names = results.names
-
-    workers = []
-    items = []
-
-    # Gom nhóm worker & items
-    for box, cls_id in zip(boxes, class_ids):
-        label = names[cls_id]
-        # if label.lower() != 'worker':
-        #     x1, y1, x2, y2 = map(int, box)
-        #     color = get_color(names[cls_id])
-        #     cv2.rectangle(frame, (x1, y1), (x2, y2), color, 2)
-        #     cv2.putText(frame, label, (x1, y1 - 8),
-        #                 cv2.FONT_HERSHEY_SIMPLEX, 0.6, color, 2)
-
-        if label.lower() == 'worker':
-            workers.append({'box': box, 'items': set()})
-        elif label in LABELS.values():
-            items.append({'box': box, 'label': label})
-
-    # Kiểm tra trang bị của từng worker
-    for worker in workers:
-        wbox = worker['box']
-        for item in items:
-            if item['label'] in REQUIRED_ITEMS and inside(item['box'], wbox):
-                worker['items'].add(item['label'])
-
-    # Vẽ lên frame
-    for worker in workers:
-        x1, y1, x2, y2 = map(int, worker['box'])
-        has_all = all(req in worker['items'] for req in REQUIRED_ITEMS) and \
-                  all(f"no_{req}" not in worker['items'] for req in REQUIRED_ITEMS)
-        color = (0, 255, 0) if has_all else (0, 0, 255)
-        label_text = f"Worker ({'Safe' if has_all else 'Unsafe'})"
-
-        cv2.rectangle(frame, (x1, y1), (x2, y2), color, 2)
-        cv2.putText(frame, label_text, (x1, y1 - 8),
-                    cv2.FONT_HERSHEY_SIMPLEX, 0.6, color, 2)
-
-    cv2.imshow("PPE Detection", frame)
-
-    # Bấm Q để thoát
-    if cv2.waitKey(1) & 0xFF == ord('q'):
-        break
-
-# === Giải phóng tài nguyên ===
-cap.release()
-cv2.destroyAllWindows()
+VIDEO_SUFFIXES = ('.mp4', '.avi', '.mov', '.mkv', '.m4v', '.mpg', '.mpeg', '.wmv', '.webm', '.ts')
+IMAGE_SUFFIXES = ('.jpg', '.jpeg', '.png', '.bmp', '.webp', '.tif', '.tiff')
+
+# Đuôi file tóm tắt, ghi cạnh file kết quả (giữ cả đuôi gốc để a.jpg / a.png không trùng)
+SUMMARY_SUFFIX = '.json'
+
+# Các tham số ảnh hưởng tới kết quả; đổi bất kỳ tham số nào thì file phải xử lý lại
+SETTINGS = ('model', 'classes', 'conf', 'backend', 'stride', 'track', 'required_only', 'save', 'log', 'clips')
+
+# Detector của tiến trình con, tạo 1 lần trong _init_worker
+_detector = None
+_config = None
+
+
+def parse_classes(values):
+    """
+    Đổi danh sách lớp (tên hoặc số như bản CLI cũ: 1 = helmet, ...) thành tên lớp
+
+    Raises:
+        ValueError: Nếu có lớp không hợp lệ
+    """
+    names = []
+    for value in values:
+        label = LABELS.get(int(value)) if value.isdigit() else value
+        if label not in LABELS.values() or label == 'worker':
+            raise ValueError(f"Lớp không hợp lệ: {value} (chọn trong {list(LABELS.values())[1:]} hoặc 1-8)")
+        names.append(label)
+    return names
+
+
+def _glob_base(pattern):
+    """Thư mục dài nhất của pattern không chứa ký tự glob"""
+    parts = Path(pattern).parts
+    base = []
+    for part in parts:
+        if glob.has_magic(part):
+            break
+        base.append(part)
+    return Path(*base) if base else Path('.')
+
+
+def collect_inputs(inputs, suffixes=VIDEO_SUFFIXES + IMAGE_SUFFIXES):
+    """
+    Tìm file video / ảnh từ danh sách file, thư mục (quét đệ quy) hoặc glob
+
+    Đường dẫn tương đối dùng cho output giữ lại tên thư mục đã truyền vào, để
+    nhiều camera có file cùng tên (cam01/night.mp4, cam02/night.mp4) không ghi đè nhau.
+
+    Returns:
+        list: Các cặp (đường dẫn file, đường dẫn tương đối cho output), không trùng lặp
+
+    Raises:
+        ValueError: Nếu 2 file khác nhau cho ra cùng file kết quả (xem output_path)
+    """
+    found = {}
+    for value in inputs:
+        path = Path(value)
+        if path.is_dir():
+            base = path.resolve().parent
+            files = (p for p in path.rglob('*') if p.is_file())
+        elif glob.has_magic(value):
+            base = _glob_base(value).resolve().parent
+            files = (Path(p) for p in glob.glob(value, recursive=True) if Path(p).is_file())
+        elif path.is_file():
+            base = path.resolve().parent
+            files = [path]
+        else:
+            raise ValueError(f"Không tìm thấy: {value}")
+
+        for file in files:
+            if file.suffix.lower() in suffixes:
+                file = file.resolve()
+                found.setdefault(file, file.relative_to(base))
+
+    targets = {}
+    for file, relative in found.items():
+        # So trên file kết quả thật (JSON / log / clip cùng tên gốc nên trùng theo)
+        target = output_path(Path('.'), relative)
+        if target in targets:
+            raise ValueError(f"{file} và {targets[target]} trùng đường dẫn output ({target})")
+        targets[target] = file
+    return sorted(found.items())
+
+
+def summary_path(output_dir, relative):
+    return Path(output_dir) / relative.with_name(relative.name + SUMMARY_SUFFIX)
+
+
+def log_path(output_dir, relative):
+    """Thư mục log detection dạng cột của 1 video (xem utils/eventlog.py)"""
+    return Path(output_dir) / relative.with_name(relative.name + '.log')
+
+
+def clip_path(output_dir, relative):
+    """Thư mục clip vi phạm của 1 video (xem utils/clips.py)"""
+    return Path(output_dir) / relative.with_name(relative.name + '.clips')
+
+
+def output_path(output_dir, relative):
+    """
+    File kết quả đã vẽ: video ghi thành .mp4, ảnh giữ nguyên định dạng
+
+    Video không phải .mp4 giữ cả đuôi gốc (a.avi -> a.avi.mp4) để a.mp4 và a.avi
+    cùng thư mục không ghi đè nhau.
+    """
+    target = Path(output_dir) / relative
+    suffix = relative.suffix.lower()
+    if suffix in VIDEO_SUFFIXES and suffix != '.mp4':
+        return target.with_name(target.name + '.mp4')
+    return target
+
+
+def source_stamp(path):
+    stat = Path(path).stat()
+    return {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns}
+
+
+def is_done(path, output_dir, relative, settings):
+    """
+    File đã xử lý xong ở lần chạy trước: có JSON tóm tắt, file nguồn không đổi
+    và cùng cấu hình (mọi tham số trong SETTINGS: model, lớp, ngưỡng, backend,
+    stride, lưu video / log / clip, ...)
+    """
+    try:
+        with open(summary_path(output_dir, relative), encoding='utf-8') as f:
+            summary = json.load(f)
+    except (OSError, ValueError):
+        return False
+    if summary.get('source_stamp') != source_stamp(path):
+        return False
+    return summary.get('settings') == settings
+
+
+def write_json(path, data):
+    """Ghi JSON qua file tạm rồi đổi tên, để file dở dang không bị coi là đã xong"""
+    path = Path(path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp = path.with_name(path.name + '.tmp')
+    with open(tmp, 'w', encoding='utf-8') as f:
+        json.dump(data, f, ensure_ascii=False, indent=2)
+    os.replace(tmp, path)
+
+
+class FileSummary:
+    """Cộng dồn kết quả gán PPE theo frame thành thống kê cho cả file"""
+
+    def __init__(self, required_items):
+        self.required_items = required_items
+        self.frames = 0
+        self.worker_detections = 0
+        self.max_workers = 0
+        self.unsafe_detections = 0
+        self.unsafe_frames = 0
+        self.first_unsafe_frame = None
+        self.missing = dict.fromkeys(required_items, 0)
+
+    def add(self, workers):
+        unsafe = [worker for worker in workers if not worker['safe']]
+        if unsafe and self.first_unsafe_frame is None:
+            self.first_unsafe_frame = self.frames
+        self.frames += 1
+        self.worker_detections += len(workers)
+        self.max_workers = max(self.max_workers, len(workers))
+        self.unsafe_detections += len(unsafe)
+        self.unsafe_frames += bool(unsafe)
+        for worker in unsafe:
+            for item in self.required_items:
+                if item not in worker['items']:
+                    self.missing[item] += 1
+
+    def to_dict(self):
+        return {
+            'frames': self.frames,
+            'worker_detections': self.worker_detections,
+            'max_workers': self.max_workers,
+            'unsafe_detections': self.unsafe_detections,
+            'unsafe_frames': self.unsafe_frames,
+            'first_unsafe_frame': self.first_unsafe_frame,
+            'missing': self.missing,
+        }
+
+
+def _init_worker(config):
+    """Chạy 1 lần trong mỗi tiến trình con: giới hạn thread và load model"""
+    global _detector, _config
+    import cv2
+    import torch
+
+    # Mỗi tiến trình chỉ dùng vài thread, pool mới là nơi chia đều cho các core
+    torch.set_num_threads(config['threads'])
+    cv2.setNumThreads(config['threads'])
+
+    sys.path.insert(0, str(ROOT / 'app'))
+    from backend import PPEDetector
+
+    _config = config
+    _detector = PPEDetector(
+        config['model'], config['classes'], config['conf'],
+        device=config['device'], backend=config['backend'],
+        stride=config['stride'], track_workers=config['track'],
+        required_only=config['required_only'], render=config['save'] or config['clips'] is not None,
+    )
+    _detector.load_model()
+
+
+def _process_video(path, target, summary, log_dir=None, clip_dir=None):
+    from backend import open_capture, open_clip_recorder, open_event_log
+    from utils.writer import AsyncVideoWriter
+    import cv2
+
+    detector = _detector
+    cap = open_capture(str(path))
+    writer = None
+    event_log = None
+    clip_recorder = None
+    clips = None
+    try:
+        if log_dir is not None:
+            event_log = open_event_log(log_dir, detector, [cap], [str(path)])
+        if clip_dir is not None:
+            clip_recorder = open_clip_recorder(clip_dir, detector, cap, _config['clips'])
+        if target is not None:
+            target.parent.mkdir(parents=True, exist_ok=True)
+            size = int(cap.get(cv2.CAP_PROP_FRAME_WIDTH)), int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT))
+            writer = AsyncVideoWriter(target, cap.get(cv2.CAP_PROP_FPS) or 30, size)
+
+        def flush(batch):
+            for frame, detection in zip(batch, detector.predict(batch)):
+                workers, items = detector.associate(detection)
+                summary.add(workers)
+                if writer is not None or clip_recorder is not None:
+                    frame = detector.annotate(frame, workers, items)
+                if writer is not None:
+                    writer.write(frame)
+
+        batch = []
+        while True:
+            ret, frame = cap.read()
+            if not ret:
+                break
+            batch.append(frame)
+            if len(batch) == _config['batch_size']:
+                flush(batch)
+                batch = []
+        if batch:
+            flush(batch)
+        if summary.frames == 0:
+            raise ValueError("Không đọc được frame nào (file lỗi hoặc không hỗ trợ)")
+        video_fps = cap.get(cv2.CAP_PROP_FPS) or None
+    finally:
+        cap.release()
+        if event_log is not None:
+            detector.event_log = None
+            event_log.close()
+        if clip_recorder is not None:
+            detector.clip_recorder = None
+            clips = clip_recorder.close()
+        if writer is not None:
+            writer.release()
+            # Lỗi encode chỉ được báo khi không có lỗi khác đang xảy ra, để giữ nguyên nguyên nhân gốc
+            if writer.error is not None and sys.exc_info()[1] is None:
+                raise RuntimeError(f"Lỗi khi ghi video: {writer.error}") from writer.error
+    return {'video_fps': video_fps, 'clips': clips}
+
+
+def _process_image(path, target, summary, log_dir=None, clip_dir=None):
+    import cv2
+    import numpy as np
+
+    detector = _detector
+    frame = cv2.imread(str(path))
+    if frame is None:
+        raise ValueError("Không đọc được ảnh")
+    detection = detector.predict([frame])[0]
+    workers, items = detector.associate(detection)
+    summary.add(workers)
+    if target is not None:
+        target.parent.mkdir(parents=True, exist_ok=True)
+        if not cv2.imwrite(str(target), detector.annotate(frame, workers, items)):
+            raise ValueError(f"Không ghi được ảnh: {target}")
+    return {
+        'workers': [
+            {
+                'box': np.asarray(worker['box']).round(1).tolist(),
+                'confidence': round(float(worker['conf']), 4),
+                'safe': bool(worker['safe']),
+                'items': sorted(worker['items']),
+            }
+            for worker in workers
+        ],
+        'items': [
+            {'label': item['label'], 'box': np.asarray(item['box']).round(1).tolist(),
+             'confidence': round(float(item['conf']), 4)}
+            for item in items
+        ],
+    }
+
+
+def process_file(path, relative):
+    """
+    Xử lý 1 file trong tiến trình con và ghi JSON tóm tắt (bước cuối cùng)
+
+    Returns:
+        dict: Nội dung JSON đã ghi
+    """
+    detector = _detector
+    detector.reset_streams()
+    detector.stats = dict.fromkeys(detector.stats, 0)
+    output_dir = _config['output']
+    target = output_path(output_dir, relative) if _config['save'] else None
+    is_video = relative.suffix.lower() in VIDEO_SUFFIXES
+    # Ảnh đã có toàn bộ detection trong JSON, chỉ video mới cần log theo frame
+    log_dir = log_path(output_dir, relative) if _config['log'] and is_video else None
+    clip_dir = clip_path(output_dir, relative) if _config['clips'] is not None and is_video else None
+
+    summary = FileSummary(_config['classes'])
+    stamp = source_stamp(path)
+    start = time.perf_counter()
+    details = (_process_video if is_video else _process_image)(path, target, summary, log_dir, clip_dir)
+    elapsed = time.perf_counter() - start
+
+    result = {
+        'source': str(path),
+        'source_stamp': stamp,
+        'type': 'video' if is_video else 'image',
+        'output': str(target) if target is not None else None,
+        'log': str(log_dir) if log_dir is not None else None,
+        'clip_dir': str(clip_dir) if clip_dir is not None else None,
+        'model': _config['model'],
+        'backend': detector.backend,
+        'classes': _config['classes'],
+        'conf': _config['conf'],
+        **summary.to_dict(),
+        'processing_sec': round(elapsed, 3),
+        'processing_fps': round(summary.frames / elapsed, 2) if elapsed > 0 else None,
+        'keyframes': detector.stats['keyframes'],
+        **details,
+        'settings': {key: _config[key] for key in SETTINGS},
+    }
+    if _config['track']:
+        result['people'] = detector.track_summary()
+    write_json(summary_path(output_dir, relative), result)
+    return result
+
+
+def _run_job(path, relative):
+    # Lỗi của 1 file không được làm dừng cả pool
+    try:
+        return process_file(path, relative), None
+    except Exception as e:
+        return None, f"{type(e).__name__}: {e}"
+
+
+def main(argv=None):
+    cores = os.cpu_count() or 1
+    parser = argparse.ArgumentParser(
+        description="Phát hiện PPE hàng loạt trên video / ảnh, ghi file đã vẽ và JSON tóm tắt cho từng file"
+    )
+    parser.add_argument('inputs', nargs='+', help="File, thư mục (quét đệ quy) hoặc glob (đặt trong ngoặc kép)")
+    parser.add_argument('--model', required=True, help="File model (.pt, .ppe, .onnx, .torchscript)")
+    parser.add_argument('--classes', nargs='+', required=True,
+                        help="PPE bắt buộc: tên (helmet vest ...) hoặc số (1 = helmet ... 8 = no_boots)")
+    parser.add_argument('--conf', type=float, default=0.5, help="Ngưỡng confidence")
+    parser.add_argument('--output', default='outputs', help="Thư mục kết quả")
+    parser.add_argument('--workers', type=int, default=0, help="Số tiến trình (0 = số core / --threads)")
+    parser.add_argument('--threads', type=int, default=1, help="Số thread mỗi tiến trình")
+    parser.add_argument('--device', default='cpu', help="Thiết bị chạy model, ví dụ cpu, cuda:0")
+    parser.add_argument('--backend', default=None,
+                        choices=['ultralytics', 'custom', 'compiled', 'onnx', 'torchscript'],
+                        help="Backend chạy model (mặc định: theo đuôi file model)")
+    parser.add_argument('--batch-size', type=int, default=8, help="Số frame video mỗi lần inference")
+    parser.add_argument('--stride', type=int, default=1, help="Chỉ chạy model mỗi N frame video")
+    parser.add_argument('--track', action='store_true', help="Theo dõi worker và đếm số người vi phạm")
+    parser.add_argument('--required-only', action='store_true',
+                        help="Chỉ phát hiện worker và PPE đã chọn (kèm no_*)")
+    parser.add_argument('--no-save', action='store_true', help="Chỉ ghi JSON, không ghi file đã vẽ")
+    parser.add_argument('--log', action='store_true',
+                        help="Ghi log detection theo frame dạng cột cho mỗi video (<tên>.log/, xem utils/eventlog.py)")
+    parser.add_argument('--clips', action='store_true',
+                        help="Lưu clip quanh các vi phạm cho mỗi video (<tên>.clips/, xem utils/clips.py); "
+                             "dùng cùng --no-save để không ghi toàn bộ video")
+    parser.add_argument('--clip-seconds', type=float, nargs=2, default=(5.0, 5.0), metavar=('PRE', 'POST'),
+                        help="Số giây trước / sau vi phạm được đưa vào clip. Đoạn trước được giữ trong RAM "
+                             "dạng JPEG, tối đa 256 MB mỗi tiến trình (x --workers)")
+    parser.add_argument('--overwrite', action='store_true', help="Xử lý lại cả các file đã xong")
+    args = parser.parse_args(argv)
+
+    try:
+        classes = parse_classes(args.classes)
+        jobs = collect_inputs(args.inputs)
+    except ValueError as e:
+        parser.error(str(e))
+    if not Path(args.model).is_file():
+        parser.error(f"Không tìm thấy model: {args.model}")
+
+    output_dir = Path(args.output).resolve()
+    settings = {
+        'model': str(Path(args.model).resolve()),
+        'classes': classes,
+        'conf': args.conf,
+        'backend': args.backend,
+        'stride': args.stride,
+        'track': args.track,
+        'required_only': args.required_only,
+        'save': not args.no_save,
+        'log': args.log,
+        'clips': ({'pre_seconds': args.clip_seconds[0], 'post_seconds': args.clip_seconds[1]}
+                  if args.clips else None),
+    }
+    total = len(jobs)
+    if not args.overwrite:
+        jobs = [(path, relative) for path, relative in jobs if not is_done(path, output_dir, relative, settings)]
+    if not jobs:
+        print(f"✅ Không còn file nào cần xử lý ({total} file đã xong trong {output_dir})")
+        return 0
+
+    threads = max(args.threads, 1)
+    workers = min(args.workers or max(cores // threads, 1), len(jobs))
+    config = {
+        **settings,
+        'output': str(output_dir),
+        'threads': threads,
+        'device': args.device,
+        'batch_size': max(args.batch_size, 1),
+    }
+    print(f"▶️ {len(jobs)}/{total} file, {workers} tiến trình x {threads} thread, kết quả: {output_dir}")
+
+    # File lớn chạy trước để các tiến trình xong gần cùng lúc
+    jobs.sort(key=lambda job: job[0].stat().st_size, reverse=True)
+    failed = []
+    start = time.perf_counter()
+    # 'spawn' để tiến trình con không thừa hưởng thread / trạng thái của torch, OpenCV
+    with ProcessPoolExecutor(workers, get_context('spawn'), initializer=_init_worker, initargs=(config,)) as pool:
+        futures = {pool.submit(_run_job, path, relative): relative for path, relative in jobs}
+        try:
+            for done, future in enumerate(as_completed(futures), 1):
+                relative = futures[future]
+                result, error = future.result()
+                if error is not None:
+                    failed.append(relative)
+                    print(f"❌ [{done}/{len(jobs)}] {relative}: {error}", flush=True)
+                else:
+                    print(f"✅ [{done}/{len(jobs)}] {relative}: {result['frames']} frame, "
+                          f"{result['processing_fps']} fps, {result['unsafe_frames']} frame có vi phạm", flush=True)
+        except KeyboardInterrupt:
+            # File đang dở chưa có JSON nên lần chạy sau sẽ làm lại
+            pool.shutdown(wait=False, cancel_futures=True)
+            print("\n⏹️ Đã dừng, chạy lại cùng lệnh để xử lý tiếp")
+            return 130
+
+    print(f"🏁 Xong {len(jobs) - len(failed)}/{len(jobs)} file trong {time.perf_counter() - start:.1f} s")
+    if failed:
+        print(f"❌ {len(failed)} file lỗi (chạy lại cùng lệnh để thử lại)")
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
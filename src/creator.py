@@ -6,7 +6,6 @@ def make_anchors(X, strides, offset=0.5):
     dtype, device = X[0].dtype, X[0].device
     
     for x, stride in zip(X, strides):
-        print(x.shape)
         _, _, h, w = x.shape # LƯU Ý: Dòng này đã được thêm vào dựa trên logic code
         
         sx = torch.arange(end=w, device=device, dtype=dtype) + offset
@@ -14,11 +13,6 @@ def make_anchors(X, strides, offset=0.5):
         
         sy, sx = torch.meshgrid(sy, sx, indexing='ij') # LƯU Ý: Cần thêm indexing='ij' cho Pytorch >= 1.10
         
-        print(torch.stack((sx, sy), -1).view(-1, 2).shape)
-        print(torch.stack((sx, sy), -1).view(-1, 2))
-        print(torch.full((h * w, 1), stride, dtype=dtype, device=device).shape)
-        print(torch.full((h * w, 1), stride, dtype=dtype, device=device))
-        print('---')
         anchor_tensor.append(torch.stack((sx, sy), -1).view(-1, 2))
         stride_tensor.append(torch.full((h * w, 1), stride, dtype=dtype, device=device))
         
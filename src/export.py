@@ -0,0 +1,158 @@
+"""
+Export DetectionModel sang ONNX / TorchScript để chạy không cần ultralytics
+
+Model được gộp BatchNorm trước khi export; tên lớp, stride và kích thước ảnh
+được ghi kèm trong file (metadata của ONNX, extra file của TorchScript) để
+backend đọc lại mà không cần checkpoint gốc.
+
+Export toàn bộ model trong weights/ppe:
+    python -m src.export --format onnx torchscript
+"""
+
+import argparse
+import ast
+import json
+import sys
+from pathlib import Path
+
+import torch
+
+# Đuôi file của từng định dạng export
+SUFFIXES = {'onnx': '.onnx', 'torchscript': '.torchscript'}
+
+# Tên file metadata đi kèm TorchScript
+TORCHSCRIPT_CONFIG = 'config.json'
+
+
+def make_metadata(model, imgsz):
+    """Metadata ghi kèm file export: {'names', 'stride', 'imgsz', 'type'} (giá trị là chuỗi)"""
+    names = model.names or {i: str(i) for i in range(model.model[-1].n_classes)}
+    return {
+        'names': json.dumps({int(k): v for k, v in names.items()}),
+        'stride': str(int(model.stride.max())),
+        'imgsz': str(int(imgsz)),
+        'type': model.type,
+    }
+
+
+def parse_metadata(metadata):
+    """
+    Đọc lại metadata do make_metadata() ghi (hoặc do `yolo export` của ultralytics ghi)
+
+    Returns:
+        dict: {'names': {int: str} hoặc None, 'stride': int, 'imgsz': int}
+    """
+    names = metadata.get('names')
+    if names:
+        # ultralytics ghi dict Python ("{0: 'worker', ...}"), không phải JSON
+        names = json.loads(names) if names.startswith('{"') else ast.literal_eval(names)
+        names = {int(k): v for k, v in names.items()}
+    imgsz = ast.literal_eval(str(metadata.get('imgsz', 640)))
+    return {
+        'names': names or None,
+        'stride': int(metadata.get('stride', 32)),
+        'imgsz': max(imgsz) if isinstance(imgsz, (list, tuple)) else int(imgsz),
+    }
+
+
+def export_onnx(model, path, imgsz=640, opset=17):
+    """
+    Export sang ONNX với batch và kích thước ảnh động
+
+    Args:
+        model (DetectionModel): Model đã fuse() (trên cpu)
+        path (str): File .onnx đích
+        imgsz (int): Kích thước ảnh mẫu dùng khi trace
+        opset (int): ONNX opset
+    """
+    import onnx
+
+    dummy = torch.zeros(1, 3, imgsz, imgsz)
+    torch.onnx.export(
+        model, dummy, str(path),
+        dynamo=False,
+        opset_version=opset,
+        input_names=['images'],
+        output_names=['output0'],
+        dynamic_axes={'images': {0: 'batch', 2: 'height', 3: 'width'}, 'output0': {0: 'batch', 2: 'anchors'}},
+    )
+    # Ghi metadata vào chính file ONNX
+    onnx_model = onnx.load(str(path))
+    for key, value in make_metadata(model, imgsz).items():
+        onnx_model.metadata_props.add(key=key, value=value)
+    onnx.save(onnx_model, str(path))
+
+
+def export_torchscript(model, path, imgsz=640):
+    """
+    Export sang TorchScript bằng torch.jit.trace (kích thước ảnh vẫn thay đổi được)
+
+    Args:
+        model (DetectionModel): Model đã fuse() (trên cpu)
+        path (str): File .torchscript đích
+        imgsz (int): Kích thước ảnh mẫu dùng khi trace
+    """
+    dummy = torch.zeros(1, 3, imgsz, imgsz)
+    with torch.no_grad():
+        traced = torch.jit.trace(model, dummy, strict=False)
+    config = json.dumps(make_metadata(model, imgsz))
+    torch.jit.save(traced, str(path), _extra_files={TORCHSCRIPT_CONFIG: config})
+
+
+def export(source, formats, imgsz=640, check=True):
+    """
+    Export 1 checkpoint sang các định dạng, file đích nằm cạnh file nguồn
+
+    Args:
+        source (str): Checkpoint .pt / .ppe
+        formats (list): Các định dạng trong SUFFIXES
+        imgsz (int): Kích thước ảnh mẫu
+        check (bool): So sánh đầu ra của file export với DetectionModel gốc
+
+    Returns:
+        list: Đường dẫn các file đã ghi
+    """
+    from src.model import DetectionModel
+    from src.predictor import load_predictor
+
+    model = DetectionModel.from_checkpoint(source)
+    written = []
+    for fmt in formats:
+        target = Path(source).with_suffix(SUFFIXES[fmt])
+        if fmt == 'onnx':
+            export_onnx(model, target, imgsz)
+        else:
+            export_torchscript(model, target, imgsz)
+        written.append(str(target))
+
+        message = f"✅ {target}"
+        if check:
+            # Kích thước khác lúc trace để kiểm tra luôn phần shape động
+            x = torch.rand(2, 3, imgsz // 2, imgsz)
+            with torch.inference_mode():
+                expected = model(x)
+            actual = load_predictor(target, 'cpu').forward(x)
+            message += f" (sai lệch so với PyTorch: {(expected - actual).abs().max().item():.1e})"
+        print(message)
+    return written
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Export model PPE sang ONNX / TorchScript")
+    parser.add_argument('models', nargs='*', help="Checkpoint cần export (mặc định: mọi file .pt trong weights/ppe)")
+    parser.add_argument('--format', nargs='+', default=['onnx'], choices=list(SUFFIXES))
+    parser.add_argument('--imgsz', type=int, default=640)
+    parser.add_argument('--no-check', action='store_true', help="Bỏ qua bước so sánh với PyTorch")
+    args = parser.parse_args()
+
+    root = Path(__file__).parent.parent
+    sys.path.append(str(root))
+    models = args.models or sorted(str(p) for p in (root / 'weights' / 'ppe').glob('*.pt'))
+    if not models:
+        parser.error("Không có model nào để export")
+    for source in models:
+        export(source, args.format, args.imgsz, check=not args.no_check)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,7 +1,52 @@
+import copy
+
 import torch.nn as nn
 import torch
+from src.creator import make_anchors
+from src.weights import load_weights, read_checkpoint
 from utils.processor import yolo_type
 
+# Số lớp của bộ dữ liệu PPE (config/PPE_Dataset.yaml)
+N_CLASSES = 9
+
+# torch.compiler.is_compiling chỉ có từ torch 2.3; bản cũ hơn dùng hàm tương đương của dynamo
+_is_compiling = getattr(getattr(torch, 'compiler', None), 'is_compiling', None)
+if _is_compiling is None:
+    try:
+        from torch._dynamo import is_compiling as _is_compiling
+    except ImportError:
+        def _is_compiling():
+            return False
+
+
+def fuse_conv_bn(conv, bn):
+    """
+    Gộp BatchNorm (đã có running stats) vào Conv2d đứng trước nó
+
+    Args:
+        conv (nn.Conv2d): Conv không có hoặc có bias
+        bn (nn.BatchNorm2d): BatchNorm ngay sau conv
+
+    Returns:
+        nn.Conv2d: Conv mới có bias, cho kết quả bằng bn(conv(x)) ở chế độ eval
+    """
+    fused = nn.Conv2d(
+        conv.in_channels, conv.out_channels,
+        conv.kernel_size, conv.stride, conv.padding,
+        dilation=conv.dilation, groups=conv.groups, bias=True
+    ).to(conv.weight.device)
+    if conv.weight.is_meta:
+        # Model dựng trên 'meta' chỉ cần đúng cấu trúc, trọng số sẽ được nạp sau
+        return fused.requires_grad_(False)
+
+    with torch.no_grad():
+        # y = gamma * (conv(x) - mean) / sqrt(var + eps) + beta
+        scale = bn.weight / torch.sqrt(bn.running_var + bn.eps)
+        fused.weight.copy_(conv.weight * scale.view(-1, 1, 1, 1))
+        bias = conv.bias if conv.bias is not None else torch.zeros_like(bn.running_mean)
+        fused.bias.copy_((bias - bn.running_mean) * scale + bn.bias)
+    return fused.requires_grad_(False)
+
 class Conv(nn.Module):
     # Standard convolution
     def __init__(
@@ -22,6 +67,13 @@ class Conv(nn.Module):
 
     def forward(self, x):
         return self.act(self.bn(self.conv(x)))
+
+    def fuse(self):
+        """Gộp bn vào conv (chỉ dùng cho inference), bn được thay bằng Identity"""
+        if isinstance(self.bn, nn.BatchNorm2d):
+            self.conv = fuse_conv_bn(self.conv, self.bn)
+            self.bn = nn.Identity()
+        return self
     
 class Bottleneck(nn.Module):
     # Standard bottleneck
@@ -62,12 +114,14 @@ class C2f(nn.Module):
                     
     def forward(self, x):
         x = self.cv1(x)
-        x1, x2 = x.chunk(2, dim=1)
+        _, x2 = x.chunk(2, dim=1)
 
+        # Bottleneck nối tiếp trên nửa sau (giống ultralytics), ghép mọi đầu ra 1 lần
+        y = [x]
         for bottleneck in self.m:
-            x1 = bottleneck(x1)
-            x = torch.cat([x, x1], dim=1)
-        x = self.cv2(x)
+            x2 = bottleneck(x2)
+            y.append(x2)
+        x = self.cv2(torch.cat(y, dim=1))
         return x
 
 class SPPF(nn.Module):
@@ -84,11 +138,11 @@ class SPPF(nn.Module):
 
     def forward(self, x):
         x = self.cv1(x)
-        y = x
+        # 3 lần pool nối tiếp, ghép cả 4 nhánh bằng 1 lần torch.cat thay vì cat lặp lại
+        y = [x]
         for _ in range(3):
-            y = self.m(y)
-            x = torch.cat([x, y], dim=1)
-        x = self.cv2(x)
+            y.append(self.m(y[-1]))
+        x = self.cv2(torch.cat(y, dim=1))
         return x
 
 class Concat(nn.Module):
@@ -105,7 +159,7 @@ class DFL(nn.Module):
         self.bins = bins
         self.conv = nn.Conv2d(bins, 1, kernel_size=1, bias=False)
         
-        bin_w = torch.arange(bins, dtype=torch.float32).reshape(1, bins, 1, 1)
+        bin_w = torch.arange(bins, dtype=torch.float32, device='cpu').reshape(1, bins, 1, 1)
         self.conv.weight = torch.nn.Parameter(bin_w, requires_grad=False)
 
     def forward(self, x):
@@ -117,117 +171,275 @@ class DFL(nn.Module):
         return x
 
 class Detect(nn.Module):
-    def __init__(self, type='s', bins=16, n_classes=80):
+    def __init__(self, type='s', bins=16, n_classes=N_CLASSES):
         super().__init__()
         self.bins = bins
         self.n_classes = n_classes
         self.coordinates = 4 * bins 
         self.no = self.coordinates + n_classes 
 
-        self.stride = torch.zeros(3)
+        # Stride của 3 mức P3, P4, P5 (bản số Python dùng khi tạo anchor, không phải đọc từ tensor)
+        self.strides = (8, 16, 32)
+        self.stride = torch.tensor(self.strides, dtype=torch.float32, device='cpu')
 
         d, w, r = yolo_type(type)  # 'n', 's', 'm', 'l', 'x'
+        channels = (int(256*w), int(512*w), int(512*w*r))
+        # Số kênh ẩn của 2 nhánh, giống ultralytics để dùng được trọng số của nó
+        box_channels = max(16, channels[0] // 4, self.coordinates)
+        cls_channels = max(channels[0], min(n_classes, 100))
+
         # Box
         self.cv2 = nn.ModuleList([
             nn.Sequential(
-                Conv(int(256*w), self.coordinates, kernel_size=3, stride=1, padding=1),
-                Conv(self.coordinates, self.coordinates, kernel_size=3, stride=1, padding=1),
-                nn.Conv2d(self.coordinates, self.coordinates, kernel_size=1, stride=1)
-            ),
-
-            nn.Sequential(
-                Conv(int(512*w), self.coordinates, kernel_size=3, stride=1, padding=1),
-                Conv(self.coordinates, self.coordinates, kernel_size=3, stride=1, padding=1),
-                nn.Conv2d(self.coordinates, self.coordinates, kernel_size=1, stride=1)
-            ),
-
-            nn.Sequential(
-                Conv(int(512*w*r), self.coordinates, kernel_size=3, stride=1, padding=1),
-                Conv(self.coordinates, self.coordinates, kernel_size=3, stride=1, padding=1),
-                nn.Conv2d(self.coordinates, self.coordinates, kernel_size=1, stride=1)
+                Conv(c, box_channels, kernel_size=3, stride=1, padding=1),
+                Conv(box_channels, box_channels, kernel_size=3, stride=1, padding=1),
+                nn.Conv2d(box_channels, self.coordinates, kernel_size=1, stride=1)
             )
-        ])    
+            for c in channels
+        ])
 
         # Class
         self.cv3 = nn.ModuleList([
             nn.Sequential(
-                Conv(int(256*w), self.n_classes, kernel_size=3, stride=1, padding=1),
-                Conv(self.n_classes, self.n_classes, kernel_size=3, stride=1, padding=1),
-                nn.Conv2d(self.n_classes, self.n_classes, kernel_size=1, stride=1)
-            ),
+                Conv(c, cls_channels, kernel_size=3, stride=1, padding=1),
+                Conv(cls_channels, cls_channels, kernel_size=3, stride=1, padding=1),
+                nn.Conv2d(cls_channels, self.n_classes, kernel_size=1, stride=1)
+            )
+            for c in channels
+        ])
 
-            nn.Sequential(
-                Conv(int(512*w), self.n_classes, kernel_size=3, stride=1, padding=1),
-                Conv(self.n_classes, self.n_classes, kernel_size=3, stride=1, padding=1),
-                nn.Conv2d(self.n_classes, self.n_classes, kernel_size=1, stride=1)
-            ),
+        self.dfl = DFL(bins=bins)
 
-            nn.Sequential(
-                Conv(int(512*w*r), self.n_classes, kernel_size=3, stride=1, padding=1),
-                Conv(self.n_classes, self.n_classes, kernel_size=3, stride=1, padding=1),
-                nn.Conv2d(self.n_classes, self.n_classes, kernel_size=1, stride=1)
-            )
-        ]) 
+        # (kích thước các feature map, dtype, device) -> (anchors, strides)
+        self._anchor_cache = {}
 
-        self.dfl = DFL(bins=16)
+    def anchors(self, x):
+        """Anchor và stride cho các feature map, chỉ tính lại khi đổi độ phân giải đầu vào"""
+        if torch.jit.is_tracing() or _is_compiling():
+            # Khi export (ONNX / TorchScript) hoặc biên dịch phải ghi lại phép tính, không dùng hằng đã cache
+            return tuple(i.transpose(0, 1) for i in make_anchors(x, self.strides))
+        key = (tuple(xi.shape[2:] for xi in x), x[0].dtype, x[0].device)
+        cached = self._anchor_cache.get(key)
+        if cached is None:
+            cached = tuple(i.transpose(0, 1) for i in make_anchors(x, self.strides))
+            self._anchor_cache[key] = cached
+        return cached
 
     def forward(self, x):
-        for i in range(len(self.cv2)):
-            box = self.cv2[i](x[i])
-            cls = self.cv3[i](x[i])
-            x = torch.cat([box, cls], dim=1)
+        x = [torch.cat([self.cv2[i](x[i]), self.cv3[i](x[i])], dim=1) for i in range(len(self.cv2))]
 
         if self.training:
             return x
         
-        anchors, strides = (i.transpose(0, 1) for i in self.make_anchors(x, self.stride))     
+        anchors, strides = self.anchors(x)
+        b = x[0].shape[0]
+        y = torch.cat([xi.view(b, self.no, -1) for xi in x], dim=2)
+        box, cls = y.split((self.coordinates, self.n_classes), dim=1)
+
+        # DFL: phân phối khoảng cách -> (trái, trên, phải, dưới) tính theo anchor
+        lt, rb = self.dfl(box).chunk(2, dim=1)
+        x1y1 = anchors - lt
+        x2y2 = anchors + rb
+        box = torch.cat([(x1y1 + x2y2) / 2, x2y2 - x1y1], dim=1) * strides
+
+        # (b, 4 + n_classes, số anchor): box xywh theo pixel ảnh đầu vào, điểm lớp đã sigmoid
+        return torch.cat([box, cls.sigmoid()], dim=1)
         
 class DetectionModel(nn.Module):
-    def __init__(self, path=None, type='s'):
+    # Layer nhận đầu vào từ nhiều layer: index -> các layer nguồn (-1 = layer liền trước)
+    ROUTES = {
+        11: (-1, 6),
+        14: (-1, 4),
+        17: (-1, 12),
+        20: (-1, 9),
+        22: (15, 18, 21),
+    }
+
+    def __init__(self, path=None, type='s', n_classes=N_CLASSES):
         super().__init__()
+        ckpt = None
         if path:
-            type = path.split('_')[0][-1]
-            state_dict = torch.load(path)
-            self.load_state_dict(state_dict, strict=False)  # strict=False nếu không khớp 100% tên layer
-            print("Loaded state_dict into custom model!")
+            # Biến thể và số lớp lấy từ kích thước trọng số, không đoán theo tên file
+            ckpt = read_checkpoint(path)
+            type, n_classes = ckpt['type'], ckpt['n_classes']
         
         d, w, r = yolo_type(type)  # 'n', 's', 'm', 'l', 'x'
+        n3 = max(round(3*d), 1)
+        n6 = max(round(6*d), 1)
+        self.type = type
+        self.channels_last = False
+        self.names = None
         self.model = nn.Sequential(
-            Conv(3, int(64*w), kernel_size=3, stride=2, padding=1),                # 0
-            Conv(int(64*w), int(128*w), kernel_size=3, stride=2, padding=1),       # 1
-            C2f(int(128*w), int(128*w), n_bottlenecks=max(int(3*d), 1)),           # 2
-            Conv(int(128*w), int(256*w), kernel_size=3, stride=2, padding=1),      # 3
-            C2f(int(256*w), int(256*w), n_bottlenecks=max(int(6*d), 1)),           # 4
-            Conv(int(256*w), int(512*w), kernel_size=3, stride=2, padding=1),      # 5
-            C2f(int(512*w), int(512*w), n_bottlenecks=max(int(6*d), 1)),           # 6
-            Conv(int(512*w), int(512*w*r), kernel_size=3, stride=2, padding=1),    # 7
-            C2f(int(512*w*r), int(512*w*r), n_bottlenecks=max(int(3*d), 1)),       # 8
-            SPPF(int(512*w*r), int(512*w*r), kernel_size=5),                       # 9
-            nn.Upsample(scale_factor=2, mode='nearest'),                           # 10
-            Concat(dimension=1),                                                   # 11
-            C2f(int(512*w*(1 + r)), int(512*w), n_bottlenecks=max(int(3*d), 1)),   # 12  
-            nn.Upsample(scale_factor=2, mode='nearest'),                           # 13
-            Concat(dimension=1),                                                   # 14
-            C2f(int(768*w), int(256*w), n_bottlenecks=max(int(3*d), 1)),           # 15
-            Conv(int(256*w), int(256*w), kernel_size=3, stride=2, padding=1),      # 16
-            Concat(dimension=1),                                                   # 17
-            C2f(int(768*w), int(512*w), n_bottlenecks=max(int(3*d), 1)),           # 18
-            Conv(int(512*w), int(512*w), kernel_size=3, stride=2, padding=1),      # 19
-            Concat(dimension=1),                                                   # 20
-            C2f(int(512*w*(1 + r)), int(512*w*r), n_bottlenecks=max(int(3*d), 1)), # 21
-            Detect(type, bins=16)                                                               # 22
+            Conv(3, int(64*w), kernel_size=3, stride=2, padding=1),                              # 0
+            Conv(int(64*w), int(128*w), kernel_size=3, stride=2, padding=1),                     # 1
+            C2f(int(128*w), int(128*w), n_bottlenecks=n3),                                       # 2
+            Conv(int(128*w), int(256*w), kernel_size=3, stride=2, padding=1),                    # 3
+            C2f(int(256*w), int(256*w), n_bottlenecks=n6),                                       # 4
+            Conv(int(256*w), int(512*w), kernel_size=3, stride=2, padding=1),                    # 5
+            C2f(int(512*w), int(512*w), n_bottlenecks=n6),                                       # 6
+            Conv(int(512*w), int(512*w*r), kernel_size=3, stride=2, padding=1),                  # 7
+            C2f(int(512*w*r), int(512*w*r), n_bottlenecks=n3),                                   # 8
+            SPPF(int(512*w*r), int(512*w*r), kernel_size=5),                                     # 9
+            nn.Upsample(scale_factor=2, mode='nearest'),                                         # 10
+            Concat(dimension=1),                                                                 # 11
+            C2f(int(512*w*(1 + r)), int(512*w), n_bottlenecks=n3, shortcut=False),               # 12
+            nn.Upsample(scale_factor=2, mode='nearest'),                                         # 13
+            Concat(dimension=1),                                                                 # 14
+            C2f(int(768*w), int(256*w), n_bottlenecks=n3, shortcut=False),                       # 15
+            Conv(int(256*w), int(256*w), kernel_size=3, stride=2, padding=1),                    # 16
+            Concat(dimension=1),                                                                 # 17
+            C2f(int(768*w), int(512*w), n_bottlenecks=n3, shortcut=False),                       # 18
+            Conv(int(512*w), int(512*w), kernel_size=3, stride=2, padding=1),                    # 19
+            Concat(dimension=1),                                                                 # 20
+            C2f(int(512*w*(1 + r)), int(512*w*r), n_bottlenecks=n3, shortcut=False),             # 21
+            Detect(type, bins=16, n_classes=n_classes)                                           # 22
         )
+        # Chỉ giữ lại đầu ra của các layer được dùng lại về sau
+        self.saved = {j for route in self.ROUTES.values() for j in route if j != -1}
+
+        if ckpt is not None:
+            # Load sau khi đã dựng đủ các layer
+            if ckpt['fused']:
+                self.fuse(inference=False)
+            load_weights(self, ckpt['state_dict'])
+            self.names = ckpt['names']
+
+    @classmethod
+    def from_checkpoint(cls, path, device=None, fuse=True, channels_last=False):
+        """
+        Load model từ checkpoint với chi phí khởi động thấp nhất
+
+        Các layer được dựng trên device 'meta' (không khởi tạo trọng số ngẫu nhiên)
+        rồi nhận thẳng tensor được map từ file, nên thời gian và RAM lúc khởi động
+        không tăng theo kích thước checkpoint (với file .ppe float32).
+
+        Args:
+            path (str): File .pt của ultralytics, file state_dict hoặc file .ppe
+            device (str): Thiết bị chạy model (None = giữ trên cpu)
+            fuse (bool): Gộp BatchNorm vào Conv và chuyển sang chế độ inference
+            channels_last (bool): Dùng bộ nhớ NHWC (chỉ khi fuse)
+
+        Returns:
+            DetectionModel: Model ở chế độ eval, names lấy từ checkpoint
+        """
+        ckpt = read_checkpoint(path)
+        with torch.device('meta'):
+            model = cls(type=ckpt['type'], n_classes=ckpt['n_classes'])
+            if ckpt['fused']:
+                model.fuse(inference=False)
+
+        report = load_weights(model, ckpt['state_dict'], assign=True)
+        if report['missing']:
+            raise ValueError(f"{path}: thiếu {len(report['missing'])} tham số, không dựng được model")
+        model.names = ckpt['names']
+
+        if fuse:
+            model.fuse(channels_last=channels_last)
+        else:
+            model.eval()
+        return model.to(device) if device else model
+
+    @property
+    def stride(self):
+        return self.model[-1].stride
+
+    @property
+    def is_fused(self):
+        return not any(isinstance(m, nn.BatchNorm2d) for m in self.modules())
+
+    def fuse(self, channels_last=False, inference=True):
+        """
+        Chuẩn bị model cho inference: gộp BatchNorm vào mọi Conv (kể cả trong
+        Bottleneck, C2f, SPPF và Detect), bỏ 1 lần đọc/ghi feature map mỗi Conv
+
+        Args:
+            channels_last (bool): Chuyển trọng số sang bộ nhớ NHWC (nhanh hơn với
+                conv trên CPU có oneDNN và GPU có tensor core)
+            inference (bool): Chuyển sang eval và tắt gradient của mọi tham số
+
+        Returns:
+            DetectionModel: Chính model này (đã sửa tại chỗ)
+        """
+        # Chỉ gộp được khi BatchNorm dùng running stats
+        self.eval()
+        for module in self.modules():
+            if isinstance(module, Conv):
+                module.fuse()
+        if channels_last:
+            self.to(memory_format=torch.channels_last)
+            self.channels_last = True
+        if inference:
+            self.requires_grad_(False)
+        return self
+
+    def compile(self, channels_last=True, mode=None):
+        """
+        Chế độ inference biên dịch (torch.compile) cho CPU, sửa tại chỗ
+
+        Model được fuse() rồi biên dịch với shape tĩnh: mỗi độ phân giải đầu vào
+        mới được biên dịch riêng ở lần gặp đầu tiên (chậm vài chục giây), các lần
+        sau chạy bản đã tối ưu.
+
+        Args:
+            channels_last (bool): Dùng bộ nhớ NHWC
+            mode (str): Mode của torch.compile (None = mặc định)
+
+        Returns:
+            DetectionModel: Chính model này
+        """
+        self.fuse(channels_last=channels_last)
+        if hasattr(nn.Module, 'compile'):
+            super().compile(dynamic=False, mode=mode)
+        else:
+            # nn.Module.compile chỉ có từ torch 2.2
+            self.forward = torch.compile(self.forward, dynamic=False, mode=mode)
+        return self
 
     def forward(self, x):
-        return self.model(x)
+        outputs = []
+        for i, layer in enumerate(self.model):
+            route = self.ROUTES.get(i)
+            if route is not None:
+                x = [x if j == -1 else outputs[j] for j in route]
+            x = layer(x)
+            outputs.append(x if i in self.saved else None)
+        return x
     
+def check_fusion(model, imgsz=640, batch_size=1, channels_last=False, atol=1e-3):
+    """
+    So sánh đầu ra của model trước và sau fuse() trên cùng 1 đầu vào ngẫu nhiên
+
+    Args:
+        model (DetectionModel): Model chưa fuse (không bị sửa)
+        imgsz (int): Kích thước ảnh đầu vào
+        batch_size (int): Số ảnh
+        channels_last (bool): Kiểm tra cả bản channels_last
+        atol (float): Sai lệch tuyệt đối tối đa cho phép (box tính theo pixel)
+
+    Returns:
+        float: Sai lệch tuyệt đối lớn nhất giữa 2 đầu ra
+
+    Raises:
+        AssertionError: Nếu sai lệch vượt atol
+    """
+    model = model.eval()
+    fused = copy.deepcopy(model).fuse(channels_last=channels_last)
+    device = next(model.parameters()).device
+    x = torch.rand(batch_size, 3, imgsz, imgsz, device=device)
+    with torch.inference_mode():
+        expected = model(x)
+        actual = fused(x.contiguous(memory_format=torch.channels_last) if channels_last else x)
+    diff = (expected - actual).abs().max().item()
+    assert diff <= atol, f"Model sau khi fuse lệch {diff:.2e} (> {atol:.0e})"
+    return diff
+
 class YOLO(nn.Module):
     def __init__(self, path=None):
         super().__init__()
         self.model = DetectionModel(path)
 
     def forward(self, x):
-        return super().forward(x)
+        return self.model(x)
 # ...existing code...
 
 if __name__ == "__main__":
@@ -242,4 +454,5 @@ if __name__ == "__main__":
     model = DetectionModel()
     print(model.model)
     total_params = sum(p.numel() for p in model.parameters())
-    print(f"Tổng số parameters: {total_params:,}")
\ No newline at end of file
+    print(f"Tổng số parameters: {total_params:,}")
+    print(f"Sai lệch sau khi fuse: {check_fusion(model, imgsz=320):.2e}")
\ No newline at end of file
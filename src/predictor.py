@@ -0,0 +1,363 @@
+import json
+import threading
+from pathlib import Path
+
+import cv2
+import numpy as np
+import torch
+import torchvision
+
+from src.export import TORCHSCRIPT_CONFIG, parse_metadata
+from src.model import DetectionModel
+
+
+def load_checkpoint(path, device=None, fuse=True, channels_last=False, compile=False):
+    """
+    Dựng DetectionModel từ checkpoint .pt của ultralytics, file state_dict hoặc file .ppe
+
+    Biến thể (n/s/m/l/x) và số lớp được suy ra từ kích thước trọng số.
+
+    Args:
+        path (str): Đường dẫn checkpoint
+        device (str): Thiết bị chạy model (None = cuda nếu có, ngược lại cpu)
+        fuse (bool): Gộp BatchNorm vào Conv (DetectionModel.fuse)
+        channels_last (bool): Dùng bộ nhớ NHWC cho trọng số và đầu vào
+        compile (bool): Biên dịch bằng torch.compile (DetectionModel.compile, luôn fuse)
+
+    Returns:
+        tuple: (model ở chế độ eval, names) - names là dict {id: label} hoặc None
+    """
+    device = device or ('cuda' if torch.cuda.is_available() else 'cpu')
+    model = DetectionModel.from_checkpoint(path, device, fuse=fuse, channels_last=channels_last)
+    if compile:
+        model.compile(channels_last=True)
+    return model, model.names
+
+
+class OnnxRuntimeModel:
+    """
+    Chạy file ONNX đã export bằng ONNX Runtime, nhận và trả torch.Tensor như DetectionModel
+
+    Args:
+        path (str): File .onnx (từ src/export.py)
+        device (str): 'cuda...' dùng CUDAExecutionProvider nếu có, ngược lại chạy CPU
+    """
+
+    channels_last = False
+
+    def __init__(self, path, device=None):
+        import onnxruntime as ort
+
+        providers = ['CPUExecutionProvider']
+        if str(device or '').startswith('cuda') and 'CUDAExecutionProvider' in ort.get_available_providers():
+            providers.insert(0, 'CUDAExecutionProvider')
+        options = ort.SessionOptions()
+        options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        self.session = ort.InferenceSession(str(path), options, providers=providers)
+        model_input = self.session.get_inputs()[0]
+        self.input_name = model_input.name
+        self.metadata = parse_metadata(self.session.get_modelmeta().custom_metadata_map)
+        self.nbytes = Path(path).stat().st_size
+
+        # File export với kích thước cố định (mặc định của `yolo export`): chiều nào
+        # là số nguyên thì không đổi được
+        batch, _, height, width = model_input.shape
+        self.batch_size = batch if isinstance(batch, int) else None
+        self.input_shape = (height, width) if isinstance(height, int) and isinstance(width, int) else None
+
+    def __call__(self, batch):
+        batch = batch.cpu().numpy()
+        if self.batch_size is None or len(batch) == self.batch_size:
+            return torch.from_numpy(self.session.run(None, {self.input_name: batch})[0])
+        outputs = [self.session.run(None, {self.input_name: batch[i:i + 1]})[0] for i in range(len(batch))]
+        return torch.from_numpy(np.concatenate(outputs))
+
+
+def load_torchscript(path, device=None):
+    """
+    Load file TorchScript đã export
+
+    Returns:
+        tuple: (ScriptModule ở chế độ eval, metadata từ parse_metadata())
+    """
+    extra_files = {TORCHSCRIPT_CONFIG: ''}
+    device = device or ('cuda' if torch.cuda.is_available() else 'cpu')
+    model = torch.jit.load(str(path), map_location=device, _extra_files=extra_files)
+    metadata = json.loads(extra_files[TORCHSCRIPT_CONFIG] or '{}')
+    return model.eval(), parse_metadata(metadata)
+
+
+def load_predictor(path, device=None, compile=False, **kwargs):
+    """
+    Tạo Predictor cho file model theo đuôi: .onnx, .torchscript, còn lại là checkpoint PyTorch
+
+    Args:
+        path (str): File model
+        device (str): Thiết bị chạy model
+        compile (bool): Biên dịch checkpoint PyTorch bằng torch.compile
+        **kwargs: Tham số thêm cho Predictor (imgsz, iou, max_det)
+
+    Returns:
+        Predictor
+    """
+    suffix = Path(path).suffix
+    if suffix == '.onnx':
+        model = OnnxRuntimeModel(path, device)
+        metadata = model.metadata
+        if model.input_shape is not None:
+            kwargs = {'imgsz': model.input_shape, 'auto': False, **kwargs}
+        return Predictor(model, metadata['names'], stride=metadata['stride'], device='cpu', **kwargs)
+    if suffix == '.torchscript':
+        model, metadata = load_torchscript(path, device)
+        return Predictor(model, metadata['names'], stride=metadata['stride'], **kwargs)
+    model, names = load_checkpoint(path, device, compile=compile)
+    return Predictor(model, names, **kwargs)
+
+
+def letterbox_params(shape, new_shape, stride=32, auto=True):
+    """
+    Kích thước sau resize và phần pad 4 cạnh khi letterbox ảnh `shape` về `new_shape`
+
+    Returns:
+        tuple: (gain, (width, height) sau resize, (top, bottom, left, right))
+    """
+    height, width = shape[:2]
+    gain = min(new_shape[0] / height, new_shape[1] / width)
+    new_unpad = round(width * gain), round(height * gain)
+    dw, dh = new_shape[1] - new_unpad[0], new_shape[0] - new_unpad[1]
+    if auto:
+        dw, dh = dw % stride, dh % stride
+    dw, dh = dw / 2, dh / 2
+    borders = round(dh - 0.1), round(dh + 0.1), round(dw - 0.1), round(dw + 0.1)
+    return gain, new_unpad, borders
+
+
+def letterbox(frame, new_shape, stride=32, auto=True, pad_value=114):
+    """
+    Resize giữ tỉ lệ rồi pad về new_shape (giống LetterBox của ultralytics)
+
+    Returns:
+        tuple: (ảnh đã letterbox, gain, (pad_x, pad_y))
+    """
+    gain, new_unpad, (top, bottom, left, right) = letterbox_params(frame.shape, new_shape, stride, auto)
+    if frame.shape[1::-1] != new_unpad:
+        frame = cv2.resize(frame, new_unpad, interpolation=cv2.INTER_LINEAR)
+    frame = cv2.copyMakeBorder(frame, top, bottom, left, right, cv2.BORDER_CONSTANT, value=(pad_value,) * 3)
+    return frame, gain, (left, top)
+
+
+def scale_boxes(boxes, image_ids, metas):
+    """
+    Đưa box xyxy từ toạ độ ảnh letterbox về frame gốc cho cả lô trong 1 phép numpy
+
+    Args:
+        boxes (np.ndarray): (N, 4) xyxy theo ảnh đầu vào model
+        image_ids (np.ndarray): (N,) chỉ số ảnh trong lô của từng box
+        metas (list): Kết quả thứ 2 của Predictor.preprocess()
+
+    Returns:
+        np.ndarray: (N, 4) xyxy theo frame gốc, đã cắt trong khung hình
+    """
+    gains = np.array([gain for gain, _, _ in metas], dtype=np.float32)
+    pads = np.array([pad * 2 for _, pad, _ in metas], dtype=np.float32)
+    limits = np.array([(width, height) * 2 for _, _, (height, width) in metas], dtype=np.float32)
+    boxes = (boxes - pads[image_ids]) / gains[image_ids, None]
+    return np.clip(boxes, 0, limits[image_ids], out=boxes)
+
+
+class LetterboxBuffer:
+    """
+    Letterbox lô frame BGR thẳng vào buffer cấp phát sẵn và trả về tensor dùng lại được
+
+    Mỗi độ phân giải đầu vào model có 1 buffer uint8 (B, H, W, 3) đã tô sẵn màu pad
+    và 1 tensor float (B, 3, H, W) cố định. Frame được resize thẳng vào vùng giữa
+    của buffer, đổi BGR -> RGB tại chỗ rồi chép (kèm chuẩn hoá 0-1) vào tensor, nên
+    khi độ phân giải ổn định thì mỗi lô gần như không cấp phát bộ nhớ mới. Phần pad
+    chỉ được tô lại khi bố cục của ảnh trong buffer thay đổi.
+
+    Buffer tách riêng theo thread (model trong registry được dùng chung giữa các
+    session). Tensor trả về bị ghi đè ở lần gọi sau trên cùng thread: phải dùng
+    xong (forward) trước khi gọi tiếp.
+
+    Args:
+        stride (int): Stride lớn nhất của model
+        pad_value (int): Màu pad
+        device (torch.device): Thiết bị của tensor trả về
+        channels_last (bool): Tensor trả về ở bộ nhớ NHWC
+    """
+
+    def __init__(self, stride=32, pad_value=114, device='cpu', channels_last=False):
+        self.stride = stride
+        self.pad_value = pad_value
+        self.device = torch.device(device)
+        self.channels_last = channels_last
+        self._local = threading.local()
+
+    def _slot(self, batch_size, shape):
+        slots = self._local.__dict__.setdefault('slots', {})
+        slot = slots.get(shape)
+        if slot is None or len(slot['image']) < batch_size:
+            height, width = shape
+            image = np.full((batch_size, height, width, 3), self.pad_value, dtype=np.uint8)
+            if self.channels_last:
+                tensor = torch.empty(batch_size, height, width, 3, device=self.device).permute(0, 3, 1, 2)
+            else:
+                tensor = torch.empty(batch_size, 3, height, width, device=self.device)
+            staging = None if self.device.type == 'cpu' else torch.empty(image.shape, dtype=torch.uint8,
+                                                                        device=self.device)
+            slot = {'image': image, 'tensor': tensor, 'staging': staging, 'layouts': [None] * batch_size}
+            slots[shape] = slot
+        return slot
+
+    def __call__(self, frames, new_shape, auto=True):
+        """
+        Args:
+            frames (list): Danh sách frame BGR
+            new_shape (tuple): (height, width) đầu vào model
+            auto (bool): Chỉ pad tới bội số của stride (chỉ khi mọi frame cùng kích thước,
+                giống ultralytics)
+
+        Returns:
+            tuple: (tensor (B, 3, H, W) float 0-1, danh sách (gain, (pad_x, pad_y), shape gốc))
+        """
+        auto = auto and len({frame.shape for frame in frames}) == 1
+        params = [letterbox_params(frame.shape, new_shape, self.stride, auto) for frame in frames]
+        _, (width, height), (top, bottom, left, right) = params[0]
+        shape = (top + height + bottom, left + width + right)
+
+        count = len(frames)
+        slot = self._slot(count, shape)
+        image = slot['image']
+        metas = []
+        for i, (frame, (gain, (width, height), (top, _, left, _))) in enumerate(zip(frames, params)):
+            layout = (top, left, height, width)
+            if slot['layouts'][i] != layout:
+                image[i].fill(self.pad_value)
+                slot['layouts'][i] = layout
+            region = image[i, top:top + height, left:left + width]
+            if frame.shape[:2] == (height, width):
+                np.copyto(region, frame)
+            else:
+                cv2.resize(frame, (width, height), dst=region, interpolation=cv2.INTER_LINEAR)
+            cv2.cvtColor(region, cv2.COLOR_BGR2RGB, dst=region)
+            metas.append((gain, (left, top), frame.shape[:2]))
+
+        source = torch.from_numpy(image[:count])
+        if slot['staging'] is not None:
+            source = slot['staging'][:count].copy_(source)
+        tensor = slot['tensor'][:count]
+        tensor.copy_(source.permute(0, 3, 1, 2)).div_(255)
+        return tensor, metas
+
+
+class Predictor:
+    """
+    Chạy DetectionModel trên frame BGR và trả về detection cùng định dạng PPEDetector
+
+    Gồm 3 bước có thể đo riêng: preprocess (letterbox, BGR->RGB, chuẩn hóa),
+    forward và postprocess (NMS theo lớp, đưa box về toạ độ frame gốc).
+
+    Args:
+        model (callable): DetectionModel ở chế độ eval, hoặc model đã export
+            (OnnxRuntimeModel, TorchScript) cho cùng đầu ra (B, 4 + n_classes, số anchor)
+        names (dict): {class_id: label}
+        imgsz (int): Cạnh dài của ảnh đầu vào model, hoặc (height, width)
+        iou (float): Ngưỡng IoU cho NMS
+        max_det (int): Số detection tối đa mỗi ảnh
+        stride (int): Stride lớn nhất của model (None = lấy từ model.stride)
+        device (str): Thiết bị của tensor đầu vào (None = device của tham số model)
+        auto (bool): Chỉ pad tới bội số của stride (False = luôn pad đủ imgsz,
+            cho model có kích thước đầu vào cố định)
+        max_nms (int): Số ứng viên (điểm cao nhất) tối đa mỗi ảnh đưa vào NMS
+    """
+
+    def __init__(self, model, names, imgsz=640, iou=0.7, max_det=300, stride=None, device=None, auto=True,
+                 max_nms=3000):
+        self.model = model
+        self.names = names
+        self.imgsz = imgsz
+        self.auto = auto
+        self.iou = iou
+        self.max_det = max_det
+        self.max_nms = max_nms
+        self.stride = int(stride or model.stride.max())
+        self.device = torch.device(device) if device else next(model.parameters()).device
+        self.channels_last = getattr(model, 'channels_last', False)
+        self.letterbox = LetterboxBuffer(self.stride, device=self.device, channels_last=self.channels_last)
+
+    def preprocess(self, frames):
+        """
+        Returns:
+            tuple: (tensor (B, 3, H, W) float 0-1, danh sách (gain, pad, shape gốc))
+        """
+        new_shape = self.imgsz if isinstance(self.imgsz, tuple) else (self.imgsz, self.imgsz)
+        return self.letterbox(frames, new_shape, self.auto)
+
+    @torch.inference_mode()
+    def forward(self, batch):
+        return self.model(batch)
+
+    @torch.inference_mode()
+    def postprocess(self, preds, metas, conf, classes=None):
+        """
+        Lọc confidence, NMS theo lớp và đưa box về frame gốc cho cả lô trong vài phép tensor
+
+        Anchor có lớp điểm cao nhất không nằm trong `classes` hoặc dưới ngưỡng bị loại trước
+        khi đổi box sang xyxy và số ứng viên vào NMS bị chặn ở max_nms mỗi ảnh, nên
+        chi phí gần như không đổi kể cả với ngưỡng confidence rất thấp.
+        NMS chạy 1 lần cho cả lô, tách nhóm theo cặp (ảnh, lớp).
+
+        Args:
+            preds (torch.Tensor): (B, 4 + n_classes, số anchor) từ DetectionModel
+            metas (list): Kết quả thứ 2 của preprocess()
+            conf (float): Ngưỡng confidence
+            classes (list): Chỉ giữ các class id này (None = mọi lớp)
+
+        Returns:
+            list: Mỗi phần tử là dict {'boxes', 'class_ids', 'confidences', 'names'}
+        """
+        n_classes = preds.shape[1] - 4
+        # Lớp của anchor là lớp điểm cao nhất trên mọi lớp; `classes` chỉ lọc sau
+        # đó (giống NMS của ultralytics), không gán lại box sang lớp còn lại
+        scores, class_ids = preds[:, 4:].max(dim=1)
+
+        # Lọc ứng viên trước, chỉ lấy box của các anchor vượt ngưỡng
+        candidates = scores > conf
+        if classes is not None:
+            class_index = torch.as_tensor(classes, dtype=torch.long, device=preds.device)
+            candidates &= torch.isin(class_ids, class_index)
+        if candidates.sum(dim=1).max() > self.max_nms:
+            # Ngưỡng rất thấp: chỉ giữ max_nms anchor điểm cao nhất mỗi ảnh
+            top = scores.masked_fill(~candidates, -1).topk(self.max_nms, dim=1).indices
+            candidates &= torch.zeros_like(candidates).scatter_(1, top, True)
+        image_ids, anchor_ids = candidates.nonzero(as_tuple=True)
+        boxes = preds[image_ids, :4, anchor_ids]
+        scores = scores[image_ids, anchor_ids]
+        class_ids = class_ids[image_ids, anchor_ids]
+
+        # xywh -> xyxy
+        boxes = torch.cat([boxes[:, :2] - boxes[:, 2:] / 2, boxes[:, :2] + boxes[:, 2:] / 2], dim=1)
+        keep = torchvision.ops.batched_nms(boxes, scores, image_ids * n_classes + class_ids, self.iou)
+
+        # Sắp lại theo ảnh (giữ thứ tự điểm giảm dần trong từng ảnh), cắt max_det mỗi ảnh
+        keep = keep[torch.argsort(image_ids[keep], stable=True)]
+        counts = torch.bincount(image_ids[keep], minlength=len(metas))
+        starts = torch.cumsum(counts, 0) - counts
+        rank = torch.arange(len(keep), device=keep.device) - starts.repeat_interleave(counts)
+        keep = keep[rank < self.max_det]
+        counts = counts.clamp(max=self.max_det)
+
+        # Bỏ phần pad và đưa về kích thước frame gốc (mọi ảnh cùng lúc)
+        boxes = scale_boxes(boxes[keep].cpu().numpy(), image_ids[keep].cpu().numpy(), metas)
+
+        splits = np.cumsum(counts.cpu().numpy())[:-1]
+        class_ids = np.split(class_ids[keep].cpu().numpy().astype(int), splits)
+        scores = np.split(scores[keep].cpu().numpy(), splits)
+        return [
+            {'boxes': image_boxes, 'class_ids': image_class_ids, 'confidences': image_scores, 'names': self.names}
+            for image_boxes, image_class_ids, image_scores in zip(np.split(boxes, splits), class_ids, scores)
+        ]
+
+    def __call__(self, frames, conf=0.25, classes=None):
+        batch, metas = self.preprocess(frames)
+        return self.postprocess(self.forward(batch), metas, conf, classes)
@@ -0,0 +1,330 @@
+"""
+Lượng tử hóa INT8 tĩnh (ONNX Runtime) cho model PPE chạy trên CPU
+
+Checkpoint .pt / .ppe được export sang ONNX trước (file .onnx của `yolo export`
+dùng trực tiếp), rồi hiệu chỉnh (calibration) trên ảnh thật của dataset.
+Phần giải mã box ở cuối Detect (DFL, anchor, sigmoid) và các conv 1x1 cuối
+được giữ FP32 vì sai số ở đó ảnh hưởng trực tiếp tới toạ độ box và điểm lớp.
+
+Kết quả là file <tên>.int8.onnx, chọn được trong UI / PPEDetector như mọi file
+.onnx khác. Sau khi lượng tử hóa, độ chính xác từng lớp được so với bản FP32.
+
+    python -m src.quantize weights/ppe/ppe_8s_best.pt --data config/PPE_Dataset.yaml
+    python -m src.quantize weights/ppe/ppe_8s_best.pt --data path/to/images --eval-data path/to/other
+"""
+
+import argparse
+import random
+import re
+import tempfile
+import time
+from pathlib import Path
+
+import cv2
+import numpy as np
+
+from src.export import export_onnx
+from src.predictor import load_predictor
+from utils.caculator import iou_matrix
+from utils.tracker import match_boxes
+
+# Conv 3x3 ẩn và conv 1x1 cuối trong các nhánh box (cv2) / lớp (cv3) của Detect
+HIDDEN_CONV = re.compile(r'/model\.22/cv[23]\.\d+/cv[23]\.\d+\.[01]/')
+FINAL_CONV = re.compile(r'/model\.22/cv[23]\.\d+/cv[23]\.\d+\.2/')
+
+ROOT = Path(__file__).parent.parent
+IMAGE_SUFFIXES = ('.jpg', '.jpeg', '.png', '.bmp', '.webp')
+INT8_SUFFIX = '.int8.onnx'
+
+
+def dataset_images(data, split='train'):
+    """
+    Danh sách ảnh từ file dataset yaml (kiểu ultralytics) hoặc từ 1 thư mục
+
+    Args:
+        data (str): File .yaml (các khóa path / train / val / test) hoặc thư mục ảnh
+        split (str): Split cần lấy khi data là yaml
+
+    Returns:
+        list: Đường dẫn ảnh (Path), đã sắp xếp
+    """
+    data = Path(data)
+    if data.suffix in ('.yaml', '.yml'):
+        import yaml
+
+        with open(data, encoding='utf-8') as f:
+            config = yaml.safe_load(f)
+        root = Path(config.get('path') or '.')
+        if not root.is_absolute():
+            root = data.parent / root
+        entries = config.get(split)
+        if not entries:
+            raise ValueError(f"{data} không có split '{split}'")
+        sources = [Path(e) if Path(e).is_absolute() else root / e for e in np.atleast_1d(entries)]
+    else:
+        sources = [data]
+
+    images = []
+    for source in sources:
+        if source.is_dir():
+            images += [p for p in source.rglob('*') if p.suffix.lower() in IMAGE_SUFFIXES]
+        elif source.suffix == '.txt' and source.exists():
+            # File danh sách ảnh, mỗi dòng 1 đường dẫn
+            images += [Path(line.strip()) for line in source.read_text().splitlines() if line.strip()]
+    if not images:
+        raise FileNotFoundError(f"Không tìm thấy ảnh nào trong {', '.join(map(str, sources))}")
+    return sorted(images)
+
+
+def read_labels(image_path, shape):
+    """
+    Đọc nhãn YOLO (.txt trong thư mục labels/ song song với images/)
+
+    Returns:
+        tuple: (boxes xyxy theo pixel, class_ids), hoặc None nếu ảnh không có file nhãn
+    """
+    parts = list(Path(image_path).parts)
+    if 'images' not in parts:
+        return None
+    index = len(parts) - 1 - parts[::-1].index('images')
+    parts[index] = 'labels'
+    label_path = Path(*parts).with_suffix('.txt')
+    if not label_path.exists():
+        return None
+
+    rows = np.loadtxt(label_path, ndmin=2, dtype=np.float32).reshape(-1, 5)
+    height, width = shape[:2]
+    cx, cy, w, h = rows[:, 1] * width, rows[:, 2] * height, rows[:, 3] * width, rows[:, 4] * height
+    boxes = np.stack([cx - w / 2, cy - h / 2, cx + w / 2, cy + h / 2], axis=1)
+    return boxes, rows[:, 0].astype(int)
+
+
+def _sample(images, n_images, seed):
+    if n_images and len(images) > n_images:
+        images = random.Random(seed).sample(images, n_images)
+    return images
+
+
+def head_nodes(onnx_model):
+    """
+    Tên các node của phần giải mã trong Detect (layer 22), giữ FP32 khi lượng tử hóa
+
+    Chỉ 2 Conv 3x3 đầu của mỗi nhánh box / lớp (cv2.i.0, cv2.i.1, cv3.i.0, cv3.i.1)
+    được lượng tử hóa; conv 1x1 cuối (cv*.i.2), DFL, anchor và sigmoid giữ nguyên.
+
+    Raises:
+        ValueError: Nếu còn conv 1x1 cuối của nhánh nào không bị loại (tên node khác dự kiến)
+    """
+    excluded = []
+    for node in onnx_model.graph.node:
+        if not node.name.startswith('/model.22/'):
+            continue
+        # So khớp thành phần cuối cv{2,3}.<nhánh>.<layer>, không nhầm chỉ số nhánh với chỉ số layer
+        hidden_conv = node.op_type == 'Conv' and HIDDEN_CONV.search(node.name) is not None
+        if not hidden_conv:
+            excluded.append(node.name)
+
+    final_convs = [node.name for node in onnx_model.graph.node
+                   if node.op_type == 'Conv' and FINAL_CONV.search(node.name)]
+    missing = [name for name in final_convs if name not in excluded]
+    if missing:
+        raise ValueError(f"Conv 1x1 cuối của Detect bị lượng tử hóa: {missing}")
+    return excluded
+
+
+def quantize(source, data, split='train', n_images=200, target=None, imgsz=640, seed=0):
+    """
+    Lượng tử hóa INT8 tĩnh (QDQ, trọng số theo từng kênh) với ảnh hiệu chỉnh từ dataset
+
+    Args:
+        source (str): Checkpoint .pt / .ppe, hoặc file .onnx (FP32)
+        data (str): Dataset yaml hoặc thư mục ảnh hiệu chỉnh
+        split (str): Split dùng để hiệu chỉnh khi data là yaml
+        n_images (int): Số ảnh hiệu chỉnh tối đa (lấy ngẫu nhiên)
+        target (str): File đích (None = <tên>.int8.onnx cạnh file nguồn)
+        imgsz (int): Kích thước ảnh khi export checkpoint sang ONNX
+        seed (int): Seed chọn ảnh
+
+    Returns:
+        tuple: (file FP32 .onnx dùng làm gốc, file INT8 .onnx)
+    """
+    import onnx
+    from onnxruntime.quantization import (CalibrationDataReader, CalibrationMethod, QuantFormat, QuantType,
+                                          quantize_static)
+    from onnxruntime.quantization.shape_inference import quant_pre_process
+
+    source = Path(source)
+    target = Path(target) if target else source.with_name(source.stem + INT8_SUFFIX)
+    fp32_path = source
+    if source.suffix != '.onnx':
+        from src.model import DetectionModel
+
+        fp32_path = source.with_suffix('.onnx')
+        export_onnx(DetectionModel.from_checkpoint(source), fp32_path, imgsz)
+
+    predictor = load_predictor(fp32_path, 'cpu')
+    images = _sample(dataset_images(data, split), n_images, seed)
+
+    class Reader(CalibrationDataReader):
+        def __init__(self):
+            self._images = iter(images)
+
+        def get_next(self):
+            for path in self._images:
+                frame = cv2.imread(str(path))
+                if frame is not None:
+                    batch, _ = predictor.preprocess([frame])
+                    # preprocess() dùng lại buffer ở lần gọi sau, calibrator có thể giữ đầu vào
+                    return {predictor.model.input_name: batch.numpy().copy()}
+            return None
+
+    with tempfile.TemporaryDirectory() as tmp:
+        prepared = Path(tmp) / 'prepared.onnx'
+        quant_pre_process(str(fp32_path), str(prepared), skip_symbolic_shape=True)
+        quantize_static(
+            str(prepared), str(target), Reader(),
+            quant_format=QuantFormat.QDQ,
+            per_channel=True,
+            activation_type=QuantType.QUInt8,
+            weight_type=QuantType.QInt8,
+            calibrate_method=CalibrationMethod.MinMax,
+            nodes_to_exclude=head_nodes(onnx.load(str(prepared))),
+        )
+
+    # Giữ metadata (names, stride, imgsz) của bản FP32
+    fp32_model, int8_model = onnx.load(str(fp32_path)), onnx.load(str(target))
+    existing = {prop.key for prop in int8_model.metadata_props}
+    for prop in fp32_model.metadata_props:
+        if prop.key not in existing:
+            int8_model.metadata_props.add(key=prop.key, value=prop.value)
+    onnx.save(int8_model, str(target))
+    return str(fp32_path), str(target)
+
+
+def _match_counts(pred, ref, n_classes, iou):
+    """Số (đúng, dự đoán, tham chiếu) theo lớp khi ghép pred với ref cùng lớp theo IoU"""
+    counts = np.zeros((n_classes, 3), dtype=int)
+    ref_boxes, ref_ids = ref
+    for cls_id in range(n_classes):
+        p = pred['boxes'][pred['class_ids'] == cls_id]
+        r = ref_boxes[ref_ids == cls_id]
+        counts[cls_id] = (len(match_boxes(iou_matrix(p, r), iou)) if len(p) and len(r) else 0, len(p), len(r))
+    return counts
+
+
+def evaluate(fp32_path, int8_path, data, split='val', n_images=200, conf=0.25, iou=0.5, seed=0):
+    """
+    So sánh độ chính xác từng lớp và tốc độ của bản INT8 với bản FP32
+
+    Nếu ảnh có nhãn YOLO thì cả 2 bản được chấm với nhãn (precision / recall
+    ở IoU >= iou); nếu không, bản INT8 được chấm với kết quả của bản FP32.
+
+    Returns:
+        dict: {'reference': 'labels' | 'fp32', 'images', 'classes': {label: {...}},
+               'ms_per_image': {'fp32', 'int8'}}
+    """
+    fp32, int8 = load_predictor(fp32_path, 'cpu'), load_predictor(int8_path, 'cpu')
+    names = fp32.names or {}
+    n_classes = max(names, default=-1) + 1
+    images = _sample(dataset_images(data, split), n_images, seed)
+    has_labels = any(read_labels(path, (1, 1)) is not None for path in images)
+
+    counts = {'fp32': np.zeros((n_classes, 3), dtype=int), 'int8': np.zeros((n_classes, 3), dtype=int)}
+    elapsed = {'fp32': 0.0, 'int8': 0.0}
+    n_done = 0
+    for path in images:
+        frame = cv2.imread(str(path))
+        if frame is None:
+            continue
+        n_done += 1
+        detections = {}
+        for key, predictor in (('fp32', fp32), ('int8', int8)):
+            batch, metas = predictor.preprocess([frame])
+            start = time.perf_counter()
+            preds = predictor.forward(batch)
+            elapsed[key] += time.perf_counter() - start
+            detections[key] = predictor.postprocess(preds, metas, conf)[0]
+
+        if has_labels:
+            labels = read_labels(path, frame.shape)
+            if labels is None:
+                labels = (np.zeros((0, 4), dtype=np.float32), np.zeros(0, dtype=int))
+            for key in counts:
+                counts[key] += _match_counts(detections[key], labels, n_classes, iou)
+        else:
+            ref = (detections['fp32']['boxes'], detections['fp32']['class_ids'])
+            counts['int8'] += _match_counts(detections['int8'], ref, n_classes, iou)
+
+    def scores(c):
+        tp, n_pred, n_ref = c
+        return {
+            'precision': tp / n_pred if n_pred else None,
+            'recall': tp / n_ref if n_ref else None,
+            'instances': int(n_ref),
+        }
+
+    classes = {}
+    for cls_id in range(n_classes):
+        entry = {'int8': scores(counts['int8'][cls_id])}
+        if has_labels:
+            entry['fp32'] = scores(counts['fp32'][cls_id])
+        classes[names.get(cls_id, str(cls_id))] = entry
+    return {
+        'reference': 'labels' if has_labels else 'fp32',
+        'images': n_done,
+        'classes': classes,
+        'ms_per_image': {key: value / max(n_done, 1) * 1000 for key, value in elapsed.items()},
+    }
+
+
+def print_report(report):
+    def fmt(value):
+        return '   -  ' if value is None else f"{value:6.3f}"
+
+    print(f"\n📊 Độ chính xác theo lớp ({report['images']} ảnh, tham chiếu: {report['reference']})")
+    if report['reference'] == 'labels':
+        print(f"{'Lớp':<12}{'Số box':>8}{'P fp32':>9}{'P int8':>9}{'R fp32':>9}{'R int8':>9}{'ΔR':>9}")
+        for label, entry in report['classes'].items():
+            fp32, int8 = entry['fp32'], entry['int8']
+            delta = None if fp32['recall'] is None else int8['recall'] - fp32['recall']
+            print(f"{label:<12}{int8['instances']:>8}   {fmt(fp32['precision'])}   {fmt(int8['precision'])}"
+                  f"   {fmt(fp32['recall'])}   {fmt(int8['recall'])}   {fmt(delta)}")
+    else:
+        # Không có nhãn: recall = tỉ lệ box FP32 mà INT8 vẫn tìm thấy
+        print(f"{'Lớp':<12}{'Box fp32':>9}{'Khớp':>9}{'Thừa':>9}")
+        for label, entry in report['classes'].items():
+            int8 = entry['int8']
+            print(f"{label:<12}{int8['instances']:>9}   {fmt(int8['recall'])}   "
+                  f"{fmt(None if int8['precision'] is None else 1 - int8['precision'])}")
+
+    speed = report['ms_per_image']
+    print(f"\n⏱️ Forward: FP32 {speed['fp32']:.1f} ms/ảnh, INT8 {speed['int8']:.1f} ms/ảnh "
+          f"(x{speed['fp32'] / max(speed['int8'], 1e-9):.2f})")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Lượng tử hóa INT8 model PPE cho CPU")
+    parser.add_argument('source', help="Checkpoint .pt / .ppe hoặc file .onnx FP32")
+    parser.add_argument('--data', default=str(ROOT / 'config' / 'PPE_Dataset.yaml'),
+                        help="Dataset yaml hoặc thư mục ảnh hiệu chỉnh")
+    parser.add_argument('--split', default='train', help="Split dùng để hiệu chỉnh")
+    parser.add_argument('--calib-images', type=int, default=200)
+    parser.add_argument('--eval-data', help="Dataset yaml / thư mục ảnh để đánh giá (mặc định: --data)")
+    parser.add_argument('--eval-split', default='val')
+    parser.add_argument('--eval-images', type=int, default=200)
+    parser.add_argument('--conf', type=float, default=0.25)
+    parser.add_argument('--imgsz', type=int, default=640)
+    parser.add_argument('--output', help=f"File đích (mặc định: <tên>{INT8_SUFFIX})")
+    args = parser.parse_args()
+
+    fp32_path, int8_path = quantize(args.source, args.data, args.split, args.calib_images, args.output, args.imgsz)
+    print(f"✅ Đã ghi {int8_path}")
+
+    eval_data = args.eval_data or args.data
+    # Thư mục ảnh không có split: đánh giá trên chính thư mục đó
+    eval_split = args.eval_split if Path(eval_data).suffix in ('.yaml', '.yml') else None
+    print_report(evaluate(fp32_path, int8_path, eval_data, eval_split, args.eval_images, args.conf))
+
+
+if __name__ == '__main__':
+    main()
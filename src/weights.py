@@ -0,0 +1,215 @@
+"""
+Đọc / ghi trọng số cho DetectionModel trong src/model.py
+
+Hỗ trợ checkpoint .pt của ultralytics (model đã pickle), file state_dict thuần
+và định dạng gọn đã chuyển đổi sẵn (.ppe): chỉ gồm tensor float32 (có thể đã
+gộp BatchNorm) cùng cấu hình model, load được bằng memory mapping mà không cần
+ultralytics.
+
+Chuyển đổi 1 lần:
+    python -m src.weights weights/ppe/ppe_8s_best.pt weights/ppe/ppe_8s_best.ppe
+"""
+
+import argparse
+import sys
+import time
+from pathlib import Path
+
+import torch
+import torch.nn as nn
+
+# Số kênh ra của Conv đầu tiên -> biến thể YOLOv8
+VARIANT_BY_WIDTH = {16: 'n', 32: 's', 48: 'm', 64: 'l', 80: 'x'}
+
+# Đánh dấu file ở định dạng gọn
+COMPACT_FORMAT = 'ppe-detection-model'
+COMPACT_VERSION = 1
+COMPACT_SUFFIX = '.ppe'
+
+# Tiền tố do DataParallel / DistributedDataParallel thêm vào tên tham số
+WRAPPER_PREFIXES = ('module.', '_orig_mod.')
+
+
+def _torch_load(path, weights_only):
+    # Checkpoint dạng zip (torch >= 1.6) được map thẳng từ file, tensor chỉ được
+    # đọc vào RAM khi dùng tới; file định dạng cũ thì phải đọc toàn bộ
+    try:
+        return torch.load(path, map_location='cpu', mmap=True, weights_only=weights_only)
+    except RuntimeError as e:
+        if 'mmap' not in str(e):
+            raise
+        return torch.load(path, map_location='cpu', weights_only=weights_only)
+
+
+def read_checkpoint(path):
+    """
+    Đọc checkpoint bằng memory mapping và tách state_dict cùng thông tin đi kèm
+
+    Args:
+        path (str): File .pt của ultralytics, file state_dict hoặc file .ppe
+
+    Returns:
+        dict: {'state_dict', 'names', 'type', 'n_classes', 'fused'}; 'type' và
+            'n_classes' được suy ra từ kích thước trọng số nếu file không ghi sẵn
+    """
+    try:
+        # File .ppe và state_dict thuần không cần unpickle class nào
+        ckpt = _torch_load(path, weights_only=True)
+    except Exception:
+        # Checkpoint ultralytics chứa cả object model (cần cài ultralytics)
+        ckpt = _torch_load(path, weights_only=False)
+
+    if isinstance(ckpt, dict) and ckpt.get('format') == COMPACT_FORMAT:
+        if ckpt.get('version', 0) > COMPACT_VERSION:
+            raise ValueError(f"{path}: định dạng phiên bản {ckpt['version']} mới hơn bản hỗ trợ ({COMPACT_VERSION})")
+        return {
+            'state_dict': ckpt['state_dict'],
+            'names': ckpt.get('names'),
+            'type': ckpt['type'],
+            'n_classes': ckpt['n_classes'],
+            'fused': ckpt.get('fused', False),
+        }
+
+    names = None
+    if isinstance(ckpt, dict) and isinstance(ckpt.get('ema') or ckpt.get('model'), nn.Module):
+        ckpt = ckpt.get('ema') or ckpt.get('model')
+    if isinstance(ckpt, nn.Module):
+        names = getattr(ckpt, 'names', None)
+        ckpt = ckpt.state_dict()
+    elif isinstance(ckpt, dict) and isinstance(ckpt.get('state_dict'), dict):
+        names = ckpt.get('names')
+        ckpt = ckpt['state_dict']
+
+    state_dict = remap_keys(ckpt)
+    variant, n_classes = infer_config(state_dict)
+    if isinstance(names, (list, tuple)):
+        names = dict(enumerate(names))
+    return {
+        'state_dict': state_dict,
+        'names': names,
+        'type': variant,
+        'n_classes': n_classes,
+        'fused': not any(k.endswith('.bn.running_var') for k in state_dict),
+    }
+
+
+def remap_keys(state_dict):
+    """
+    Đổi tên tham số về tên module của DetectionModel ('model.<index>.<...>')
+
+    Bỏ tiền tố của DataParallel / torch.compile, thêm 'model.' cho state_dict
+    lưu từ nn.Sequential bên trong và bỏ các giá trị không phải tensor.
+    """
+    remapped = {}
+    for key, value in state_dict.items():
+        if not torch.is_tensor(value):
+            continue
+        for prefix in WRAPPER_PREFIXES:
+            key = key.replace(prefix, '')
+        if key.split('.', 1)[0].isdigit():
+            key = f'model.{key}'
+        remapped[key] = value
+    return remapped
+
+
+def infer_config(state_dict):
+    """
+    Suy ra biến thể (n/s/m/l/x) và số lớp từ kích thước trọng số
+
+    Returns:
+        tuple: (type, n_classes)
+    """
+    try:
+        width = state_dict['model.0.conv.weight'].shape[0]
+        head = max(k for k in state_dict if k.startswith('model.22.cv3.0.2.'))
+    except (KeyError, ValueError):
+        raise ValueError("Checkpoint không phải YOLOv8 detection (thiếu model.0.conv / model.22.cv3)") from None
+    if width not in VARIANT_BY_WIDTH:
+        raise ValueError(f"Không nhận ra biến thể YOLOv8 với {width} kênh ở layer đầu")
+    return VARIANT_BY_WIDTH[width], state_dict[head].shape[0]
+
+
+def load_weights(model, state_dict, assign=False):
+    """
+    Nạp state_dict vào model đã dựng xong và báo các tham số không khớp
+
+    Args:
+        model (nn.Module): DetectionModel (đã fuse() nếu state_dict đã gộp BatchNorm)
+        state_dict (dict): Kết quả của remap_keys() / read_checkpoint()
+        assign (bool): Dùng thẳng tensor của state_dict thay vì copy vào tham số
+            có sẵn (model dựng trên device 'meta', tensor vẫn map từ file)
+
+    Returns:
+        dict: {'missing', 'unexpected', 'mismatched'} - danh sách tên tham số
+    """
+    own = model.state_dict()
+    mismatched = [k for k, v in state_dict.items() if k in own and v.shape != own[k].shape]
+    # Ép về dtype của model (checkpoint ultralytics lưu float16)
+    matched = {
+        k: v.to(own[k].dtype) for k, v in state_dict.items()
+        if k in own and k not in mismatched
+    }
+    result = model.load_state_dict(matched, strict=False, assign=assign)
+    report = {
+        'missing': sorted(set(result.missing_keys) | set(mismatched)),
+        'unexpected': sorted(k for k in state_dict if k not in own),
+        'mismatched': sorted(mismatched),
+    }
+    if any(report.values()):
+        print(f"⚠️ Trọng số không khớp hoàn toàn: thiếu {len(report['missing'])}, "
+              f"thừa {len(report['unexpected'])}, sai kích thước {len(report['mismatched'])}")
+        for kind, keys in report.items():
+            if keys:
+                print(f"   {kind}: {', '.join(keys[:10])}{' ...' if len(keys) > 10 else ''}")
+    return report
+
+
+def save_compact(model, path, names=None):
+    """
+    Lưu DetectionModel ở định dạng gọn: state_dict float32 + cấu hình model
+
+    Model đã fuse() thì lưu luôn trọng số đã gộp BatchNorm, lúc load không
+    phải gộp lại.
+
+    Args:
+        model (DetectionModel): Model cần lưu
+        path (str): File đích (nên dùng đuôi .ppe)
+        names (dict): {class_id: label} (None = lấy model.names nếu có)
+    """
+    state_dict = {
+        k: (v.float() if v.is_floating_point() else v).detach().cpu().contiguous()
+        for k, v in model.state_dict().items()
+    }
+    torch.save({
+        'format': COMPACT_FORMAT,
+        'version': COMPACT_VERSION,
+        'type': model.type,
+        'n_classes': model.model[-1].n_classes,
+        'names': names if names is not None else getattr(model, 'names', None),
+        'fused': model.is_fused,
+        'state_dict': state_dict,
+    }, path)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Chuyển checkpoint YOLOv8 sang định dạng gọn cho DetectionModel")
+    parser.add_argument('source', help="Checkpoint .pt (ultralytics hoặc state_dict)")
+    parser.add_argument('target', nargs='?', help=f"File đích (mặc định: cùng tên, đuôi {COMPACT_SUFFIX})")
+    parser.add_argument('--no-fuse', action='store_true', help="Giữ BatchNorm riêng (để fine-tune tiếp)")
+    args = parser.parse_args()
+
+    sys.path.append(str(Path(__file__).parent.parent))
+    from src.model import DetectionModel
+
+    target = args.target or str(Path(args.source).with_suffix(COMPACT_SUFFIX))
+    model = DetectionModel.from_checkpoint(args.source, fuse=not args.no_fuse)
+    save_compact(model, target)
+
+    start = time.perf_counter()
+    DetectionModel.from_checkpoint(target)
+    print(f"✅ Đã ghi {target} ({Path(target).stat().st_size / 1e6:.1f} MB, "
+          f"load lại mất {(time.perf_counter() - start) * 1000:.0f} ms)")
+
+
+if __name__ == '__main__':
+    main()
@@ -1,3 +1,9 @@
+import numpy as np
+
+# Số cặp (worker × item) tối thiểu để chuyển sang dùng lưới không gian
+GRID_MIN_PAIRS = 50_000
+
+
 def inside(box_a, box_b, threshold=0.2):
     """Trả về True nếu box_a nằm trong box_b (theo phần giao diện tích)."""
     x1a, y1a, x2a, y2a = box_a
@@ -14,4 +20,168 @@ def inside(box_a, box_b, threshold=0.2):
 
     inter_area = (inter_x2 - inter_x1) * (inter_y2 - inter_y1)
     box_a_area = (x2a - x1a) * (y2a - y1a)
-    return inter_area / box_a_area > threshold
\ No newline at end of file
+    return inter_area / box_a_area > threshold
+
+
+def _pair_ratios(item_boxes, worker_boxes):
+    """
+    Tính tỉ lệ giao / diện tích item cho từng cặp (item, worker) tương ứng
+
+    Args:
+        item_boxes (np.ndarray): (K, 4) box item
+        worker_boxes (np.ndarray): (K, 4) box worker cùng hàng
+
+    Returns:
+        np.ndarray: (K,) tỉ lệ, bằng 0 nếu hai box không giao nhau
+    """
+    inter_w = np.minimum(item_boxes[..., 2], worker_boxes[..., 2]) - np.maximum(item_boxes[..., 0], worker_boxes[..., 0])
+    inter_h = np.minimum(item_boxes[..., 3], worker_boxes[..., 3]) - np.maximum(item_boxes[..., 1], worker_boxes[..., 1])
+    overlap = (inter_w > 0) & (inter_h > 0)
+
+    item_area = (item_boxes[..., 2] - item_boxes[..., 0]) * (item_boxes[..., 3] - item_boxes[..., 1])
+    with np.errstate(divide='ignore', invalid='ignore'):
+        ratios = (inter_w * inter_h) / item_area
+    return np.where(overlap, ratios, 0).astype(ratios.dtype, copy=False)
+
+
+def _grid_candidates(item_boxes, worker_boxes, cell_size):
+    """
+    Dùng lưới đều để tìm các cặp (item, worker) có thể giao nhau
+
+    Mỗi box được gán vào mọi ô lưới mà nó phủ lên; hai box chỉ được xét
+    khi chung ít nhất một ô. Số ô / cặp cần duyệt bị chặn ở M × N (chi phí
+    của cách tính toàn bộ cặp): vượt quá (ví dụ ô rất nhỏ vì worker suy biến
+    trong khi có item rất lớn) thì trả về None để phía gọi tính toàn bộ cặp.
+
+    Returns:
+        tuple: (item_idx, worker_idx) các cặp ứng viên không trùng lặp, hoặc None
+    """
+    budget = len(item_boxes) * len(worker_boxes)
+
+    def spans(boxes):
+        c0 = np.floor(boxes[:, :2] / cell_size).astype(np.int64)
+        c1 = np.floor(boxes[:, 2:] / cell_size).astype(np.int64)
+        span = np.maximum(c1 - c0 + 1, 1)
+        return c0, span, span[:, 0] * span[:, 1]
+
+    def cells(c0, span, counts):
+        owner = np.repeat(np.arange(len(counts)), counts)
+        # Vị trí tương đối của từng ô trong vùng box phủ
+        offset = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+        cx = c0[owner, 0] + offset % span[owner, 0]
+        cy = c0[owner, 1] + offset // span[owner, 0]
+        return owner, cx, cy
+
+    # Đếm số ô trước khi trải ra (tính bằng float để không tràn số)
+    item_spans = spans(item_boxes)
+    worker_spans = spans(worker_boxes)
+    if item_spans[2].sum(dtype=np.float64) + worker_spans[2].sum(dtype=np.float64) > budget:
+        return None
+
+    i_owner, i_cx, i_cy = cells(*item_spans)
+    w_owner, w_cx, w_cy = cells(*worker_spans)
+
+    # Mã hóa ô (cx, cy) thành 1 khóa để join bằng sort
+    base_x = min(i_cx.min(), w_cx.min())
+    base_y = min(i_cy.min(), w_cy.min())
+    width = max(i_cx.max(), w_cx.max()) - base_x + 1
+    i_key = (i_cy - base_y) * width + (i_cx - base_x)
+    w_key = (w_cy - base_y) * width + (w_cx - base_x)
+
+    order = np.argsort(w_key, kind='stable')
+    w_key, w_owner = w_key[order], w_owner[order]
+    start = np.searchsorted(w_key, i_key, side='left')
+    stop = np.searchsorted(w_key, i_key, side='right')
+    n_match = stop - start
+    if n_match.sum() > budget:
+        return None
+
+    pair_item = np.repeat(i_owner, n_match)
+    offset = np.arange(n_match.sum()) - np.repeat(np.cumsum(n_match) - n_match, n_match)
+    pair_worker = w_owner[np.repeat(start, n_match) + offset]
+
+    pairs = np.unique(pair_item * len(worker_boxes) + pair_worker)
+    return pairs // len(worker_boxes), pairs % len(worker_boxes)
+
+
+def inside_matrix(item_boxes, worker_boxes, use_grid=None):
+    """
+    Tính ma trận tỉ lệ giao giữa toàn bộ item và worker trong một lần gọi NumPy
+
+    Args:
+        item_boxes (array-like): (M, 4) box item dạng xyxy
+        worker_boxes (array-like): (N, 4) box worker dạng xyxy
+        use_grid (bool): Dùng lưới không gian; None = tự chọn theo số cặp
+
+    Returns:
+        np.ndarray: (M, N) tỉ lệ diện tích giao / diện tích item
+    """
+    item_boxes = np.asarray(item_boxes).reshape(-1, 4)
+    worker_boxes = np.asarray(worker_boxes).reshape(-1, 4)
+    dtype = np.result_type(item_boxes, worker_boxes, np.float32)
+    item_boxes = item_boxes.astype(dtype, copy=False)
+    worker_boxes = worker_boxes.astype(dtype, copy=False)
+
+    n_items, n_workers = len(item_boxes), len(worker_boxes)
+    if n_items == 0 or n_workers == 0:
+        return np.zeros((n_items, n_workers), dtype=dtype)
+
+    if use_grid is None:
+        use_grid = n_items * n_workers >= GRID_MIN_PAIRS
+
+    if not use_grid:
+        return _pair_ratios(item_boxes[:, None, :], worker_boxes[None, :, :])
+
+    # Kích thước ô = trung vị cạnh worker, để mỗi worker phủ ít ô
+    sizes = np.concatenate([worker_boxes[:, 2] - worker_boxes[:, 0], worker_boxes[:, 3] - worker_boxes[:, 1]])
+    cell_size = max(float(np.median(sizes)), 1.0)
+
+    candidates = _grid_candidates(item_boxes, worker_boxes, cell_size)
+    if candidates is None:
+        return _pair_ratios(item_boxes[:, None, :], worker_boxes[None, :, :])
+    item_idx, worker_idx = candidates
+    ratios = np.zeros((n_items, n_workers), dtype=dtype)
+    ratios[item_idx, worker_idx] = _pair_ratios(item_boxes[item_idx], worker_boxes[worker_idx])
+    return ratios
+
+
+def assign_items(item_boxes, worker_boxes, threshold=0.2, use_grid=None):
+    """
+    Gán item cho worker theo cùng tiêu chí với inside() nhưng xử lý theo lô
+
+    Args:
+        item_boxes (array-like): (M, 4) box item
+        worker_boxes (array-like): (N, 4) box worker
+        threshold (float): Ngưỡng tỉ lệ giao, giống inside()
+        use_grid (bool): Xem inside_matrix()
+
+    Returns:
+        tuple: (ratios, mask) - ma trận tỉ lệ (M, N) và ma trận bool
+               mask[i, j] = inside(item_boxes[i], worker_boxes[j], threshold)
+    """
+    ratios = inside_matrix(item_boxes, worker_boxes, use_grid=use_grid)
+    return ratios, ratios > threshold
+
+
+def iou_matrix(boxes_a, boxes_b):
+    """
+    Tính IoU giữa mọi cặp box của 2 tập
+
+    Args:
+        boxes_a (array-like): (M, 4) box xyxy
+        boxes_b (array-like): (N, 4) box xyxy
+
+    Returns:
+        np.ndarray: (M, N) IoU
+    """
+    boxes_a = np.asarray(boxes_a, dtype=np.float32).reshape(-1, 4)
+    boxes_b = np.asarray(boxes_b, dtype=np.float32).reshape(-1, 4)
+    a, b = boxes_a[:, None, :], boxes_b[None, :, :]
+
+    inter_w = np.clip(np.minimum(a[..., 2], b[..., 2]) - np.maximum(a[..., 0], b[..., 0]), 0, None)
+    inter_h = np.clip(np.minimum(a[..., 3], b[..., 3]) - np.maximum(a[..., 1], b[..., 1]), 0, None)
+    inter = inter_w * inter_h
+    area_a = (a[..., 2] - a[..., 0]) * (a[..., 3] - a[..., 1])
+    area_b = (b[..., 2] - b[..., 0]) * (b[..., 3] - b[..., 1])
+    union = area_a + area_b - inter
+    return np.where(union > 0, inter / np.maximum(union, 1e-9), 0).astype(np.float32)
@@ -0,0 +1,240 @@
+import json
+import os
+import threading
+import time
+from collections import deque
+from datetime import datetime
+from pathlib import Path
+
+import cv2
+
+from utils.renderer import BGR
+from utils.writer import AsyncVideoWriter
+
+
+def _describe(error):
+    return f"{type(error).__name__}: {error}" if error is not None else None
+
+
+class _Clip:
+    """1 clip đang ghi: writer và thông tin cho file index"""
+
+    def __init__(self, writer, path, start_frame):
+        self.writer = writer
+        self.path = path
+        self.start_frame = start_frame
+        self.end_frame = start_frame
+        self.trigger_end = start_frame
+        self.first_trigger = None
+        self.last_trigger = None
+        self.triggers = 0
+        self.peak_unsafe = 0
+        self.started = time.time()
+
+
+class ClipRecorder:
+    """
+    Chỉ ghi các đoạn video quanh vi phạm thay vì toàn bộ video
+
+    Frame gần nhất được giữ trong ring buffer có giới hạn (pre_seconds). Khi 1
+    frame có worker Unsafe, clip mới bắt đầu bằng các frame trong buffer rồi ghi
+    tiếp tới post_seconds sau frame vi phạm cuối cùng. Vi phạm xảy ra trong lúc
+    clip đang ghi, hoặc đủ gần để cửa sổ trước của nó chạm vào clip, được gộp vào
+    clip đó. Mỗi clip (.mp4) có 1 file index .json cùng tên.
+
+    Frame trong buffer được nén JPEG (giải nén lại trên thread ghi của clip) và
+    tổng dung lượng buffer bị giới hạn bởi max_buffer_mb: frame thô 1080p là
+    ~6 MB, nên 5 s ở 30 fps sẽ tốn ~0.9 GB cho mỗi recorder nếu không nén.
+    Khi chạm giới hạn, frame cũ nhất bị bỏ (đoạn trước vi phạm ngắn lại).
+    Clip được đóng trên thread riêng (encode nốt hàng đợi) nên thread gọi add()
+    không bị chặn.
+
+    Args:
+        output_dir (str): Thư mục chứa clip
+        fps (float): FPS của nguồn video (đổi giây sang số frame)
+        size (tuple): (width, height) của frame
+        pre_seconds (float): Số giây trước vi phạm được đưa vào clip
+        post_seconds (float): Số giây sau vi phạm cuối cùng được đưa vào clip
+        max_seconds (float): Độ dài tối đa 1 clip; vi phạm kéo dài hơn được tách
+            thành nhiều clip (None = không giới hạn)
+        color_order (str): Thứ tự kênh màu của frame: 'bgr' hoặc 'rgb'
+        writer_options (dict): Tham số thêm cho AsyncVideoWriter (encoder, codec, ...)
+        prefix (str): Tiền tố tên file clip (None = thời điểm tạo recorder)
+        buffer_quality (int): Chất lượng JPEG của frame trong buffer (None = giữ frame thô)
+        max_buffer_mb (float): Dung lượng tối đa của buffer (MB)
+    """
+
+    def __init__(self, output_dir, fps, size, pre_seconds=5.0, post_seconds=5.0, max_seconds=300.0,
+                 color_order=BGR, writer_options=None, prefix=None, buffer_quality=90, max_buffer_mb=256):
+        self.output_dir = Path(output_dir)
+        self.output_dir.mkdir(parents=True, exist_ok=True)
+        self.fps = fps or 30
+        self.size = tuple(size)
+        self.pre_frames = max(int(round(pre_seconds * self.fps)), 0)
+        self.post_frames = max(int(round(post_seconds * self.fps)), 0)
+        self.max_frames = int(round(max_seconds * self.fps)) if max_seconds else None
+        self.color_order = color_order
+        self.writer_options = writer_options or {}
+        self.prefix = prefix or f"clip_{datetime.now():%Y%m%d_%H%M%S}"
+        self.clips = []  # Index của các clip đã đóng
+        self.clip_count = 0
+        self.frames_seen = 0
+        self.frames_written = 0
+        self.buffer_quality = buffer_quality
+        self.max_buffer_bytes = int(max_buffer_mb * 1024 * 1024)
+        self._buffer = deque()
+        self._buffer_bytes = 0
+        self._clip = None
+        self._closing = []
+        self._lock = threading.Lock()
+
+    @property
+    def recording(self):
+        return self._clip is not None
+
+    @property
+    def buffer_bytes(self):
+        """Dung lượng hiện tại của ring buffer (byte)"""
+        return self._buffer_bytes
+
+    def _push(self, frame):
+        """
+        Thêm frame (nén JPEG nếu bật) vào cuối buffer, bỏ frame cũ nhất khi vượt
+        pre_frames hoặc max_buffer_bytes
+
+        Returns:
+            int: Số frame bị bỏ
+        """
+        if self.pre_frames == 0:
+            return 1
+        if self.buffer_quality is not None:
+            ok, encoded = cv2.imencode('.jpg', frame, [cv2.IMWRITE_JPEG_QUALITY, int(self.buffer_quality)])
+            if ok:
+                frame = encoded
+        self._buffer.append(frame)
+        self._buffer_bytes += frame.nbytes
+        dropped = 0
+        while self._buffer and (len(self._buffer) > self.pre_frames or self._buffer_bytes > self.max_buffer_bytes):
+            self._buffer_bytes -= self._buffer.popleft().nbytes
+            dropped += 1
+        return dropped
+
+    def _pop(self):
+        frame = self._buffer.popleft()
+        self._buffer_bytes -= frame.nbytes
+        return frame
+
+    def add(self, frame, triggered, unsafe=0):
+        """
+        Đưa 1 frame (đã vẽ, theo đúng thứ tự) vào recorder
+
+        Args:
+            frame (np.ndarray): Frame; không được sửa sau khi đưa vào
+            triggered (bool): Frame có vi phạm (worker Unsafe)
+            unsafe (int): Số worker Unsafe (ghi vào index)
+        """
+        index = self.frames_seen
+        self.frames_seen += 1
+        clip = self._clip
+
+        if clip is None:
+            if not triggered:
+                self._push(frame)
+                return
+            clip = self._start(index - len(self._buffer))
+        elif index > clip.trigger_end and not triggered:
+            # Đã qua cửa sổ sau: giữ frame trong buffer, chỉ đóng clip khi buffer đủ
+            # dài (hoặc đã phải bỏ frame) để vi phạm tiếp theo không còn nối liền clip này
+            dropped = self._push(frame)
+            if dropped or len(self._buffer) >= self.pre_frames:
+                self._finish()
+            return
+
+        # Frame thuộc clip: ghi nốt phần buffer (khoảng trống giữa 2 vi phạm) rồi tới frame này
+        while self._buffer:
+            self._write(clip, self._pop())
+        self._write(clip, frame)
+        clip.end_frame = index
+        if triggered:
+            clip.trigger_end = index + self.post_frames
+            clip.first_trigger = index if clip.first_trigger is None else clip.first_trigger
+            clip.last_trigger = index
+            clip.triggers += 1
+            clip.peak_unsafe = max(clip.peak_unsafe, int(unsafe))
+        if self.max_frames is not None and clip.end_frame - clip.start_frame + 1 >= self.max_frames:
+            self._finish()
+
+    def _start(self, start_frame):
+        self.clip_count += 1
+        path = self.output_dir / f"{self.prefix}_{self.clip_count:04d}.mp4"
+        writer = AsyncVideoWriter(path, self.fps, self.size, **{'color_order': self.color_order,
+                                                                 **self.writer_options})
+        self._clip = _Clip(writer, path, start_frame)
+        return self._clip
+
+    def _write(self, clip, frame):
+        clip.writer.write(frame)
+        self.frames_written += 1
+
+    def _finish(self):
+        clip, self._clip = self._clip, None
+        thread = threading.Thread(target=self._close_clip, args=(clip,), name='clip-closer', daemon=True)
+        with self._lock:
+            self._closing.append(thread)
+        thread.start()
+
+    def _close_clip(self, clip):
+        index = {
+            'video': clip.path.name,
+            'start_frame': clip.start_frame,
+            'end_frame': clip.end_frame,
+            'frames': clip.end_frame - clip.start_frame + 1,
+            'start_sec': round(clip.start_frame / self.fps, 3),
+            'end_sec': round((clip.end_frame + 1) / self.fps, 3),
+            'first_violation_frame': clip.first_trigger,
+            'last_violation_frame': clip.last_trigger,
+            'violation_frames': clip.triggers,
+            'peak_unsafe_workers': clip.peak_unsafe,
+            'fps': self.fps,
+            'recorded_at': clip.started,
+            'error': None,
+        }
+        try:
+            try:
+                clip.writer.release()
+                error = clip.writer.error
+            except Exception as e:
+                # Ví dụ BrokenPipeError khi ffmpeg đã thoát: vẫn ghi index kèm lỗi
+                error = e
+            index['error'] = _describe(error)
+            tmp = clip.path.with_suffix('.json.tmp')
+            with open(tmp, 'w', encoding='utf-8') as f:
+                json.dump(index, f, ensure_ascii=False, indent=2)
+            os.replace(tmp, clip.path.with_suffix('.json'))
+        except Exception as e:
+            index['error'] = index['error'] or _describe(e)
+        finally:
+            # Luôn bỏ thread khỏi _closing, nếu không close() sẽ chờ mãi
+            with self._lock:
+                self.clips.append(index)
+                self._closing.remove(threading.current_thread())
+
+    def close(self):
+        """
+        Đóng clip đang ghi (nếu có) và chờ mọi clip ghi xong
+
+        Returns:
+            list: Index của mọi clip đã ghi, theo thứ tự thời gian
+        """
+        if self._clip is not None:
+            self._finish()
+        while True:
+            with self._lock:
+                pending = list(self._closing)
+            if not pending:
+                break
+            for thread in pending:
+                thread.join()
+        self._buffer.clear()
+        self._buffer_bytes = 0
+        return sorted(self.clips, key=lambda clip: clip['start_frame'])
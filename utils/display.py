@@ -0,0 +1,54 @@
+import time
+
+import cv2
+
+from utils.renderer import BGR, RGB
+
+
+def encode_preview(frame, max_width=960, quality=80, color_order=BGR):
+    """
+    Thu nhỏ và nén JPEG 1 frame để gửi lên trình duyệt
+
+    Thu nhỏ trước rồi mới chuyển màu (nếu cần), nên chi phí không phụ thuộc
+    độ phân giải gốc.
+
+    Args:
+        frame (np.ndarray): Frame đã vẽ kết quả
+        max_width (int): Chiều rộng tối đa (None = giữ nguyên kích thước)
+        quality (int): Chất lượng JPEG (0-100)
+        color_order (str): Thứ tự kênh màu của frame: 'bgr' hoặc 'rgb'
+
+    Returns:
+        bytes: Ảnh JPEG
+    """
+    height, width = frame.shape[:2]
+    if max_width and width > max_width:
+        size = (max_width, max(int(round(height * max_width / width)), 1))
+        frame = cv2.resize(frame, size, interpolation=cv2.INTER_AREA)
+    if color_order == RGB:
+        frame = cv2.cvtColor(frame, cv2.COLOR_RGB2BGR)
+    ok, buffer = cv2.imencode('.jpg', frame, [cv2.IMWRITE_JPEG_QUALITY, int(quality)])
+    if not ok:
+        raise ValueError("Không nén được frame sang JPEG")
+    return buffer.tobytes()
+
+
+class RateLimiter:
+    """
+    Giới hạn số lần cập nhật mỗi giây (hiển thị frame, bảng thống kê, ...)
+
+    Args:
+        rate (float): Số lần tối đa mỗi giây (None hoặc 0 = không giới hạn)
+    """
+
+    def __init__(self, rate):
+        self.interval = 1.0 / rate if rate else 0.0
+        self._last = None
+
+    def ready(self, now=None):
+        """True nếu đã đến lúc cập nhật (và tính mốc thời gian từ lần này)"""
+        now = time.perf_counter() if now is None else now
+        if self._last is not None and now - self._last < self.interval:
+            return False
+        self._last = now
+        return True
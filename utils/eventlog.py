@@ -0,0 +1,231 @@
+import json
+import os
+import threading
+import time
+from pathlib import Path
+
+import numpy as np
+
+# Các bảng trong log và cột của từng bảng (tên cột -> dtype)
+TABLES = {
+    # Mỗi frame 1 dòng
+    'frames': {
+        'frame': np.int32,       # Chỉ số frame trong luồng
+        'stream': np.int16,      # ID luồng video
+        'time': np.float64,      # Thời điểm của frame trong luồng (giây từ frame đầu)
+        'processed': np.float64, # Thời điểm frame được xử lý (unix time, giây)
+        'keyframe': np.bool_,    # True nếu model được chạy trên frame này
+        'workers': np.uint16,    # Số worker
+        'unsafe': np.uint16,     # Số worker Unsafe
+    },
+    # Mỗi worker 1 dòng
+    'workers': {
+        'frame': np.int32,
+        'stream': np.int16,
+        'track_id': np.int32,    # -1 khi không bật theo dõi worker
+        'box': np.float32,       # (N, 4) xyxy theo frame gốc
+        'conf': np.float16,
+        'safe': np.bool_,
+        'items': np.uint16,      # Bitmask PPE đã gán cho worker: bit i = class id i
+    },
+    # Mỗi PPE item (kể cả nhãn no_*) 1 dòng
+    'items': {
+        'frame': np.int32,
+        'stream': np.int16,
+        'label': np.uint8,       # Class id (xem 'labels' trong meta.json)
+        'box': np.float32,
+        'conf': np.float16,
+    },
+}
+
+META_FILE = 'meta.json'
+CHUNK_PATTERN = 'chunk_{:06d}.npz'
+
+
+class DetectionLog:
+    """
+    Ghi detection, gán PPE và trạng thái Safe/Unsafe theo từng frame ra file dạng cột
+
+    Log là 1 thư mục gồm meta.json và các chunk .npz (mỗi chunk tối đa
+    `chunk_frames` frame). Trong chunk, mỗi cột là 1 mảng numpy riêng
+    ('workers.safe', 'items.label', ...), nên phần báo cáo chỉ cần đọc những cột
+    cần dùng (xem read_log). Chunk được ghi ra file tạm rồi đổi tên, nên log vẫn
+    đọc được nếu tiến trình dừng giữa chừng (mất tối đa 1 chunk).
+
+    Args:
+        path (str): Thư mục log (tạo mới nếu chưa có, chunk cũ bị xóa)
+        labels (dict): {class_id: label} dùng để mã hóa nhãn thành số
+        meta (dict): Thông tin thêm ghi vào meta.json (nguồn, model, ...)
+        fps (float | list): FPS của nguồn, hoặc list FPS theo ID luồng, để tính cột
+            'time' = frame / fps khi detection không có 'timestamp' (None = NaN)
+        chunk_frames (int): Số frame mỗi chunk
+        compress (bool): Nén chunk bằng zlib (nhỏ hơn nhiều, tốn thêm chút CPU mỗi chunk)
+    """
+
+    def __init__(self, path, labels, meta=None, chunk_frames=1024, compress=True, fps=None):
+        self.path = Path(path)
+        self.path.mkdir(parents=True, exist_ok=True)
+        for old in self.path.glob('chunk_*.npz'):
+            old.unlink()
+        self.label_ids = {label: class_id for class_id, label in labels.items()}
+        self.chunk_frames = max(int(chunk_frames), 1)
+        self.compress = compress
+        self.fps = list(fps) if isinstance(fps, (list, tuple)) else [fps]
+        self.frames_logged = 0
+        self.chunks = 0
+        self._lock = threading.Lock()
+        self._reset()
+
+        self.meta = {
+            'tables': {table: list(columns) for table, columns in TABLES.items()},
+            'labels': {int(k): v for k, v in labels.items()},
+            'created': time.time(),
+            'fps': self.fps[0],
+            'stream_fps': self.fps,
+            **(meta or {}),
+        }
+        self._write_meta()
+
+    def _reset(self):
+        self._frames = []
+        self._workers = []
+        self._items = []
+
+    def add(self, detection, workers, items, timestamp=None):
+        """
+        Ghi kết quả của 1 frame
+
+        Args:
+            detection (dict): Kết quả PPEDetector.predict() của frame (dùng 'frame',
+                'stream', 'keyframe', 'timestamp', 'processed')
+            workers (list): Worker từ PPEDetector.associate()
+            items (list): PPE item từ PPEDetector.associate()
+            timestamp (float): Thời điểm của frame trong luồng, giây (None = 'timestamp'
+                của detection, nếu không có thì frame / fps)
+        """
+        frame = detection.get('frame', self.frames_logged)
+        stream = detection.get('stream', 0)
+        if timestamp is None:
+            timestamp = detection.get('timestamp')
+        if timestamp is None:
+            fps = self.fps[stream] if stream < len(self.fps) else None
+            timestamp = frame / fps if fps else np.nan
+        processed = detection.get('processed') or time.time()
+        unsafe = sum(1 for worker in workers if not worker['safe'])
+
+        row = (frame, stream, timestamp, processed, detection.get('keyframe', True), len(workers), unsafe)
+        worker_rows = None
+        if workers:
+            worker_rows = (
+                [worker.get('track_id', -1) for worker in workers],
+                [worker['box'] for worker in workers],
+                [worker['conf'] for worker in workers],
+                [worker['safe'] for worker in workers],
+                [self._mask(worker['items']) for worker in workers],
+            )
+        item_rows = None
+        if items:
+            item_rows = (
+                [self.label_ids.get(item['label'], 255) for item in items],
+                [item['box'] for item in items],
+                [item['conf'] for item in items],
+            )
+
+        with self._lock:
+            self._frames.append(row)
+            if worker_rows is not None:
+                self._workers.append((frame, stream, worker_rows))
+            if item_rows is not None:
+                self._items.append((frame, stream, item_rows))
+            self.frames_logged += 1
+            if len(self._frames) >= self.chunk_frames:
+                self._flush()
+
+    def _mask(self, labels):
+        mask = 0
+        for label in labels:
+            class_id = self.label_ids.get(label)
+            if class_id is not None:
+                mask |= 1 << class_id
+        return mask
+
+    def _flush(self):
+        if not self._frames:
+            return
+        columns = {}
+        frames = list(zip(*self._frames))
+        for name, values in zip(TABLES['frames'], frames):
+            columns[f'frames.{name}'] = np.asarray(values, dtype=TABLES['frames'][name])
+
+        for table, rows in (('workers', self._workers), ('items', self._items)):
+            spec = TABLES[table]
+            counts = [len(values[0]) for _, _, values in rows]
+            columns[f'{table}.frame'] = np.repeat([frame for frame, _, _ in rows], counts).astype(spec['frame'])
+            columns[f'{table}.stream'] = np.repeat([stream for _, stream, _ in rows], counts).astype(spec['stream'])
+            names = [name for name in spec if name not in ('frame', 'stream')]
+            for i, name in enumerate(names):
+                values = [value for _, _, row in rows for value in row[i]]
+                shape = (0, 4) if name == 'box' else (0,)
+                columns[f'{table}.{name}'] = (np.asarray(values, dtype=spec[name]) if values
+                                              else np.zeros(shape, dtype=spec[name]))
+
+        target = self.path / CHUNK_PATTERN.format(self.chunks)
+        tmp = target.with_name(target.stem + '.tmp.npz')
+        (np.savez_compressed if self.compress else np.savez)(tmp, **columns)
+        os.replace(tmp, target)
+        self.chunks += 1
+        self._reset()
+
+    def _write_meta(self):
+        self.meta.update(frames=self.frames_logged, chunks=self.chunks)
+        tmp = self.path / (META_FILE + '.tmp')
+        with open(tmp, 'w', encoding='utf-8') as f:
+            json.dump(self.meta, f, ensure_ascii=False, indent=2)
+        os.replace(tmp, self.path / META_FILE)
+
+    def close(self):
+        """Ghi nốt chunk còn lại và cập nhật meta.json"""
+        with self._lock:
+            self._flush()
+            self._write_meta()
+
+    @property
+    def nbytes(self):
+        """Tổng dung lượng các file của log trên đĩa"""
+        return sum(p.stat().st_size for p in self.path.iterdir() if p.is_file())
+
+
+def read_meta(path):
+    with open(Path(path) / META_FILE, encoding='utf-8') as f:
+        meta = json.load(f)
+    meta['labels'] = {int(k): v for k, v in meta['labels'].items()}
+    return meta
+
+
+def read_log(path, table, columns=None):
+    """
+    Đọc 1 bảng của log, chỉ nạp các cột cần dùng từ từng chunk
+
+    Args:
+        path (str): Thư mục log
+        table (str): 'frames', 'workers' hoặc 'items'
+        columns (list): Các cột cần đọc (None = mọi cột của bảng)
+
+    Returns:
+        dict: {tên cột: mảng numpy nối từ mọi chunk}
+    """
+    if table not in TABLES:
+        raise ValueError(f"table phải là 1 trong {list(TABLES)}, nhận được: {table}")
+    columns = list(columns or TABLES[table])
+    parts = {name: [] for name in columns}
+    for chunk in sorted(Path(path).glob('chunk_*.npz')):
+        if '.tmp' in chunk.name:
+            continue
+        with np.load(chunk) as data:
+            for name in columns:
+                parts[name].append(data[f'{table}.{name}'])
+    return {
+        name: (np.concatenate(values) if values
+               else np.zeros((0, 4) if name == 'box' else 0, dtype=TABLES[table][name]))
+        for name, values in parts.items()
+    }
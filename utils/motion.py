@@ -0,0 +1,88 @@
+import cv2
+import numpy as np
+
+# Kích thước ảnh thu nhỏ dùng để so sánh frame
+SIGNATURE_SIZE = (64, 36)
+
+
+def frame_signature(frame, size=SIGNATURE_SIZE):
+    """Ảnh xám thu nhỏ của frame, dùng để đo thay đổi giữa các frame với chi phí thấp"""
+    small = cv2.resize(frame, size, interpolation=cv2.INTER_AREA)
+    if small.ndim == 3:
+        small = cv2.cvtColor(small, cv2.COLOR_BGR2GRAY)
+    return small.astype(np.int16)
+
+
+def frame_difference(sig_a, sig_b):
+    """Trung bình trị tuyệt đối chênh lệch (0-255) giữa 2 signature"""
+    if sig_a is None or sig_b is None:
+        return float('inf')
+    return float(np.abs(sig_a - sig_b).mean())
+
+
+class MotionGate:
+    """
+    Bỏ qua inference khi cảnh gần như không đổi (ví dụ camera nhìn bãi trống)
+
+    Điểm chuyển động được tính trên ảnh thu nhỏ nên rất rẻ so với 1 lần forward:
+        - 'diff': chênh lệch trung bình (0-255) so với frame của lần chạy model gần nhất
+        - 'mog2': % điểm ảnh foreground theo background subtraction (MOG2)
+    Sau max_skip lần bỏ qua liên tiếp, model luôn được chạy lại để kết quả
+    không bị cũ.
+
+    Args:
+        threshold (float): Điểm chuyển động tối thiểu để chạy model
+        max_skip (int): Số lần bỏ qua liên tiếp tối đa trước khi buộc chạy lại
+        method (str): 'diff' hoặc 'mog2'
+        size (tuple): Kích thước ảnh thu nhỏ (width, height)
+    """
+
+    METHODS = ('diff', 'mog2')
+
+    def __init__(self, threshold, max_skip=30, method='diff', size=SIGNATURE_SIZE):
+        if method not in self.METHODS:
+            raise ValueError(f"method phải là một trong {self.METHODS}, nhận được: {method}")
+        self.threshold = threshold
+        self.max_skip = max_skip
+        self.method = method
+        self.size = size
+        self.reference = None
+        self.consecutive = 0
+        self.skipped = 0
+        self.forced = 0
+        self.last_score = None
+        self._subtractor = None
+        if method == 'mog2':
+            self._subtractor = cv2.createBackgroundSubtractorMOG2(history=200, detectShadows=False)
+
+    def _score(self, frame, signature):
+        signature = frame_signature(frame, self.size) if signature is None else signature
+        if self._subtractor is not None:
+            mask = self._subtractor.apply(signature.astype(np.uint8))
+            return float(np.count_nonzero(mask)) * 100 / mask.size, signature
+        return frame_difference(signature, self.reference), signature
+
+    def should_run(self, frame, signature=None):
+        """
+        Quyết định có chạy model cho frame này không
+
+        Args:
+            frame (np.ndarray): Frame BGR
+            signature (np.ndarray): frame_signature() đã tính sẵn (nếu có)
+
+        Returns:
+            bool: True nếu cần chạy model, False nếu dùng lại detection trước
+        """
+        score, signature = self._score(frame, signature)
+        self.last_score = score
+        # MOG2 cần vài frame để học nền nên frame đầu luôn chạy model
+        first = self.reference is None
+        if not first and score < self.threshold:
+            if self.consecutive < self.max_skip:
+                self.consecutive += 1
+                self.skipped += 1
+                return False
+            self.forced += 1
+        self.consecutive = 0
+        self.reference = signature
+        return True
@@ -0,0 +1,223 @@
+import queue
+import threading
+import time
+from collections import deque
+
+# Chính sách khi hàng đợi đầy
+BLOCK = 'block'              # Chờ đến khi có chỗ (video file: không mất frame)
+DROP_OLDEST = 'drop_oldest'  # Bỏ frame cũ nhất (camera trực tiếp: luôn lấy frame mới)
+
+# Đánh dấu kết thúc luồng dữ liệu
+_END = object()
+
+
+class FrameQueue:
+    """Hàng đợi có giới hạn với chính sách backpressure"""
+
+    def __init__(self, maxsize, policy=BLOCK):
+        if policy not in (BLOCK, DROP_OLDEST):
+            raise ValueError(f"Chính sách không hợp lệ: {policy}")
+        self._queue = queue.Queue(maxsize=max(int(maxsize), 1))
+        self.policy = policy
+        self.dropped = 0
+
+    def put(self, item, stop_event):
+        """Đưa item vào hàng đợi; trả về False nếu pipeline đã dừng"""
+        if self.policy == DROP_OLDEST and item is not _END:
+            while not stop_event.is_set():
+                try:
+                    self._queue.put_nowait(item)
+                    return True
+                except queue.Full:
+                    try:
+                        oldest = self._queue.get_nowait()
+                    except queue.Empty:
+                        continue
+                    if oldest is _END:
+                        # Không bao giờ bỏ dấu kết thúc
+                        self._queue.put_nowait(oldest)
+                        return False
+                    self.dropped += 1
+            return False
+
+        while not stop_event.is_set():
+            try:
+                self._queue.put(item, timeout=0.05)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def get_nowait(self):
+        """Lấy 1 item nếu có sẵn, ngược lại trả về None"""
+        try:
+            return self._queue.get_nowait()
+        except queue.Empty:
+            return None
+
+    def get(self, stop_event, timeout=None):
+        """
+        Lấy 1 item; trả về _END khi pipeline dừng
+
+        Args:
+            timeout (float): Thời gian chờ tối đa; hết giờ trả về None
+        """
+        deadline = None if timeout is None else time.time() + timeout
+        while not stop_event.is_set():
+            wait = 0.05 if deadline is None else min(0.05, deadline - time.time())
+            if wait <= 0:
+                return None
+            try:
+                return self._queue.get(timeout=wait)
+            except queue.Empty:
+                continue
+        return _END
+
+
+class Stage:
+    """
+    Một bước xử lý trong pipeline, chạy trên thread riêng
+
+    Args:
+        fn (callable): Nhận list item, trả về list kết quả (cùng thứ tự)
+        name (str): Tên stage (dùng cho thread / thông báo lỗi)
+        batch_size (int): Số item tối đa gom cho 1 lần gọi fn
+        max_latency (float): Thời gian tối đa (giây) chờ gom đủ lô
+    """
+
+    def __init__(self, fn, name, batch_size=1, max_latency=0.0):
+        self.fn = fn
+        self.name = name
+        self.batch_size = max(int(batch_size), 1)
+        self.max_latency = max_latency
+
+    def _collect(self, inbox, stop_event):
+        """Gom 1 lô item từ inbox; trả về (batch, kết thúc chưa)"""
+        item = inbox.get(stop_event)
+        if item is _END:
+            return [], True
+
+        batch = [item]
+        deadline = time.time() + self.max_latency
+        while len(batch) < self.batch_size:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                break
+            item = inbox.get(stop_event, timeout=remaining)
+            if item is None:
+                break
+            if item is _END:
+                return batch, True
+            batch.append(item)
+        return batch, False
+
+
+class Pipeline:
+    """
+    Chạy đọc frame và các stage song song, nối với nhau bằng hàng đợi có giới hạn
+
+    Chính sách backpressure áp dụng cho hàng đợi đầu vào (sau bước đọc) và
+    hàng đợi đầu ra (trước consumer); các hàng đợi giữa các stage luôn chờ
+    để không phí công xử lý frame đã qua inference.
+
+    Args:
+        read_fn (callable): Trả về item tiếp theo, hoặc None khi hết dữ liệu
+        stages (list): Danh sách Stage theo thứ tự
+        queue_size (int): Kích thước mỗi hàng đợi
+        policy (str): BLOCK hoặc DROP_OLDEST
+    """
+
+    def __init__(self, read_fn, stages, queue_size=4, policy=BLOCK):
+        self.read_fn = read_fn
+        self.stages = stages
+        self.queues = [FrameQueue(queue_size, policy)]
+        self.queues += [FrameQueue(queue_size, BLOCK) for _ in stages[:-1]]
+        self.queues.append(FrameQueue(queue_size, policy))
+        self.stop_event = threading.Event()
+        self.threads = []
+        self.error = None
+
+    @property
+    def dropped(self):
+        """Tổng số frame đã bị bỏ do hàng đợi đầy"""
+        return sum(q.dropped for q in self.queues)
+
+    def _fail(self, name, exc):
+        if self.error is None:
+            self.error = (name, exc)
+        self.stop_event.set()
+
+    def _read_loop(self):
+        outbox = self.queues[0]
+        try:
+            while not self.stop_event.is_set():
+                item = self.read_fn()
+                if item is None:
+                    break
+                outbox.put(item, self.stop_event)
+        except Exception as e:
+            self._fail('read', e)
+        finally:
+            outbox.put(_END, self.stop_event)
+
+    def _stage_loop(self, stage, inbox, outbox):
+        try:
+            done = False
+            while not done and not self.stop_event.is_set():
+                batch, done = stage._collect(inbox, self.stop_event)
+                if not batch:
+                    continue
+                for result in stage.fn(batch):
+                    if not outbox.put(result, self.stop_event):
+                        break
+        except Exception as e:
+            self._fail(stage.name, e)
+        finally:
+            outbox.put(_END, self.stop_event)
+
+    def start(self):
+        self.threads.append(threading.Thread(target=self._read_loop, name='read', daemon=True))
+        for i, stage in enumerate(self.stages):
+            self.threads.append(threading.Thread(
+                target=self._stage_loop,
+                args=(stage, self.queues[i], self.queues[i + 1]),
+                name=stage.name,
+                daemon=True
+            ))
+        for thread in self.threads:
+            thread.start()
+
+    def stop(self, timeout=2.0):
+        """Dừng toàn bộ thread và chờ chúng kết thúc"""
+        self.stop_event.set()
+        for thread in self.threads:
+            thread.join(timeout=timeout)
+
+    def __iter__(self):
+        """Yield kết quả của stage cuối theo đúng thứ tự, dừng pipeline khi consumer dừng"""
+        self.start()
+        try:
+            outbox = self.queues[-1]
+            while True:
+                item = outbox.get(self.stop_event)
+                if item is _END:
+                    break
+                yield item
+        finally:
+            self.stop()
+
+        if self.error is not None:
+            name, exc = self.error
+            raise RuntimeError(f"Lỗi ở stage '{name}': {exc}") from exc
+
+
+class RateMeter:
+    """Đo FPS theo cửa sổ trượt các mốc thời gian gần nhất"""
+
+    def __init__(self, window=30):
+        self.timestamps = deque(maxlen=window)
+
+    def tick(self):
+        self.timestamps.append(time.time())
+        span = self.timestamps[-1] - self.timestamps[0]
+        return (len(self.timestamps) - 1) / span if span > 0 else 0
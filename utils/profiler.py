@@ -0,0 +1,96 @@
+import json
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+
+import numpy as np
+
+# Các stage của pipeline detection theo thứ tự
+STAGES = (
+    'decode',
+    'preprocess',
+    'forward',
+    'postprocess',
+    'association',
+    'annotation',
+    'encode',
+    'display',
+)
+
+
+class StageProfiler:
+    """
+    Đo thời gian từng stage với cửa sổ trượt để tính p50 / p95 / p99
+
+    Mỗi lần ghi chỉ là 1 lần append vào deque nên có thể bật thường trực.
+    Percentile chỉ được tính khi gọi summary().
+
+    Args:
+        window (int): Số mẫu gần nhất giữ lại cho mỗi stage
+        jsonl_path (str): Nếu có, định kỳ ghi summary ra file dạng JSON lines
+        dump_interval (float): Khoảng thời gian (giây) giữa 2 lần ghi JSON lines
+    """
+
+    def __init__(self, window=512, jsonl_path=None, dump_interval=1.0):
+        self.window = window
+        self.samples = {name: deque(maxlen=window) for name in STAGES}
+        self.counts = dict.fromkeys(STAGES, 0)
+        self.jsonl_path = jsonl_path
+        self.dump_interval = dump_interval
+        self._last_dump = time.time()
+        self._dump_lock = threading.Lock()
+
+    def record(self, name, seconds, count=1):
+        """Ghi thời gian (giây) của 1 stage; count > 1 khi đo cho cả lô"""
+        if name not in self.samples:
+            self.samples[name] = deque(maxlen=self.window)
+            self.counts[name] = 0
+        self.samples[name].extend([seconds / count] * count)
+        self.counts[name] += count
+
+    @contextmanager
+    def stage(self, name, count=1):
+        """Đo thời gian khối lệnh: with profiler.stage('forward'): ..."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(name, time.perf_counter() - start, count)
+
+    def summary(self):
+        """
+        Thống kê các stage đã có mẫu
+
+        Returns:
+            dict: {stage: {'count', 'mean_ms', 'p50_ms', 'p95_ms', 'p99_ms'}}
+        """
+        stats = {}
+        for name, samples in list(self.samples.items()):
+            if not samples:
+                continue
+            values = np.fromiter(list(samples), dtype=np.float64) * 1000
+            p50, p95, p99 = np.percentile(values, [50, 95, 99])
+            stats[name] = {
+                'count': self.counts[name],
+                'mean_ms': float(values.mean()),
+                'p50_ms': float(p50),
+                'p95_ms': float(p95),
+                'p99_ms': float(p99),
+            }
+        return stats
+
+    def maybe_dump(self):
+        """Ghi summary ra JSON lines nếu đã đến kỳ"""
+        if not self.jsonl_path or time.time() - self._last_dump < self.dump_interval:
+            return
+        with self._dump_lock:
+            self._last_dump = time.time()
+            line = json.dumps({'time': self._last_dump, 'stages': self.summary()})
+            with open(self.jsonl_path, 'a', encoding='utf-8') as f:
+                f.write(line + '\n')
+
+    def reset(self):
+        for name in self.samples:
+            self.samples[name].clear()
+            self.counts[name] = 0
@@ -0,0 +1,156 @@
+from collections import OrderedDict
+
+import cv2
+import numpy as np
+
+from utils.processor import get_color
+
+# Thứ tự kênh màu của frame đầu ra
+BGR = 'bgr'
+RGB = 'rgb'
+
+# Kiểu chữ giống cách vẽ cũ bằng cv2.putText
+ITEM_FONT = (cv2.FONT_HERSHEY_SIMPLEX, 0.4, 1)
+WORKER_FONT = (cv2.FONT_HERSHEY_SIMPLEX, 0.6, 2)
+MISSING_FONT = (cv2.FONT_HERSHEY_SIMPLEX, 0.4, 1)
+
+SAFE_COLOR = (0, 255, 0)
+UNSAFE_COLOR = (0, 0, 255)
+
+
+class _Sprite:
+    """
+    Chữ đã raster hóa sẵn bằng cv2.putText: ảnh màu + mask, vẽ bằng 1 lần cv2.copyTo
+
+    Chỉ dùng được khi putText không khử răng cưa (OpenCV 4.x); nếu mask có
+    điểm bán trong suốt thì patch = None và chữ được vẽ lại bằng putText.
+    """
+
+    __slots__ = ('text', 'font', 'color', 'patch', 'mask', 'dx', 'dy')
+
+    def __init__(self, text, font, color):
+        self.text = text
+        self.font = font
+        self.color = color
+        face, scale, thickness = font
+        (width, height), baseline = cv2.getTextSize(text, face, scale, thickness)
+        pad = thickness + 1
+        canvas = np.zeros((height + baseline + 2 * pad, width + 2 * pad), dtype=np.uint8)
+        cv2.putText(canvas, text, (pad, height + pad), face, scale, 255, thickness)
+        # Độ lệch từ điểm gốc (góc dưới trái của chữ) tới góc trên trái của patch
+        self.dx = -pad
+        self.dy = -(height + pad)
+        if np.isin(canvas, (0, 255)).all():
+            self.mask = canvas
+            self.patch = np.zeros((*canvas.shape, 3), dtype=np.uint8)
+            self.patch[canvas > 0] = color
+        else:
+            self.mask = self.patch = None
+
+
+class Renderer:
+    """
+    Vẽ kết quả PPE lên frame mà không cấp phát bộ nhớ mới cho mỗi frame
+
+    Chữ của từng nhãn được raster hóa 1 lần rồi cache lại (LRU), mỗi lần vẽ
+    chỉ copy patch đã tính sẵn qua mask. Khi cần RGB (Streamlit), frame
+    được chuyển màu 1 lần trước khi vẽ và vẽ thẳng bằng màu RGB, nên phía sau
+    không cần thêm bản sao cvtColor nào nữa.
+
+    Args:
+        color_order (str): Thứ tự kênh màu của frame đầu ra: 'bgr' hoặc 'rgb'
+        enabled (bool): False = không vẽ gì (chạy headless / chỉ lấy kết quả)
+        max_sprites (int): Số nhãn tối đa giữ trong cache
+    """
+
+    def __init__(self, color_order=BGR, enabled=True, max_sprites=4096):
+        if color_order not in (BGR, RGB):
+            raise ValueError(f"color_order phải là '{BGR}' hoặc '{RGB}', nhận được: {color_order}")
+        self.color_order = color_order
+        self.enabled = enabled
+        self.max_sprites = max_sprites
+        self._sprites = OrderedDict()
+        self._colors = {}
+
+    def _color(self, bgr):
+        """Màu (BGR) theo thứ tự kênh của frame đầu ra"""
+        color = self._colors.get(bgr)
+        if color is None:
+            color = bgr[::-1] if self.color_order == RGB else bgr
+            self._colors[bgr] = color
+        return color
+
+    def _sprite(self, key, make_text, font, color):
+        sprite = self._sprites.get(key)
+        if sprite is None:
+            sprite = _Sprite(make_text(), font, color)
+            self._sprites[key] = sprite
+            if len(self._sprites) > self.max_sprites:
+                self._sprites.popitem(last=False)
+        else:
+            self._sprites.move_to_end(key)
+        return sprite
+
+    def _blit(self, frame, sprite, origin):
+        x0, y0 = origin[0] + sprite.dx, origin[1] + sprite.dy
+        if sprite.patch is not None:
+            height, width = sprite.mask.shape
+            if x0 >= 0 and y0 >= 0 and x0 + width <= frame.shape[1] and y0 + height <= frame.shape[0]:
+                cv2.copyTo(sprite.patch, sprite.mask, frame[y0:y0 + height, x0:x0 + width])
+                return
+        # Chữ tràn ra ngoài frame (OpenCV cắt nét trước khi raster) hoặc có khử răng cưa
+        face, scale, thickness = sprite.font
+        cv2.putText(frame, sprite.text, origin, face, scale, sprite.color, thickness)
+
+    def draw(self, frame, workers, items, required_items):
+        """
+        Vẽ PPE items và workers (Safe/Unsafe) trực tiếp lên frame
+
+        Args:
+            frame (np.ndarray): Frame BGR vừa đọc; với 'bgr' thì được vẽ trực tiếp lên đó
+            workers (list): Worker từ PPEDetector.associate()
+            items (list): PPE item từ PPEDetector.associate()
+            required_items (list): Các PPE bắt buộc (để ghi phần còn thiếu)
+
+        Returns:
+            np.ndarray: Frame đã vẽ theo thứ tự kênh color_order (với 'rgb' là
+                mảng mới từ lần chuyển màu duy nhất, vẽ thẳng bằng màu RGB)
+        """
+        if self.color_order == RGB:
+            frame = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
+        if not self.enabled:
+            return frame
+
+        # Vẽ PPE items trước
+        for item in items:
+            x1, y1, x2, y2 = map(int, item['box'])
+            color = self._color(get_color(item['label']))
+            cv2.rectangle(frame, (x1, y1), (x2, y2), color, 1)
+            label, conf = item['label'], round(float(item['conf']), 2)
+            sprite = self._sprite(('item', label, conf), lambda: f"{label} {conf:.2f}", ITEM_FONT, color)
+            self._blit(frame, sprite, (x1, y1 - 8))
+
+        # Vẽ workers: Safe xanh lá, Unsafe đỏ
+        for worker in workers:
+            x1, y1, x2, y2 = map(int, worker['box'])
+            safe = worker['safe']
+            color = self._color(SAFE_COLOR if safe else UNSAFE_COLOR)
+            cv2.rectangle(frame, (x1, y1), (x2, y2), color, 2)
+
+            status = 'Safe' if safe else 'Unsafe'
+            track_id, conf = worker.get('track_id'), round(float(worker['conf']), 2)
+            if track_id is not None:
+                make_text = lambda: f"Worker #{track_id} ({status}) {conf:.2f}"  # noqa: E731
+            else:
+                make_text = lambda: f"Worker ({status}) {conf:.2f}"  # noqa: E731
+            sprite = self._sprite(('worker', track_id, status, conf), make_text, WORKER_FONT, color)
+            self._blit(frame, sprite, (x1, y1 - 8))
+
+            # Hiển thị missing items nếu unsafe
+            if not safe:
+                missing = frozenset(required_items) - worker['items']
+                sprite = self._sprite(('missing', missing), lambda: f"Missing: {', '.join(missing)}",
+                                      MISSING_FONT, self._color(UNSAFE_COLOR))
+                self._blit(frame, sprite, (x1, y2 + 20))
+
+        return frame
@@ -0,0 +1,123 @@
+import threading
+import time
+
+from utils.pipeline import FrameQueue, BLOCK, DROP_OLDEST, _END
+
+# Chính sách chia lượt giữa các nguồn
+ROUND_ROBIN = 'round_robin'  # Lần lượt từng nguồn
+DEADLINE = 'deadline'        # Frame chờ lâu nhất được xử lý trước
+
+
+class MultiSourceScheduler:
+    """
+    Đọc frame từ nhiều nguồn song song và gom thành các lô inference chung
+
+    Mỗi nguồn có 1 thread đọc và 1 hàng đợi riêng (nguồn trực tiếp bỏ frame cũ,
+    file thì chờ). Scheduler lấy frame từ đầu các hàng đợi theo chính sách
+    công bằng đã chọn và yield từng lô [(source_id, frame, timestamp), ...].
+
+    Args:
+        read_fns (list): Mỗi phần tử là hàm trả về frame tiếp theo hoặc None khi hết
+        live (list): Cờ nguồn trực tiếp tương ứng với read_fns
+        batch_size (int): Số frame tối đa mỗi lô
+        max_latency (float): Thời gian tối đa (giây) chờ gom đủ lô
+        policy (str): ROUND_ROBIN hoặc DEADLINE
+        queue_size (int): Kích thước hàng đợi mỗi nguồn
+    """
+
+    def __init__(self, read_fns, live, batch_size=None, max_latency=0.05,
+                 policy=ROUND_ROBIN, queue_size=2):
+        if policy not in (ROUND_ROBIN, DEADLINE):
+            raise ValueError(f"Chính sách không hợp lệ: {policy}")
+        self.read_fns = read_fns
+        self.batch_size = max(int(batch_size or len(read_fns)), 1)
+        self.max_latency = max_latency
+        self.policy = policy
+        self.queues = [FrameQueue(queue_size, DROP_OLDEST if is_live else BLOCK) for is_live in live]
+        self.heads = [None] * len(read_fns)
+        self.ended = [False] * len(read_fns)
+        self.stop_event = threading.Event()
+        self.threads = []
+        self.errors = {}
+        self._next = 0
+
+    @property
+    def dropped(self):
+        """Số frame bị bỏ của từng nguồn"""
+        return [q.dropped for q in self.queues]
+
+    def _read_loop(self, source_id):
+        read_fn, outbox = self.read_fns[source_id], self.queues[source_id]
+        try:
+            while not self.stop_event.is_set():
+                frame = read_fn()
+                if frame is None:
+                    break
+                outbox.put((frame, time.time()), self.stop_event)
+        except Exception as e:
+            self.errors[source_id] = e
+        finally:
+            outbox.put(_END, self.stop_event)
+
+    def _fill_heads(self):
+        for i, q in enumerate(self.queues):
+            if self.heads[i] is None and not self.ended[i]:
+                item = q.get_nowait()
+                if item is _END:
+                    self.ended[i] = True
+                else:
+                    self.heads[i] = item
+
+    def _pick(self):
+        """Chọn 1 frame theo chính sách; trả về (source_id, frame, timestamp) hoặc None"""
+        self._fill_heads()
+        ready = [i for i, head in enumerate(self.heads) if head is not None]
+        if not ready:
+            return None
+
+        if self.policy == DEADLINE:
+            source_id = min(ready, key=lambda i: self.heads[i][1])
+        else:
+            n = len(self.heads)
+            source_id = min(ready, key=lambda i: (i - self._next) % n)
+            self._next = (source_id + 1) % n
+
+        frame, timestamp = self.heads[source_id]
+        self.heads[source_id] = None
+        return source_id, frame, timestamp
+
+    def _finished(self):
+        return all(self.ended) and all(head is None for head in self.heads)
+
+    def start(self):
+        for i in range(len(self.read_fns)):
+            thread = threading.Thread(target=self._read_loop, args=(i,), name=f'source-{i}', daemon=True)
+            self.threads.append(thread)
+            thread.start()
+
+    def stop(self, timeout=2.0):
+        self.stop_event.set()
+        for thread in self.threads:
+            thread.join(timeout=timeout)
+
+    def __iter__(self):
+        self.start()
+        try:
+            while not self._finished():
+                batch = []
+                deadline = None
+                while len(batch) < self.batch_size:
+                    picked = self._pick()
+                    if picked is not None:
+                        batch.append(picked)
+                        if deadline is None:
+                            deadline = time.time() + self.max_latency
+                        continue
+                    if self._finished() or (batch and time.time() >= deadline):
+                        break
+                    time.sleep(0.002)
+                if batch:
+                    yield batch
+        finally:
+            self.stop()
+
@@ -0,0 +1,257 @@
+import numpy as np
+
+from utils.caculator import inside_matrix, iou_matrix
+
+
+def match_boxes(iou, threshold):
+    """
+    Ghép cặp tham lam theo IoU giảm dần
+
+    Args:
+        iou (np.ndarray): (M, N) ma trận IoU
+        threshold (float): IoU tối thiểu để ghép
+
+    Returns:
+        list: Các cặp (i, j) đã ghép
+    """
+    if iou.size == 0:
+        return []
+    rows, cols = np.nonzero(iou >= threshold)
+    order = np.argsort(-iou[rows, cols], kind='stable')
+    used_rows, used_cols, pairs = set(), set(), []
+    for k in order:
+        i, j = rows[k], cols[k]
+        if i in used_rows or j in used_cols:
+            continue
+        used_rows.add(i)
+        used_cols.add(j)
+        pairs.append((int(i), int(j)))
+    return pairs
+
+
+class BoxPropagator:
+    """
+    Nội suy box giữa các keyframe bằng mô hình vận tốc không đổi
+
+    Ở mỗi keyframe, detection được ghép với keyframe trước (cùng lớp, theo IoU)
+    để ước lượng vận tốc từng box (pixel/frame). Ở các frame giữa 2 keyframe,
+    box được dịch theo vận tốc đó.
+
+    Args:
+        iou_threshold (float): IoU tối thiểu để coi 2 box là cùng 1 đối tượng
+    """
+
+    def __init__(self, iou_threshold=0.3):
+        self.iou_threshold = iou_threshold
+        self.detection = None
+        self.frame_index = None
+        self.velocity = None
+
+    def update(self, detection, frame_index):
+        """Ghi nhận detection của keyframe mới và cập nhật vận tốc"""
+        boxes = detection['boxes']
+        velocity = np.zeros_like(boxes, dtype=np.float32)
+
+        if self.detection is not None and len(boxes) and len(self.detection['boxes']):
+            gap = max(frame_index - self.frame_index, 1)
+            prev_boxes = self.detection['boxes']
+            iou = iou_matrix(boxes, prev_boxes)
+            # Chỉ ghép các box cùng lớp
+            same_class = detection['class_ids'][:, None] == self.detection['class_ids'][None, :]
+            for i, j in match_boxes(np.where(same_class, iou, 0), self.iou_threshold):
+                velocity[i] = (boxes[i] - prev_boxes[j]) / gap
+
+        self.detection = detection
+        self.frame_index = frame_index
+        self.velocity = velocity
+
+    def propagate(self, frame_index, frame_shape=None):
+        """
+        Dự đoán detection cho 1 frame không phải keyframe
+
+        Returns:
+            dict: Detection cùng định dạng PPEDetector.predict() với box đã dịch
+        """
+        steps = frame_index - self.frame_index
+        boxes = self.detection['boxes'] + self.velocity * steps
+        if frame_shape is not None:
+            height, width = frame_shape[:2]
+            boxes[:, [0, 2]] = np.clip(boxes[:, [0, 2]], 0, width)
+            boxes[:, [1, 3]] = np.clip(boxes[:, [1, 3]], 0, height)
+        return {**self.detection, 'boxes': boxes.astype(self.detection['boxes'].dtype, copy=False)}
+
+    def hold(self, frame_index, frame_shape=None):
+        """
+        Giữ nguyên detection khi cảnh đứng yên: box hiện tại thành mốc mới, vận tốc = 0
+
+        Returns:
+            dict: Detection dùng lại cho frame_index
+        """
+        detection = self.propagate(frame_index, frame_shape)
+        self.detection = detection
+        self.frame_index = frame_index
+        self.velocity = np.zeros_like(detection['boxes'], dtype=np.float32)
+        return detection
+
+
+class Track:
+    """1 worker được theo dõi qua nhiều frame"""
+
+    def __init__(self, track_id, box):
+        self.track_id = track_id
+        self.box = box
+        self.evidence = {}      # label -> điểm có mặt đã làm mượt (0-1)
+        self.items = set()      # các PPE được coi là đang mang (sau làm mượt)
+        self.raw_items = set()  # kết quả gán PPE lần gần nhất
+        self.assoc_box = None   # box tại lần gán PPE gần nhất
+        self.safe = None
+        self.violations = 0     # số lần chuyển sang Unsafe
+        self.missed = 0
+        self.hits = 0
+
+
+class WorkerTracker:
+    """
+    Theo dõi worker qua các frame với ID ổn định và trạng thái PPE được làm mượt
+
+    Worker được ghép với track theo IoU. Việc gán PPE chỉ được tính lại cho
+    track đã di chuyển đáng kể hoặc có PPE item xuất hiện / biến mất / di chuyển
+    ở gần; các track còn lại dùng kết quả đã cache. Mỗi PPE có điểm có mặt làm mượt
+    theo EMA nên trạng thái Safe/Unsafe không nhấp nháy theo từng frame.
+
+    Args:
+        is_safe (callable): Nhận tập PPE đang mang, trả về True nếu Safe
+        assign_fn (callable): assign_items(item_boxes, worker_boxes) -> (ratios, mask)
+        iou_threshold (float): IoU tối thiểu để ghép worker với track
+        max_missed (int): Số frame liên tiếp không thấy trước khi xóa track
+        smoothing (float): Hệ số EMA cho điểm có mặt của PPE (1 = không làm mượt)
+        move_iou (float): Worker / item có IoU với box lúc gán PPE trước dưới ngưỡng
+            này thì được coi là đã di chuyển và phải gán lại
+    """
+
+    def __init__(self, is_safe, assign_fn, iou_threshold=0.3, max_missed=15, smoothing=0.4,
+                 move_iou=0.7):
+        self.is_safe = is_safe
+        self.assign_fn = assign_fn
+        self.iou_threshold = iou_threshold
+        self.max_missed = max_missed
+        self.smoothing = smoothing
+        self.move_iou = move_iou
+        self.tracks = []
+        self.next_id = 1
+        self.violators = set()
+        self.violations = 0
+        self.reassociated = 0
+        self._item_refs = {}    # label -> box tham chiếu của các PPE item
+
+    def _changed_regions(self, item_boxes, item_labels):
+        """
+        Vùng (xyxy) của các item mới xuất hiện, biến mất hoặc đã dịch chuyển
+
+        Mỗi item được so với box tham chiếu cùng label (IoU >= move_iou) nên
+        dao động nhỏ của detection không bị coi là thay đổi.
+        """
+        boxes = np.asarray(item_boxes, dtype=np.float32).reshape(-1, 4)
+        labels = np.asarray(item_labels, dtype=object)
+        refs, changed = [], []
+        for label in set(item_labels) | set(self._item_refs):
+            current = boxes[labels == label] if len(labels) else boxes
+            previous = self._item_refs.get(label, np.zeros((0, 4), dtype=np.float32))
+            pairs = match_boxes(iou_matrix(current, previous), self.move_iou)
+            kept_cur = {i for i, _ in pairs}
+            kept_prev = {j for _, j in pairs}
+            # Item vẫn ở chỗ cũ giữ box tham chiếu cũ để không bị trôi dần
+            kept = previous[sorted(kept_prev)]
+            new = current[[i for i in range(len(current)) if i not in kept_cur]]
+            gone = previous[[j for j in range(len(previous)) if j not in kept_prev]]
+            refs.append((label, np.concatenate([kept, new])))
+            changed += [new, gone]
+        self._item_refs = {label: ref for label, ref in refs if len(ref)}
+        return np.concatenate(changed) if changed else np.zeros((0, 4), dtype=np.float32)
+
+    def update(self, worker_boxes, item_boxes, item_labels):
+        """
+        Cập nhật track với worker và PPE item (chỉ các PPE cần kiểm tra) của frame mới
+
+        Args:
+            worker_boxes (list): Box các worker trong frame
+            item_boxes (list): Box các PPE item cần kiểm tra
+            item_labels (list): Label tương ứng với item_boxes
+
+        Returns:
+            list: Track tương ứng với từng worker_boxes
+        """
+        boxes = np.asarray(worker_boxes, dtype=np.float32).reshape(-1, 4)
+        track_boxes = np.array([t.box for t in self.tracks], dtype=np.float32).reshape(-1, 4)
+
+        matched = [None] * len(boxes)
+        for i, j in match_boxes(iou_matrix(boxes, track_boxes), self.iou_threshold):
+            matched[i] = self.tracks[j]
+
+        seen = {id(t) for t in matched if t is not None}
+        for track in self.tracks:
+            if id(track) not in seen:
+                track.missed += 1
+        self.tracks = [t for t in self.tracks if t.missed <= self.max_missed]
+
+        for i, track in enumerate(matched):
+            if track is None:
+                track = Track(self.next_id, boxes[i])
+                self.next_id += 1
+                self.tracks.append(track)
+                matched[i] = track
+            track.box = boxes[i]
+            track.missed = 0
+            track.hits += 1
+
+        # Chỉ gán lại PPE cho track mới, đã di chuyển, hoặc có item thay đổi ở gần
+        regions = self._changed_regions(item_boxes, item_labels)
+        dirty = [t for t in matched if t.assoc_box is None]
+        cached = [t for t in matched if t.assoc_box is not None]
+        if cached:
+            cached_boxes = [t.box for t in cached]
+            stale = np.diag(iou_matrix(cached_boxes, [t.assoc_box for t in cached])) < self.move_iou
+            if len(regions):
+                stale |= (inside_matrix(regions, cached_boxes) > 0).any(axis=0)
+            dirty += [t for t, is_stale in zip(cached, stale) if is_stale]
+        if dirty:
+            self.reassociated += len(dirty)
+            if len(item_boxes):
+                _, mask = self.assign_fn(item_boxes, [t.box for t in dirty])
+            else:
+                mask = np.zeros((0, len(dirty)), dtype=bool)
+            for k, track in enumerate(dirty):
+                track.raw_items = {item_labels[i] for i in np.nonzero(mask[:, k])[0]}
+                track.assoc_box = track.box
+
+        for track in matched:
+            self._smooth(track)
+        return matched
+
+    def _smooth(self, track):
+        labels = set(track.evidence) | track.raw_items
+        for label in labels:
+            present = 1.0 if label in track.raw_items else 0.0
+            if track.hits == 1:
+                track.evidence[label] = present
+            else:
+                previous = track.evidence.get(label, 0.0)
+                track.evidence[label] = previous + self.smoothing * (present - previous)
+        track.items = {label for label, score in track.evidence.items() if score >= 0.5}
+
+        safe = self.is_safe(track.items)
+        if not safe and track.safe is not False:
+            track.violations += 1
+            self.violations += 1
+            self.violators.add(track.track_id)
+        track.safe = safe
+
+    def summary(self):
+        """Thống kê theo người: số track đang theo dõi, tổng số và số người từng vi phạm"""
+        return {
+            'active_tracks': sum(1 for t in self.tracks if t.missed == 0),
+            'total_tracks': self.next_id - 1,
+            'violators': len(self.violators),
+            'violations': self.violations,
+            'reassociated': self.reassociated,
+        }
@@ -0,0 +1,211 @@
+import hashlib
+import io
+import os
+import tempfile
+import threading
+from collections import Counter, OrderedDict
+from pathlib import Path
+
+# Kích thước mỗi lần đọc / ghi khi copy file upload
+CHUNK_SIZE = 1024 * 1024
+
+# Thư mục cache và số file tối đa được giữ lại
+UPLOAD_CACHE_DIR = Path(tempfile.gettempdir()) / 'ppe_uploads'
+UPLOAD_CACHE_MAX_FILES = 8
+
+# Tiền tố file tạm đang ghi trong thư mục cache (không bị dọn)
+PARTIAL_PREFIX = '.partial-'
+
+# file_id của Streamlit -> đường dẫn đã cache (tránh cả việc hash lại khi rerun),
+# LRU tối đa UPLOAD_CACHE_MAX_FILES mục; mục có file bị _prune xóa cũng bị bỏ
+_cached_ids = OrderedDict()
+_ids_lock = threading.Lock()
+
+# File cache đang được giữ (đã trả về nhưng chưa mở xong), không bị _prune xóa
+_pinned = Counter()
+_pin_lock = threading.Lock()
+
+
+def local_path(source):
+    """
+    Trả về đường dẫn file trên ổ đĩa nếu source đã là file cục bộ, ngược lại None
+
+    Hỗ trợ str / os.PathLike và file object mở từ ổ đĩa. File object chỉ được
+    coi là cục bộ khi fileno() dùng được và .name trỏ đúng vào file đang mở
+    (cùng inode): UploadedFile của Streamlit là io.BytesIO, có .name là tên file
+    upload nhưng không phải file trên đĩa, không được nhầm với file trùng tên
+    trong thư mục hiện tại.
+    """
+    if isinstance(source, (str, os.PathLike)):
+        path = Path(source)
+        return str(path) if path.is_file() else None
+    name = getattr(source, 'name', None)
+    if not isinstance(name, str) or isinstance(source, io.BytesIO):
+        return None
+    try:
+        opened = os.fstat(source.fileno())
+        on_disk = os.stat(name)
+    except (AttributeError, OSError, ValueError):
+        return None
+    if (opened.st_dev, opened.st_ino) != (on_disk.st_dev, on_disk.st_ino):
+        return None
+    return str(Path(name).resolve())
+
+
+def unpin_upload(path):
+    """Bỏ giữ file trả về bởi cache_upload(..., pin=True) sau khi đã mở xong"""
+    with _pin_lock:
+        key = str(path)
+        _pinned[key] -= 1
+        if _pinned[key] <= 0:
+            del _pinned[key]
+
+
+def _pin(path):
+    with _pin_lock:
+        _pinned[str(path)] += 1
+
+
+def _lookup_id(file_id):
+    with _ids_lock:
+        cached = _cached_ids.get(file_id)
+        if cached is not None:
+            _cached_ids.move_to_end(file_id)
+        return cached
+
+
+def _remember_id(file_id, path):
+    with _ids_lock:
+        _cached_ids[file_id] = path
+        _cached_ids.move_to_end(file_id)
+        while len(_cached_ids) > UPLOAD_CACHE_MAX_FILES:
+            _cached_ids.popitem(last=False)
+
+
+def _forget_paths(paths):
+    with _ids_lock:
+        for file_id in [file_id for file_id, path in _cached_ids.items() if path in paths]:
+            del _cached_ids[file_id]
+
+
+def _hash_stream(fileobj, chunk_size):
+    digest = hashlib.sha256()
+    for chunk in iter(lambda: fileobj.read(chunk_size), b''):
+        digest.update(chunk)
+    return digest.hexdigest()
+
+
+def _prune(cache_dir, keep):
+    """
+    Xóa các file cache cũ nhất, chỉ giữ `keep` file dùng gần đây nhất
+
+    Bỏ qua file tạm đang ghi và file đang được giữ. File đã được mở để đọc thì
+    vẫn an toàn: trên POSIX tiến trình đang đọc vẫn giữ inode, trên Windows
+    unlink file đang mở bị từ chối (OSError, bỏ qua).
+    """
+    files = []
+    for path in cache_dir.glob('*'):
+        if path.name.startswith(PARTIAL_PREFIX):
+            continue
+        try:
+            files.append((path.stat().st_mtime, path))
+        except OSError:
+            continue
+    files.sort(key=lambda item: item[0], reverse=True)
+    removed = set()
+    with _pin_lock:
+        for _, old in files[keep:]:
+            if str(old) in _pinned:
+                continue
+            try:
+                old.unlink()
+            except OSError:
+                continue
+            removed.add(str(old))
+    if removed:
+        _forget_paths(removed)
+
+
+def cache_upload(fileobj, suffix='.mp4', cache_dir=None, chunk_size=CHUNK_SIZE, pin=False):
+    """
+    Ghi file upload ra ổ đĩa theo từng chunk, cache theo hash nội dung
+
+    Bộ nhớ dùng tối đa 1 chunk bất kể kích thước file. Nếu cùng nội dung đã
+    được ghi trước đó (ví dụ Streamlit rerun), trả về luôn file cũ.
+
+    Args:
+        fileobj: File object hỗ trợ read() (ví dụ UploadedFile của Streamlit)
+        suffix (str): Phần mở rộng file
+        cache_dir (Path): Thư mục cache (mặc định UPLOAD_CACHE_DIR)
+        chunk_size (int): Kích thước mỗi chunk (byte)
+        pin (bool): Giữ file không bị session khác dọn mất cho tới khi gọi
+            unpin_upload(đường dẫn), để mở file an toàn
+
+    Returns:
+        str: Đường dẫn file video trên ổ đĩa
+    """
+    cache_dir = Path(cache_dir or UPLOAD_CACHE_DIR)
+    cache_dir.mkdir(parents=True, exist_ok=True)
+
+    file_id = getattr(fileobj, 'file_id', None)
+    cached = _lookup_id(file_id) if file_id is not None else None
+    if cached is not None:
+        if pin:
+            _pin(cached)
+        if Path(cached).exists():
+            return cached
+        if pin:
+            unpin_upload(cached)
+        _forget_paths({cached})
+
+    seekable = hasattr(fileobj, 'seek') and (not hasattr(fileobj, 'seekable') or fileobj.seekable())
+    if seekable:
+        # Hash trước (chỉ đọc), chỉ ghi khi chưa có trong cache
+        fileobj.seek(0)
+        digest = _hash_stream(fileobj, chunk_size)
+        fileobj.seek(0)
+        target = cache_dir / f"{digest}{suffix}"
+        # Giữ file ngay khi biết tên để session khác không dọn mất giữa chừng
+        _pin(target)
+        if not target.exists():
+            fd, tmp_name = tempfile.mkstemp(suffix=suffix, prefix=PARTIAL_PREFIX, dir=cache_dir)
+            try:
+                with os.fdopen(fd, 'wb') as tmp_file:
+                    for chunk in iter(lambda: fileobj.read(chunk_size), b''):
+                        tmp_file.write(chunk)
+                os.replace(tmp_name, target)
+            except BaseException:
+                unpin_upload(target)
+                if os.path.exists(tmp_name):
+                    os.unlink(tmp_name)
+                raise
+    else:
+        # Stream không seek được: vừa ghi vừa hash rồi đổi tên theo hash
+        digest = hashlib.sha256()
+        fd, tmp_name = tempfile.mkstemp(suffix=suffix, prefix=PARTIAL_PREFIX, dir=cache_dir)
+        try:
+            with os.fdopen(fd, 'wb') as tmp_file:
+                for chunk in iter(lambda: fileobj.read(chunk_size), b''):
+                    digest.update(chunk)
+                    tmp_file.write(chunk)
+        except BaseException:
+            os.unlink(tmp_name)
+            raise
+        target = cache_dir / f"{digest.hexdigest()}{suffix}"
+        _pin(target)
+        if target.exists():
+            os.unlink(tmp_name)
+        else:
+            os.replace(tmp_name, target)
+
+    try:
+        # Đánh dấu vừa dùng để không bị xóa khi dọn cache
+        os.utime(target)
+        _prune(cache_dir, UPLOAD_CACHE_MAX_FILES)
+    finally:
+        if not pin:
+            unpin_upload(target)
+
+    if file_id is not None:
+        _remember_id(file_id, str(target))
+    return str(target)
@@ -0,0 +1,146 @@
+import shutil
+import subprocess
+import threading
+from collections import deque
+
+import cv2
+
+from utils.pipeline import FrameQueue, BLOCK, _END
+from utils.renderer import BGR, RGB
+
+# Bộ encode hỗ trợ
+OPENCV = 'opencv'
+FFMPEG = 'ffmpeg'
+
+# Số dòng stderr cuối cùng của ffmpeg được giữ lại để báo lỗi
+STDERR_LINES = 50
+
+
+class AsyncVideoWriter:
+    """
+    Ghi video trên thread nền để việc encode không làm chậm detection
+
+    Frame được đưa vào hàng đợi có giới hạn; khi hàng đợi đầy thì chờ ('block')
+    hoặc bỏ frame cũ nhất ('drop_oldest'). Có thể encode bằng cv2.VideoWriter
+    hoặc pipe frame thô sang tiến trình ffmpeg.
+
+    Args:
+        path (str): Đường dẫn file video đầu ra
+        fps (float): FPS của video đầu ra
+        size (tuple): (width, height) của frame
+        encoder (str): 'opencv' hoặc 'ffmpeg'
+        codec (str): FourCC cho opencv (mặc định 'mp4v') hoặc codec ffmpeg (mặc định 'libx264')
+        crf (int): Chất lượng cho ffmpeg (càng nhỏ càng đẹp)
+        preset (str): Preset tốc độ encode của ffmpeg
+        queue_size (int): Số frame tối đa chờ ghi
+        policy (str): 'block' hoặc 'drop_oldest' khi hàng đợi đầy
+        color_order (str): Thứ tự kênh màu của frame: 'bgr' hoặc 'rgb'. Với opencv,
+            frame RGB được chuyển màu trên thread ghi; ffmpeg nhận thẳng rgb24
+    """
+
+    def __init__(self, path, fps, size, encoder=OPENCV, codec=None, crf=23, preset='veryfast',
+                 queue_size=64, policy=BLOCK, color_order=BGR):
+        self.path = str(path)
+        self.fps = fps
+        self.size = tuple(size)
+        self.encoder = encoder
+        self.color_order = color_order
+        self.queue = FrameQueue(queue_size, policy)
+        self.stop_event = threading.Event()
+        self.frames_written = 0
+        self.error = None
+
+        if encoder == OPENCV:
+            fourcc = cv2.VideoWriter_fourcc(*(codec or 'mp4v'))
+            self._writer = cv2.VideoWriter(self.path, fourcc, fps, self.size)
+            self._process = None
+        elif encoder == FFMPEG:
+            ffmpeg = shutil.which('ffmpeg')
+            if ffmpeg is None:
+                raise ValueError("Không tìm thấy ffmpeg trong PATH. Cài ffmpeg hoặc dùng encoder 'opencv'.")
+            width, height = self.size
+            command = [
+                ffmpeg, '-y', '-loglevel', 'error',
+                '-f', 'rawvideo', '-pix_fmt', 'rgb24' if color_order == RGB else 'bgr24',
+                '-s', f'{width}x{height}', '-r', str(fps),
+                '-i', '-',
+                '-c:v', codec or 'libx264', '-crf', str(crf), '-preset', preset,
+                '-pix_fmt', 'yuv420p',
+                self.path
+            ]
+            self._process = subprocess.Popen(command, stdin=subprocess.PIPE, stderr=subprocess.PIPE)
+            self._writer = None
+            # Đọc stderr liên tục: nếu chỉ đọc lúc release, pipe đầy sẽ làm ffmpeg
+            # (và thread ghi đang chờ stdin) treo
+            self._stderr = deque(maxlen=STDERR_LINES)
+            self._stderr_thread = threading.Thread(target=self._drain_stderr, name='ffmpeg-stderr', daemon=True)
+            self._stderr_thread.start()
+        else:
+            raise ValueError(f"Encoder không hợp lệ: {encoder}")
+
+        self._thread = threading.Thread(target=self._write_loop, name='video-writer', daemon=True)
+        self._thread.start()
+
+    @property
+    def dropped(self):
+        return self.queue.dropped
+
+    def _drain_stderr(self):
+        for line in self._process.stderr:
+            self._stderr.append(line)
+        self._process.stderr.close()
+
+    def _write_loop(self):
+        try:
+            while True:
+                frame = self.queue.get(self.stop_event)
+                if frame is _END:
+                    break
+                if frame.ndim == 1:
+                    # Frame đã nén JPEG (cv2.imencode): giải nén ở đây, không tốn thời gian của phía ghi
+                    frame = cv2.imdecode(frame, cv2.IMREAD_COLOR)
+                if self._writer is not None:
+                    if self.color_order == RGB:
+                        frame = cv2.cvtColor(frame, cv2.COLOR_RGB2BGR)
+                    self._writer.write(frame)
+                else:
+                    self._process.stdin.write(frame.tobytes())
+                self.frames_written += 1
+        except Exception as e:
+            self.error = e
+            self.stop_event.set()
+
+    def write(self, frame):
+        """
+        Đưa frame (theo color_order) vào hàng đợi ghi; không được sửa frame sau khi ghi
+
+        Frame cũng có thể là ảnh JPEG đã nén (mảng uint8 1 chiều từ cv2.imencode,
+        cùng thứ tự kênh), được giải nén trên thread ghi.
+        """
+        if self.error is not None:
+            raise RuntimeError(f"Lỗi khi ghi video: {self.error}") from self.error
+        self.queue.put(frame, self.stop_event)
+
+    def release(self):
+        """
+        Ghi nốt các frame còn trong hàng đợi rồi đóng file
+
+        Không raise: lỗi encode (kể cả khi ffmpeg thoát giữa chừng) được lưu vào
+        self.error, phía gọi cần kiểm tra sau khi release.
+        """
+        self.queue.put(_END, self.stop_event)
+        self._thread.join()
+
+        if self._writer is not None:
+            self._writer.release()
+        if self._process is not None:
+            try:
+                self._process.stdin.close()
+            except OSError as e:
+                # BrokenPipeError khi ffmpeg đã thoát, lý do thật nằm trong stderr
+                self.error = self.error or e
+            self._process.wait()
+            self._stderr_thread.join()
+            if self._process.returncode != 0 and (self.error is None or isinstance(self.error, OSError)):
+                message = b''.join(self._stderr).decode(errors='ignore').strip()
+                self.error = RuntimeError(message or f"ffmpeg thoát với mã {self._process.returncode}")